@@ -0,0 +1,407 @@
+""" An asyncio engine for supervising docker containers.
+
+The :class:`AsyncEngine` runs a single event loop in a background thread
+and talks to the docker daemon directly over its unix socket. Attaching to
+a container, waiting for it to exit and streaming the output of an image
+build are all driven as coroutines on that loop, so one process may
+supervise many concurrent builds without dedicating a thread to each
+stream. Every operation supports cancellation and an optional timeout.
+
+"""
+import asyncio
+import codecs
+import io
+import json
+import os
+import queue
+import struct
+import tarfile
+import threading
+from urllib.parse import quote
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+from .utils import wait_for_future
+
+log = __import__('logging').getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = '/var/run/docker.sock'
+
+class DockerAPIError(Exception):
+    """ The daemon responded with an unexpected status code."""
+    def __init__(self, status, message):
+        Exception.__init__(
+            self, 'docker api error, status={0}: {1}'.format(status, message))
+        self.status = status
+        self.message = message
+
+def socket_path_from_env(environ=None):
+    """ Determine the path of the docker socket from ``DOCKER_HOST``.
+
+    Raises a ``ValueError`` if the daemon is not reachable over a unix
+    socket.
+
+    """
+    if environ is None:
+        environ = os.environ
+    host = environ.get('DOCKER_HOST')
+    if not host:
+        return DEFAULT_SOCKET_PATH
+    url = urlparse(host)
+    if url.scheme != 'unix':
+        raise ValueError(
+            'the asyncio engine only supports unix sockets, '
+            'DOCKER_HOST={0}'.format(host))
+    return url.path
+
+class Response(object):
+    def __init__(self, status, headers, reader, writer):
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    @property
+    def chunked(self):
+        return self.headers.get('transfer-encoding') == 'chunked'
+
+    async def iter_body(self):
+        if self.chunked:
+            while True:
+                line = await self.reader.readline()
+                size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    break
+                data = await self.reader.readexactly(size)
+                await self.reader.readexactly(2)
+                yield data
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining > 0:
+                data = await self.reader.read(min(remaining, 64 * 1024))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await self.reader.read(64 * 1024)
+                if not data:
+                    break
+                yield data
+
+    async def read(self):
+        body = io.BytesIO()
+        async for data in self.iter_body():
+            body.write(data)
+        return body.getvalue()
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body.decode('utf8')) if body else None
+
+    def close(self):
+        self.writer.close()
+
+class AsyncDockerClient(object):
+    """ A minimal client for the docker engine api over a unix socket.
+
+    A new connection is opened for every request. Connections on a local
+    unix socket are cheap and this avoids any state shared between the
+    long-lived streams used while attached to containers.
+
+    """
+    def __init__(self, socket_path=None, version=None):
+        if socket_path is None:
+            socket_path = socket_path_from_env()
+        self.socket_path = socket_path
+        self.version = version
+
+    def _url(self, path, params=None):
+        if self.version:
+            path = '/v{0}{1}'.format(self.version, path)
+        if params:
+            path += '?' + urlencode(params)
+        return path
+
+    async def request(self, method, path, params=None, headers=None,
+                      body=None):
+        """ Send a request and return the :class:`Response`.
+
+        ``body`` may be ``bytes`` or an async iterable yielding ``bytes``
+        in which case the body is sent using chunked transfer encoding.
+
+        """
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            lines = [
+                '{0} {1} HTTP/1.1'.format(method, self._url(path, params)),
+                'Host: docker',
+            ]
+            headers = dict(headers or {})
+            headers.setdefault('Connection', 'close')
+            if body is None:
+                body = b''
+            if isinstance(body, bytes):
+                headers['Content-Length'] = str(len(body))
+            else:
+                headers['Transfer-Encoding'] = 'chunked'
+            for k, v in headers.items():
+                lines.append('{0}: {1}'.format(k, v))
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+            if isinstance(body, bytes):
+                writer.write(body)
+            else:
+                async for chunk in body:
+                    if chunk:
+                        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                        await writer.drain()
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError('connection closed by the daemon')
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                k, _, v = line.decode('latin-1').partition(':')
+                response_headers[k.strip().lower()] = v.strip()
+        except BaseException:
+            writer.close()
+            raise
+
+        response = Response(status, response_headers, reader, writer)
+        if status >= 400:
+            try:
+                body = await response.read()
+            finally:
+                response.close()
+            try:
+                message = json.loads(body.decode('utf8'))['message']
+            except Exception:
+                message = body.decode('utf8', 'replace')
+            raise DockerAPIError(status, message)
+        return response
+
+    async def wait(self, container):
+        """ Wait for the container to exit and return its status code."""
+        response = await self.request(
+            'POST', '/containers/{0}/wait'.format(quote(container)))
+        try:
+            result = await response.json()
+        finally:
+            response.close()
+        return result['StatusCode']
+
+    async def attach(self, container, on_output, on_attached=None,
+                     encoding='utf8'):
+        """ Attach to the container and stream its output.
+
+        ``on_output`` is called with each chunk of stdout and stderr
+        output, decoded using ``encoding`` unless it is ``None``.
+        ``on_attached`` is called once the stream is established, the
+        container should not be started before then.
+
+        Returns the number of bytes read.
+
+        """
+        response = await self.request(
+            'POST',
+            '/containers/{0}/attach'.format(quote(container)),
+            params={'stream': 1, 'stdout': 1, 'stderr': 1},
+            headers={'Connection': 'Upgrade', 'Upgrade': 'tcp'},
+        )
+        try:
+            if on_attached is not None:
+                on_attached()
+            decoder = None
+            if encoding:
+                decoder = codecs.getincrementaldecoder(encoding)('replace')
+            num_bytes = 0
+            async for chunk in iter_frames(response.reader):
+                num_bytes += len(chunk)
+                if decoder is not None:
+                    chunk = decoder.decode(chunk)
+                    if not chunk:
+                        continue
+                on_output(chunk)
+            if decoder is not None:
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    on_output(tail)
+            return num_bytes
+        finally:
+            response.close()
+
+    async def build(self, context, params=None):
+        """ Build an image and yield each decoded event of the build output.
+
+        ``context`` is an async iterable yielding the tarball used as the
+        build context.
+
+        """
+        response = await self.request(
+            'POST', '/build',
+            params=params,
+            headers={'Content-Type': 'application/x-tar'},
+            body=context,
+        )
+        try:
+            decoder = json.JSONDecoder()
+            buf = ''
+            async for chunk in response.iter_body():
+                buf += chunk.decode('utf8', 'replace')
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        event, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+                    yield event
+        finally:
+            response.close()
+
+async def iter_frames(reader):
+    """ Decode the multiplexed stdout/stderr stream of a container."""
+    while True:
+        try:
+            header = await reader.readexactly(8)
+        except asyncio.IncompleteReadError as ex:
+            if ex.partial:
+                raise
+            return
+        _, size = struct.unpack('>BxxxL', header)
+        if size:
+            yield await reader.readexactly(size)
+
+async def with_timeout(coro, timeout):
+    """ Await ``coro``, cancelling it after ``timeout`` seconds."""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        raise asyncio.TimeoutError(
+            'operation timed out after {0}s'.format(timeout))
+
+class AsyncEngine(object):
+    """ Run coroutines for many builds on one event loop.
+
+    The loop runs in a daemon thread. Callers block on the results using
+    :meth:`run` which polls in order to keep the calling thread responsive
+    to signals, and cancels the coroutine if the caller is interrupted.
+
+    """
+    queue_size = 1000
+
+    def __init__(self, client=None, timeout=None):
+        if client is None:
+            client = AsyncDockerClient()
+        self.client = client
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name='marina-aio')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def submit(self, coro, timeout=None):
+        """ Schedule ``coro`` on the loop.
+
+        Returns a :class:`concurrent.futures.Future`. Cancelling the future
+        cancels the coroutine.
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            coro = with_timeout(coro, timeout)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """ Run ``coro`` on the loop and wait for the result."""
+        future = self.submit(coro, timeout=timeout)
+        try:
+            return wait_for_future(future)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def wait(self, container, timeout=None):
+        return self.run(self.client.wait(container), timeout=timeout)
+
+    def iter(self, agen, timeout=None):
+        """ Iterate over an async generator from a synchronous caller.
+
+        Items are pumped into a queue holding at most :attr:`queue_size`
+        items, applying backpressure to the generator if the caller falls
+        behind. The ``timeout`` applies to the entire iteration.
+
+        """
+        items = queue.Queue()
+        done = object()
+        # created on the loop, released by the caller for each item taken
+        slots = None
+
+        async def pump():
+            nonlocal slots
+            slots = asyncio.Semaphore(self.queue_size)
+            try:
+                async for item in agen:
+                    await slots.acquire()
+                    items.put(item)
+            finally:
+                await agen.aclose()
+
+        future = self.submit(pump(), timeout=timeout)
+        # wakes the caller once the pump is finished, failed or cancelled
+        future.add_done_callback(lambda f: items.put(done))
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    future.result()
+                    break
+                self.loop.call_soon_threadsafe(slots.release)
+                yield item
+        finally:
+            future.cancel()
+
+    def build(self, context, params=None, timeout=None):
+        """ Build an image, yielding the decoded events of the output.
+
+        ``context`` is an iterable yielding the tarball used as the build
+        context. It is consumed in a worker thread so that it may block.
+
+        """
+        async def body():
+            it = iter(context)
+            while True:
+                chunk = await self.loop.run_in_executor(None, next, it, None)
+                if chunk is None:
+                    break
+                yield chunk
+
+        return self.iter(self.client.build(body(), params), timeout=timeout)
+
+def make_build_context(dockerfile):
+    """ Create a tarball containing only a Dockerfile."""
+    data = dockerfile.encode('utf-8') if not isinstance(
+        dockerfile, bytes) else dockerfile
+    fp = io.BytesIO()
+    with tarfile.open(fileobj=fp, mode='w') as tf:
+        info = tarfile.TarInfo('Dockerfile')
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+    return fp.getvalue()
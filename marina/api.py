@@ -0,0 +1,330 @@
+""" A library api to build many apps concurrently without the cli.
+
+Example::
+
+    from marina.api import BatchBuilder
+
+    with BatchBuilder(jobs=4, archive_dir='/srv/slugs') as builder:
+        for result in builder.build(['apps/web', 'apps/worker'], tag='1.2'):
+            if not result.success:
+                print(result.app, result.error, ''.join(result.log))
+
+Each app is either the path to a folder containing a ``meta.yml`` or a
+:class:`marina.build.BuildSteps` whose ``context_path`` is set. The builds
+share a pool of docker clients, an image puller and optionally an artifact
+store and a warm container pool, and a :class:`BuildResult` is returned for
+each app instead of raising.
+
+"""
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import os
+import os.path
+
+import docker
+
+from .build import BuildSteps
+from .build import DockerBuilder
+from .build import ImagePuller
+from .build import configure_builder
+from .build import find_default_identity_file
+from .build import parse_build_steps_from_file
+from .clients import ClientPool
+from .utils import wait_for_future
+
+log = __import__('logging').getLogger(__name__)
+
+class BuildResult(object):
+    """ The outcome of building a single app.
+
+    ``status`` is ``0`` if the build succeeded and ``-1`` otherwise, in
+    which case ``error`` describes the failure. ``phases`` maps the name of
+    each phase of the build to its total duration in seconds and
+    ``exit_codes`` is a list of ``(phase, status)`` tuples for each
+    container run by the build. ``log`` contains the last lines of output.
+
+    ``image`` and ``tag`` identify the runner image, or the image of the
+    first variant if the app has several run variants, and ``images`` maps
+    the tag of every runner image to its id.
+
+    """
+    def __init__(self, app, version=None):
+        self.app = app
+        self.version = version
+        self.status = -1
+        self.error = None
+        self.image = None
+        self.tag = None
+        self.images = collections.OrderedDict()
+        self.build_digest = None
+        self.slug_path = None
+        self.slug_digest = None
+        self.reused = False
+        self.duration = None
+        self.phases = collections.OrderedDict()
+        self.exit_codes = []
+        self.log = []
+        self.metrics = None
+
+    @property
+    def success(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return '<BuildResult app={0} status={1} image={2}>'.format(
+            self.app, self.status, self.image)
+
+    def as_dict(self):
+        return {
+            'app': self.app,
+            'version': self.version,
+            'status': self.status,
+            'error': self.error,
+            'image': self.image,
+            'tag': self.tag,
+            'images': dict(self.images),
+            'build_digest': self.build_digest,
+            'slug_path': self.slug_path,
+            'slug_digest': self.slug_digest,
+            'reused': self.reused,
+            'duration': self.duration,
+            'phases': dict(self.phases),
+            'exit_codes': [list(item) for item in self.exit_codes],
+            'log': list(self.log),
+        }
+
+class LogTail(object):
+    """ A writer keeping the last ``max_lines`` lines of output.
+
+    Each chunk is also passed to ``write`` if it is set.
+
+    """
+    def __init__(self, max_lines=100, write=None):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.write = write
+        self.buffer = ''
+
+    def __call__(self, msg):
+        if self.write is not None:
+            self.write(msg)
+        lines = (self.buffer + msg).split('\n')
+        self.buffer = lines.pop()
+        self.lines.extend(line + '\n' for line in lines)
+
+    def flush(self):
+        if self.buffer:
+            self.lines.append(self.buffer)
+            self.buffer = ''
+
+class BatchBuilder(object):
+    """ Build many apps concurrently using up to ``jobs`` workers.
+
+    Every build shares the ``docker_pool``, a
+    :class:`marina.clients.ClientPool`, which is created from the
+    environment if it is not set. The remaining options have the same
+    meaning as the options of ``marina build``:
+
+    - ``build_dir`` is the folder in which the builds are staged.
+    - ``archive_dir`` is a folder to which the slug of each app is written
+      as ``<name>-<version><ext>``, the slugs are not kept otherwise.
+    - ``cache`` is ``False`` to disable the cache or a ``--cache`` spec.
+    - ``force`` rebuilds apps with an existing image built from identical
+      inputs.
+    - ``artifact_store`` and ``container_pool`` are an optional
+      :class:`marina.artifacts.ArtifactStore` and
+      :class:`marina.pool.ContainerPool`.
+    - ``engine`` is an optional :class:`marina.aio.AsyncEngine` enforcing
+      the ``timeout`` of each container and image build.
+    - ``log_lines`` is the number of lines of output kept per build and
+      ``on_output(app, msg)`` is called with the output of every build.
+
+    """
+    def __init__(self, docker_pool=None, jobs=4, build_dir=None,
+                 archive_dir=None, cache=True, rebuild_cache=False,
+                 force=False, pull='always', stage_mode='copy',
+                 stage_dir=None, single_pass=False, host_dist=False,
+                 compression=None, compression_level=None,
+                 compression_threads=None, reproducible=False,
+                 snapshot=False, identity_file=None, artifact_store=None,
+                 container_pool=None, engine=None, timeout=None,
+                 log_lines=100, on_output=None):
+        self.owns_pool = docker_pool is None
+        if docker_pool is None:
+            docker_pool = ClientPool(_docker_client)
+        self.docker_pool = docker_pool
+        self.jobs = jobs
+        self.build_dir = build_dir or os.getcwd()
+        self.archive_dir = archive_dir
+        self.cache = cache
+        self.rebuild_cache = rebuild_cache
+        self.force = force
+        self.puller = ImagePuller(policy=pull)
+        self.stage_mode = stage_mode
+        self.stage_dir = stage_dir
+        self.single_pass = single_pass
+        self.host_dist = host_dist
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.reproducible = reproducible
+        self.snapshot = snapshot
+        if identity_file is None:
+            identity_file = find_default_identity_file()
+        self.identity_file = identity_file
+        self.artifact_store = artifact_store
+        self.container_pool = container_pool
+        self.engine = engine
+        self.timeout = timeout
+        self.log_lines = log_lines
+        self.on_output = on_output
+
+    def build(self, apps, tag=None, env=None):
+        """ Build each of the ``apps`` and return a :class:`BuildResult`
+        for each, in the same order.
+
+        ``tag`` overrides the version of every app and ``env`` is a dict of
+        variables passed to the compile containers.
+
+        """
+        apps = list(apps)
+        for app in apps:
+            if isinstance(app, BuildSteps) and not app.context_path:
+                raise ValueError(
+                    'The context_path of app "{0}" is not set.'.format(
+                        app.name))
+        if self.archive_dir and not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as pool:
+            futures = [
+                pool.submit(self.build_one, app, tag=tag, env=env)
+                for app in apps
+            ]
+            results = [wait_for_future(future) for future in futures]
+        # completed pulls are repeated by later batches such that the
+        # builder follows the pull policy
+        self.puller.forget_completed()
+        return results
+
+    def build_one(self, app, tag=None, env=None):
+        """ Build a single app and return its :class:`BuildResult`."""
+        if isinstance(app, BuildSteps):
+            steps = copy.deepcopy(app)
+        else:
+            context_path = os.path.normpath(app)
+            try:
+                steps = parse_build_steps_from_file(
+                    os.path.join(context_path, 'meta.yml'))
+            except (IOError, ValueError) as ex:
+                result = BuildResult(app)
+                result.error = 'Invalid meta.yml in app "{0}": {1}'.format(
+                    app, ex.args[-1])
+                return result
+            steps.context_path = context_path
+        if tag:
+            steps.version = tag
+
+        result = BuildResult(steps.name, steps.version)
+        try:
+            builder = self._make_builder(steps, env)
+        except (OSError, ValueError) as ex:
+            result.error = str(ex)
+            return result
+        try:
+            builder.run()
+            result.status = 0
+        except Exception as ex:
+            log.debug('caught build exception', exc_info=1)
+            result.error = str(ex) or ex.__class__.__name__
+        finally:
+            builder.stdout.flush()
+        self._collect(builder, result)
+        return result
+
+    def _make_builder(self, steps, env):
+        steps.root_path = self.build_dir
+        steps.identity_file = self.identity_file
+
+        builder = DockerBuilder(steps, self.docker_pool)
+        on_output = None
+        if self.on_output is not None:
+            on_output = lambda msg: self.on_output(steps.name, msg)
+        builder.stdout = LogTail(self.log_lines, write=on_output)
+        builder.puller = self.puller
+        configure_builder(
+            builder,
+            force=self.force,
+            stage_mode=self.stage_mode,
+            stage_dir=self.stage_dir,
+            single_pass=self.single_pass,
+            host_dist=self.host_dist,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            compression_threads=self.compression_threads,
+            reproducible=self.reproducible,
+            snapshot=self.snapshot,
+            cache=self.cache,
+            rebuild_cache=self.rebuild_cache,
+            engine=self.engine,
+            timeout=self.timeout,
+        )
+        builder.artifact_store = self.artifact_store
+        builder.container_pool = self.container_pool
+        if env:
+            builder.extra_env = dict(env)
+        if self.archive_dir:
+            if steps.multi_step:
+                raise ValueError(
+                    'The slug of app "{0}" cannot be archived as it has '
+                    'several compile steps.'.format(steps.name))
+            builder.archive_file = os.path.join(
+                self.archive_dir, '{0}-{1}{2}'.format(
+                    steps.name, steps.version,
+                    steps.compiler.compression.extension))
+        return builder
+
+    def _collect(self, builder, result):
+        metrics = builder.metrics
+        result.metrics = metrics
+        result.image = builder.runner_image
+        if builder.runner_image:
+            result.tag = builder.runner_tag
+        result.images = builder.runner_images
+        result.build_digest = builder.build_digest
+        if builder.archive_file and builder.archive_digest:
+            result.slug_path = builder.archive_file
+            result.slug_digest = builder.archive_digest
+        result.reused = metrics.reused
+        result.duration = metrics.duration
+        if result.error is None:
+            result.error = metrics.error
+        for phase in metrics.phases:
+            result.phases.setdefault(phase.name, 0.0)
+            result.phases[phase.name] += phase.duration or 0.0
+            if phase.status is not None:
+                result.exit_codes.append((phase.name, phase.status))
+        result.log = list(builder.stdout.lines)
+
+    def close(self):
+        """ Close the docker clients if they were created by the builder."""
+        if self.owns_pool:
+            self.docker_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def build(apps, tag=None, env=None, **kw):
+    """ Build each of the ``apps`` using a new :class:`BatchBuilder`
+    created with the keyword arguments.
+
+    Returns a list of :class:`BuildResult` in the same order as ``apps``.
+
+    """
+    with BatchBuilder(**kw) as builder:
+        return builder.build(apps, tag=tag, env=env)
+
+def _docker_client():
+    return docker.from_env().api
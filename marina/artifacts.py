@@ -0,0 +1,184 @@
+""" A store of compiled slugs shared between builds and build nodes.
+
+Slugs are keyed by a digest of the inputs of the compile step such that a
+node may skip compiling a commit that was already compiled by another node.
+The store is a folder, for example an NFS mount shared by the build nodes,
+with the layout::
+
+    <path>/<key[:2]>/<key>.slug
+    <path>/<key[:2]>/<key>.json
+
+The ``.json`` file describes the slug and is written after it, readers
+ignore slugs without one. Both files are written to a temporary file in the
+same folder and renamed into place such that a partially written slug is
+never visible, even to other nodes.
+
+"""
+import io
+import json
+import logging
+import os
+import os.path
+import tempfile
+import time
+
+from .buildcache import select_evictions
+from .utils import publish_file
+
+log = __import__('logging').getLogger(__name__)
+
+class Artifact(object):
+    """ A slug in the :class:`ArtifactStore`."""
+    def __init__(self, key, path, codec, size, last_used, sha256=None):
+        self.key = key
+        self.path = path
+        self.codec = codec
+        self.size = size
+        self.last_used = last_used
+        self.sha256 = sha256
+
+    @property
+    def name(self):
+        return self.key
+
+    def __repr__(self):
+        return '<Artifact key={0!r} size={1}>'.format(self.key, self.size)
+
+class ArtifactStore(object):
+    """ A folder containing slugs keyed by the digest of their inputs.
+
+    If ``max_size`` is set the least-recently-used slugs are evicted after
+    a slug is added such that the store remains within this many bytes.
+    Each :meth:`get` updates the modification time of the ``.json`` file to
+    track usage as the access time is unreliable on network filesystems.
+
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def _prefix(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        """ Return the :class:`Artifact` for ``key`` or ``None``."""
+        prefix = self._prefix(key)
+        try:
+            with io.open(prefix + '.json', 'rb') as fp:
+                meta = json.loads(fp.read().decode('utf8'))
+            size = os.path.getsize(prefix + '.slug')
+            os.utime(prefix + '.json', None)
+        except (OSError, ValueError):
+            log.debug('no artifact found for key=%s', key, exc_info=True)
+            return None
+        return Artifact(
+            key,
+            prefix + '.slug',
+            meta.get('codec'),
+            size,
+            time.time(),
+            sha256=meta.get('sha256'),
+        )
+
+    def put(self, key, src, codec):
+        """ Add the slug at ``src`` to the store.
+
+        The slug is hardlinked into the store if possible and copied
+        otherwise. Returns the new :class:`Artifact`.
+
+        """
+        prefix = self._prefix(key)
+        dirname = os.path.dirname(prefix)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        digest = self._write(prefix + '.slug', lambda tmp_path: publish_file(
+            src, tmp_path))
+        meta = {
+            'codec': codec,
+            'sha256': digest,
+            'created_at': time.time(),
+        }
+
+        def write_meta(tmp_path):
+            with io.open(tmp_path, 'w') as fp:
+                fp.write(json.dumps(meta, sort_keys=True))
+        self._write(prefix + '.json', write_meta)
+        log.info('stored artifact key=%s in store=%s', key, self.path)
+
+        if self.max_size is not None:
+            try:
+                self.prune(self.max_size)
+            except Exception:
+                log.warn('failed to prune artifact store=%s', self.path,
+                         exc_info=log.isEnabledFor(logging.DEBUG))
+        return Artifact(
+            key,
+            prefix + '.slug',
+            codec,
+            os.path.getsize(prefix + '.slug'),
+            time.time(),
+            sha256=digest,
+        )
+
+    def _write(self, path, writer):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix='.tmp-')
+        os.close(fd)
+        try:
+            result = writer(tmp_path)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.lexists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return result
+
+    def entries(self):
+        """ Return a list of every :class:`Artifact` in the store."""
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for subdir in sorted(os.listdir(self.path)):
+            dirname = os.path.join(self.path, subdir)
+            if not os.path.isdir(dirname):
+                continue
+            for fname in sorted(os.listdir(dirname)):
+                if not fname.endswith('.json'):
+                    continue
+                key = fname[:-len('.json')]
+                prefix = os.path.join(dirname, key)
+                try:
+                    size = os.path.getsize(prefix + '.slug')
+                    last_used = os.path.getmtime(prefix + '.json')
+                except OSError:
+                    # removed by a concurrent prune
+                    continue
+                entries.append(Artifact(
+                    key, prefix + '.slug', None, size, last_used))
+        return entries
+
+    def prune(self, max_size):
+        """ Remove the least-recently-used slugs until the store is at most
+        ``max_size`` bytes.
+
+        Returns the evicted artifacts.
+
+        """
+        evictions = select_evictions(self.entries(), max_size)
+        for artifact in evictions:
+            self.remove(artifact.key)
+            log.info('evicted artifact key=%s from store=%s',
+                     artifact.key, self.path)
+        return evictions
+
+    def remove(self, key):
+        prefix = self._prefix(key)
+        # the metadata is removed first such that readers never find it
+        # without the slug
+        for path in (prefix + '.json', prefix + '.slug'):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -1,30 +1,160 @@
 from datetime import datetime
 import collections
+import copy
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
 from contextlib import contextmanager
+import hashlib
 import io
 import json
+import logging
 import os
 import os.path
 import posixpath
 import re
 import shutil
 import sys
+import tarfile
 import tempfile
 import threading
+import time
 
 import docker.errors
 import yaml
 
+from .aio import AsyncDockerClient
+from .aio import AsyncEngine
+from .aio import make_build_context
+from .aio import socket_path_from_env
+from .artifacts import ArtifactStore
+from .buildcache import BuildCache
+from .buildcache import create_cache_volume
+from .buildcache import current_cache_volume
+from .buildcache import find_cache_volumes
+from .buildcache import is_rotatable_volume
+from .buildcache import parse_cache_spec
+from .buildcache import remove_cache_volumes
+from .buildcache import step_cache
+from .clients import acquire_client
+from .clients import release_client
 from .compat import reraise
+from .metrics import BuildMetrics
+from .metrics import write_metrics_file
+from .pool import ContainerPool
+from .utils import IgnoreRules
+from .utils import format_size
+from .utils import hash_tree
+from .utils import parse_build_env
+from .utils import parse_size
+from .utils import publish_file
+from .utils import select_paths
+from .utils import split_tarball
+from .utils import stage_tree
+from .utils import wait_for_future
+from .utils import write_checksum_file
 
 log = __import__('logging').getLogger(__name__)
 
 def main(cli, args):
-    context_path = os.path.normpath(args.app)
+    if args.archive and len(args.app) > 1:
+        cli.abort('The --archive option may only be used when building a '
+                  'single app.')
 
-    steps = (
-        parse_build_steps_from_file(
-            os.path.join(context_path, 'meta.yml')))
+    env = parse_build_env(cli, args)
+
+    artifact_store = None
+    if args.artifact_store:
+        try:
+            artifact_store = ArtifactStore(
+                args.artifact_store,
+                max_size=parse_size(args.artifact_store_max_size),
+            )
+        except ValueError as ex:
+            cli.abort(ex.args[0])
+
+    container_pool = None
+    if args.warm_pool:
+        container_pool = ContainerPool(
+            max_uses=args.warm_pool_max_uses,
+            idle_timeout=args.warm_pool_idle_timeout,
+        )
+
+    engine = make_engine(cli, args)
+
+    builders = []
+    try:
+        puller = ImagePuller(policy=args.pull)
+        builders = [
+            make_builder(
+                cli, args, app,
+                env=env,
+                puller=puller,
+                artifact_store=artifact_store,
+                container_pool=container_pool,
+                engine=engine,
+            )
+            for app in args.app
+        ]
+        if len(builders) == 1:
+            return run_builder(builders[0])
+
+        for builder in builders:
+            builder.stdout = LinePrefixer(
+                cli.out, '[{0}] '.format(builder.steps.name))
+        return run_builders(cli, builders, jobs=args.jobs)
+    finally:
+        if engine is not None:
+            engine.close()
+        if container_pool is not None:
+            with cli.docker_pool.client() as client:
+                container_pool.close(client)
+        if args.metrics_file and builders:
+            try:
+                write_metrics_file(
+                    args.metrics_file,
+                    [builder.metrics for builder in builders],
+                    format=args.metrics_format,
+                )
+            except Exception:
+                log.exception('failed to write metrics to file=%s',
+                              args.metrics_file)
+
+def make_engine(cli, args):
+    """ Create the :class:`marina.aio.AsyncEngine` selected by ``--engine``
+    or return ``None``.
+
+    """
+    if args.timeout is not None and args.engine != 'asyncio':
+        cli.abort('The --timeout option requires --engine=asyncio.')
+    if args.timeout is not None and args.warm_pool:
+        # the build script is exec'd without the engine in a warm container
+        cli.abort('The --timeout option is not supported with --warm-pool.')
+    if args.engine != 'asyncio':
+        return None
+    try:
+        return AsyncEngine(
+            AsyncDockerClient(socket_path_from_env()),
+            timeout=args.timeout,
+        )
+    except ValueError as ex:
+        cli.abort(ex.args[0])
+
+def make_builder(cli, args, app, env=None, puller=None, artifact_store=None,
+                 container_pool=None, engine=None):
+    context_path = os.path.normpath(app)
+
+    try:
+        steps = (
+            parse_build_steps_from_file(
+                os.path.join(context_path, 'meta.yml')))
+    except ValueError as ex:
+        cli.abort('Invalid meta.yml in app "{0}": {1}'.format(
+            app, ex.args[0]))
+    if steps.multi_step and args.archive:
+        cli.abort('The --archive option is not supported by apps with '
+                  'several compile steps.')
     steps.root_path = args.build_dir
     steps.context_path = context_path
     steps.identity_file = args.identity_file
@@ -35,50 +165,97 @@ def main(cli, args):
         log.info('overriding version tag=%s', args.tag)
         steps.version = args.tag
 
-    builder = DockerBuilder(steps, lambda: cli.docker_client().api)
+    builder = DockerBuilder(steps, cli.docker_pool)
     builder.stdout = cli.out
     builder.archive_only = args.archive_only
     builder.archive_file = args.archive
     builder.skip_cleanup = args.skip_cleanup
 
-    if args.env:
-        env = {}
-        for entry in args.env:
-            parts = entry.split('=', 1)
-            if len(parts) != 2:
-                cli.abort(
-                    'Environment variables must follow the KEY=VALUE '
-                    'format. Invalid entry: "{0}".'.format(entry))
-            k, v = parts
-            env[k] = v
+    try:
+        configure_builder(
+            builder,
+            force=args.force,
+            stage_mode=args.stage_mode,
+            stage_dir=args.stage_dir,
+            single_pass=args.single_pass,
+            host_dist=args.host_dist,
+            compression=args.compression,
+            compression_level=args.compression_level,
+            compression_threads=args.compression_threads,
+            reproducible=args.reproducible,
+            snapshot=args.snapshot,
+            cache=args.cache if args.use_cache else False,
+            rebuild_cache=args.rebuild_cache,
+            engine=engine,
+            timeout=args.timeout,
+        )
+    except ValueError as ex:
+        cli.abort(ex.args[0])
+
+    if env:
         builder.extra_env = env
 
-    if args.use_cache:
-        cache_volume = '{0}__buildcache'.format(steps.name)
-        cache_hostpath = None
-        cache_path = '/tmp/cache'
-        if args.cache:
-            parts = args.cache.split(':', 1)
-            if posixpath.isabs(parts[0]):
-                cache_hostpath = parts[0]
-                cache_volume = None
-            else:
-                cache_volume = parts[0]
-            if len(parts) == 2:
-                cache_path = parts[1]
-            if not posixpath.isabs(cache_path):
-                cli.abort('The cache "path" must be an absolute path.')
-
-        builder.cache_volume = cache_volume
-        builder.cache_hostpath = cache_hostpath
-        builder.cache_path = cache_path
-        builder.rebuild_cache = args.rebuild_cache
+    if puller is not None:
+        builder.puller = puller
+
+    if artifact_store is not None:
+        builder.artifact_store = artifact_store
+
+    if container_pool is not None:
+        builder.container_pool = container_pool
+
+    return builder
+
+def configure_builder(builder, force=False, stage_mode='copy', stage_dir=None,
+                      single_pass=False, host_dist=False, compression=None,
+                      compression_level=None, compression_threads=None,
+                      reproducible=False, snapshot=False, cache=True,
+                      rebuild_cache=False, engine=None, timeout=None):
+    """ Apply the build options shared by ``marina build``, the daemon,
+    ``marina watch`` and :mod:`marina.api` to a :class:`DockerBuilder`.
+
+    The options have the same meaning as the command line options. The
+    compression options override the settings of every compile step.
+    ``cache`` is ``False`` to disable the cache, ``True`` to use the
+    default cache or a ``--cache`` spec. Raises a ``ValueError`` if the
+    spec is invalid.
+
+    """
+    steps = builder.steps
+    builder.skip_unchanged = not force
+    builder.stage_mode = stage_mode
+    builder.stage_dir = stage_dir
+    builder.single_pass = single_pass
+    builder.host_dist = host_dist
+    builder.engine = engine
+    builder.timeout = timeout
+
+    for step in steps.compilers:
+        step.compression = step.compression.override(
+            codec=compression,
+            level=compression_level,
+            threads=compression_threads,
+        )
+        if reproducible:
+            step.reproducible = True
+        if snapshot:
+            step.snapshot = True
+
+    if cache is not False:
+        (
+            builder.cache_volume,
+            builder.cache_hostpath,
+            builder.cache_path,
+        ) = parse_cache_spec(cache if cache is not True else None, steps.name)
+        builder.rebuild_cache = rebuild_cache
+        builder.cache_max_size = steps.cache_max_size
     else:
         builder.cache_volume = None
         builder.cache_hostpath = None
         builder.cache_path = None
         builder.rebuild_cache = False
 
+def run_builder(builder):
     try:
         builder.run()
     except Exception as ex:
@@ -87,8 +264,187 @@ def main(cli, args):
         return -1
     return 0
 
+def run_builders(cli, builders, jobs=1):
+    """ Run many builders concurrently using a pool of ``jobs`` workers.
+
+    A summary of the status and duration of each build is written to
+    the output once they are all complete.
+
+    """
+    def worker(builder):
+        start = time.time()
+        try:
+            ret = run_builder(builder)
+        finally:
+            builder.stdout.flush()
+        return ret, time.time() - start
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = [pool.submit(worker, builder) for builder in builders]
+        for builder, future in zip(builders, futures):
+            results.append((builder, wait_for_future(future)))
+
+    name_width = max(len(b.steps.name) for b in builders)
+    name_width = max(name_width, len('app'))
+    row = u'{0:<%d}  {1:<6}  {2:>9}\n' % name_width
+    cli.out(row.format('app', 'status', 'duration'))
+    for builder, (ret, elapsed) in results:
+        cli.out(row.format(
+            builder.steps.name,
+            'ok' if ret == 0 else 'failed',
+            '{0:.1f}s'.format(elapsed),
+        ))
+    if any(ret != 0 for _, (ret, _) in results):
+        return -1
+    return 0
+
+class LinePrefixer(object):
+    """ A writer that prefixes each line of output.
+
+    Partial lines are buffered until they are complete such that the
+    output of concurrent builds is never interleaved within a line.
+
+    """
+    # reentrant as the output of a compile step is prefixed again when
+    # building several apps
+    lock = threading.RLock()
+
+    def __init__(self, write, prefix):
+        self.write = write
+        self.prefix = prefix
+        self.buffer = u''
+
+    def __call__(self, msg):
+        lines = (self.buffer + msg).split(u'\n')
+        self.buffer = lines.pop()
+        if lines:
+            with self.lock:
+                self.write(u''.join(
+                    u'{0}{1}\n'.format(self.prefix, line) for line in lines))
+
+    def flush(self):
+        if self.buffer:
+            msg, self.buffer = self.buffer, u''
+            with self.lock:
+                self.write(u'{0}{1}\n'.format(self.prefix, msg))
+
+PULL_POLICIES = ('always', 'missing', 'never')
+
+class ImagePuller(object):
+    """ Pull images in the background according to a pull policy.
+
+    Each image is pulled at most once, sharing the result with every build
+    that requires it. The policy may be one of:
+
+    - ``always`` - always pull the image from the registry.
+    - ``missing`` - only pull the image if it is not available locally.
+    - ``never`` - never pull, the image must be available locally.
+
+    """
+    def __init__(self, policy='always'):
+        if policy not in PULL_POLICIES:
+            raise ValueError('unknown pull policy "{0}"'.format(policy))
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.pulls = {}
+
+    def start(self, connector, image):
+        """ Start pulling ``image`` in a background thread if it is not
+        already being pulled.
+
+        The thread leases its own client from ``connector``, see
+        :func:`marina.clients.acquire_client`, as the pull may outlive the
+        build that started it.
+
+        Returns a :class:`concurrent.futures.Future`.
+
+        """
+        ref = normalize_image_ref(image)
+        with self.lock:
+            future = self.pulls.get(ref)
+            if future is not None:
+                log.debug('sharing pull of image=%s', ref)
+                return future
+            future = self.pulls[ref] = Future()
+
+        def worker():
+            try:
+                client = acquire_client(connector)
+                try:
+                    self._pull(client, image)
+                finally:
+                    release_client(connector, client)
+            except BaseException as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(None)
+
+        th = threading.Thread(target=worker)
+        th.daemon = True
+        th.start()
+        return future
+
+    def pull(self, connector, image):
+        """ Pull ``image`` and wait for it to complete."""
+        return wait_for_future(self.start(connector, image))
+
+    def forget_completed(self):
+        """ Forget the completed pulls such that a later build pulls the
+        images again according to the policy.
+
+        """
+        with self.lock:
+            for ref, future in list(self.pulls.items()):
+                if future.done():
+                    del self.pulls[ref]
+
+    def _pull(self, client, image):
+        if self.policy != 'always':
+            try:
+                client.inspect_image(image)
+            except docker.errors.NotFound:
+                if self.policy == 'never':
+                    raise RuntimeError(
+                        'could not find image={0} locally and the pull '
+                        'policy is "never"'.format(image))
+            else:
+                log.info('found image=%s locally, skipping pull', image)
+                return
+        log.info('pulling image=%s', image)
+        client.pull(image)
+        log.info('pulled image=%s', image)
+
+_stage_locks = {}
+_stage_locks_lock = threading.Lock()
+
+def stage_lock(path):
+    """ The lock shared by every build staging its context into the
+    persistent folder at ``path``.
+
+    """
+    path = os.path.abspath(path)
+    with _stage_locks_lock:
+        return _stage_locks.setdefault(path, threading.Lock())
+
+def normalize_image_ref(image):
+    """ Normalize an image reference such that equivalent references to
+    images on the docker hub compare equal.
+
+    """
+    for prefix in ('docker.io/library/', 'docker.io/'):
+        if image.startswith(prefix):
+            image = image[len(prefix):]
+            break
+    if '@' not in image and ':' not in image.rsplit('/', 1)[-1]:
+        image += ':latest'
+    return image
+
 def parse_build_steps(data):
-    settings = yaml.safe_load(data)
+    try:
+        settings = yaml.safe_load(data)
+    except yaml.YAMLError as ex:
+        raise ValueError('invalid yaml: {0}'.format(ex))
     return BuildSteps(settings)
 
 def parse_build_steps_from_file(fname):
@@ -105,34 +461,206 @@ class BuildSteps(object):
     identity_file = None
     # the path to a valid ssh identity file
 
+    ignore_file = '.marinaignore'
+    # the name of the file in the build context containing ignore patterns
+
     class CompileStep(object):
         def __init__(self, settings):
+            self.settings = settings
+            self.name = settings.get('name')
+            self.depends_on = settings.get('depends_on') or []
+            if not isinstance(self.depends_on, list):
+                self.depends_on = [self.depends_on]
             self.base_image = settings['base_image']
-            self.commands = settings.get('commands', [])
-            self.files = settings['files']
+            # a command is either a string or a dict with the command to
+            # "run" and the "inputs" from the context it depends upon
+            self.commands = []
+            self.command_inputs = []
+            for command in settings.get('commands', []):
+                inputs = None
+                if isinstance(command, dict):
+                    inputs = command.get('inputs')
+                    if isinstance(inputs, str):
+                        inputs = [inputs]
+                    command = command['run']
+                self.commands.append(command)
+                self.command_inputs.append(inputs)
+            self.file_groups = parse_file_groups(settings['files'])
+            self.files = [
+                pattern
+                for _, patterns in self.file_groups
+                for pattern in patterns
+            ]
+            self.compression = Compression.from_settings(
+                settings.get('compression'))
+            # the layers of grouped files are only reused when unchanged
+            # groups are archived identically
+            self.reproducible = (
+                bool(settings.get('reproducible', False)) or
+                len(self.file_groups) > 1
+            )
+            self.snapshot = bool(settings.get('snapshot', False))
+            self.max_snapshots = int(settings.get('max_snapshots', 20))
 
     class RunStep(object):
-        def __init__(self, settings):
+        def __init__(self, settings, name=None):
+            # the name of the variant if ``run`` is a list of variants
+            self.name = name
             self.base_image = settings['base_image']
             self.override_config = settings.get('config', {})
 
     def __init__(self, settings):
+        self.settings = settings
         tag = settings.get('tag')
         if tag is None:
             tag = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
         self.version = tag
         self.name = settings['name']
-        self.compiler = self.CompileStep(settings['compile'])
-        self.runner = self.RunStep(settings['run'])
+        compile_settings = settings['compile']
+        if isinstance(compile_settings, list):
+            self.compilers = sort_compile_steps(
+                [self.CompileStep(s) for s in compile_settings])
+        else:
+            self.compilers = [self.CompileStep(compile_settings)]
+        self.compiler = self.compilers[0]
+        run_settings = settings['run']
+        if isinstance(run_settings, list):
+            self.runners = [
+                self.RunStep(s, name=s.get('name')) for s in run_settings]
+            names = [runner.name for runner in self.runners]
+            if not names:
+                raise ValueError('at least one run variant is required')
+            if None in names or len(set(names)) != len(names):
+                raise ValueError('each run variant must have a unique name')
+            for name in names:
+                if not RUN_VARIANT_NAME_PATTERN.match(str(name)):
+                    raise ValueError(
+                        'invalid run variant name "{0}", the name is part '
+                        'of the image repository and must be made of '
+                        'lowercase letters and digits separated by ".", '
+                        '"_" or "-"'.format(name))
+        else:
+            self.runners = [self.RunStep(run_settings)]
+        self.runner = self.runners[0]
+        cache_settings = settings.get('cache') or {}
+        self.cache_max_size = parse_size(cache_settings.get('max_size'))
+
+    @property
+    def multi_step(self):
+        """ Whether the app is compiled by several named compile steps."""
+        return len(self.compilers) > 1
+
+    @property
+    def run_variants(self):
+        """ The names of the run variants, empty unless ``run`` is a list."""
+        return [
+            runner.name for runner in self.runners if runner.name is not None]
+
+    def get_compile_step(self, name):
+        for step in self.compilers:
+            if step.name == name:
+                return step
+        raise ValueError('unknown compile step "{0}"'.format(name))
+
+    def for_compile_step(self, name):
+        """ Return a copy of the steps that only contains the compile step
+        named ``name``.
+
+        """
+        steps = copy.copy(self)
+        steps.compiler = self.get_compile_step(name)
+        steps.compilers = [steps.compiler]
+        return steps
+
+    def for_run_variant(self, name):
+        """ Return a copy of the steps that only contains the run variant
+        named ``name``.
+
+        """
+        steps = copy.copy(self)
+        for runner in self.runners:
+            if runner.name == name:
+                steps.runner = runner
+                steps.runners = [runner]
+                return steps
+        raise ValueError('unknown run variant "{0}"'.format(name))
+
+    def update_digest(self, h):
+        """ Update the hash ``h`` with the app settings and build context.
+
+        The version tag is ignored so that rebuilding unchanged inputs
+        under a new tag results in the same digest.
+
+        """
+        settings = dict(self.settings)
+        settings.pop('tag', None)
+        h.update(json.dumps(settings, sort_keys=True, default=str)
+                 .encode('utf8'))
+        self._update_context_digest(h)
+
+    def update_compile_digest(self, h):
+        """ Update the hash ``h`` with the inputs of the compile step.
+
+        Unlike :meth:`update_digest` the run step is ignored, along with the
+        version tag, such that the digest identifies the slug. The slug
+        must therefore not depend on ``BUILD_VERSION``.
+
+        """
+        compression = self.compiler.compression
+        settings = {
+            'name': self.name,
+            'compile': self.compiler.settings,
+            'compression': [
+                compression.codec, compression.level, compression.threads],
+            'reproducible': self.compiler.reproducible,
+        }
+        h.update(json.dumps(settings, sort_keys=True, default=str)
+                 .encode('utf8'))
+        self._update_context_digest(h)
+
+    def _update_context_digest(self, h):
+        if self.context_path:
+            ignore = self.get_context_ignore()
 
-    def write_context(self, dir):
+            def ignore_for_digest(relpath):
+                # the parsed meta.yml is hashed above
+                if relpath == 'meta.yml':
+                    return True
+                return ignore is not None and ignore(relpath)
+
+            hash_tree(self.context_path, h, ignore=ignore_for_digest)
+
+    def get_context_ignore(self):
+        """ Return a callable matching paths in the build context that
+        should be excluded from the build, or ``None``.
+
+        """
         if self.context_path:
-            log.debug('copied the build context from path=%s',
-                      self.context_path)
-            shutil.copytree(
+            return IgnoreRules.from_file(self.context_path, self.ignore_file)
+
+    def write_context(self, dir, mode='copy', target=None):
+        """ Stage the build context into ``<dir>/context``.
+
+        If ``target`` is specified the context is staged there instead,
+        which is useful in combination with ``mode='sync'`` to incrementally
+        update a persistent folder between builds.
+
+        Returns a :class:`marina.utils.StageStats` or ``None`` if there is
+        no build context.
+
+        """
+        if target is None:
+            target = os.path.join(dir, 'context')
+        if self.context_path:
+            stats = stage_tree(
                 self.context_path,
-                os.path.join(dir, 'context'),
+                target,
+                mode=mode,
+                ignore=self.get_context_ignore(),
             )
+            log.debug('staged the build context from path=%s to path=%s '
+                      'using mode=%s', self.context_path, target, mode)
+            return stats
         else:
             log.warn('could not find a valid build context')
 
@@ -144,9 +672,13 @@ class BuildSteps(object):
         else:
             log.warn('could not find a valid ssh identity file')
 
-    def write_build_script(self, dir, rebuild_cache=False):
+    def write_build_script(self, dir, rebuild_cache=False,
+                           cleanup_identity=False):
         script = BuildScript()
         script.rebuild_cache = rebuild_cache
+        script.cleanup_identity = cleanup_identity
+        script.reproducible = self.compiler.reproducible
+        script.compression = self.compiler.compression
 
         script.add_commands(self.compiler.commands)
         script.add_archive_patterns(self.compiler.files)
@@ -155,9 +687,280 @@ class BuildSteps(object):
         with io.open(script_path, 'w') as fp:
             script.save(fp)
 
+    def write_snapshot_scripts(self, dir, start=0, rebuild_cache=False):
+        """ Write a ``command-<i>.sh`` script for each command from the
+        ``start`` index onward and an ``archive.sh`` script writing the slug.
+
+        Used instead of :meth:`write_build_script` when the compile container
+        is snapshotted after each command.
+
+        """
+        script = BuildScript()
+        script.rebuild_cache = rebuild_cache
+        script.reproducible = self.compiler.reproducible
+        script.compression = self.compiler.compression
+        script.add_archive_patterns(self.compiler.files)
+
+        # the first script refreshes the context within the container
+        script.sync_context = True
+        for i, command in enumerate(self.compiler.commands):
+            if i < start:
+                continue
+            script_path = os.path.join(dir, 'command-{0}.sh'.format(i))
+            with io.open(script_path, 'w') as fp:
+                script.save_command(fp, command)
+            # the cache is only cleared before the first command
+            script.rebuild_cache = False
+            script.sync_context = False
+
+        with io.open(os.path.join(dir, 'archive.sh'), 'w') as fp:
+            script.save_archive(fp)
+
+def parse_file_groups(files):
+    """ Parse the ``files`` of a compile step.
+
+    The files are either a list of paths or a mapping of group names to
+    lists of paths, in which case each group is installed as a separate
+    layer of the runner image in order.
+
+    Returns a list of ``(group, paths)`` tuples where the group of a plain
+    list of paths is ``None``.
+
+    """
+    if isinstance(files, dict):
+        groups = []
+        for name, paths in files.items():
+            if isinstance(paths, str):
+                paths = [paths]
+            if not paths:
+                raise ValueError(
+                    'the files group "{0}" is empty'.format(name))
+            groups.append((str(name), list(paths)))
+        if not groups:
+            raise ValueError('at least one files group is required')
+        return groups
+    if isinstance(files, str):
+        files = [files]
+    return [(None, list(files))]
+
+COMPILE_STEP_NAME_PATTERN = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_.-]*$')
+
+# a component of a docker repository name, see
+# https://github.com/distribution/reference/blob/main/reference.go
+RUN_VARIANT_NAME_PATTERN = re.compile(r'^[a-z0-9]+(?:[._-][a-z0-9]+)*$')
+
+def sort_compile_steps(steps):
+    """ Validate the named compile steps and sort them such that each step
+    follows the steps it depends on. Independent steps keep their order.
+
+    Raises a ``ValueError`` if the names are invalid or if the dependencies
+    are unknown or cyclic.
+
+    """
+    by_name = collections.OrderedDict()
+    for step in steps:
+        if not step.name or not COMPILE_STEP_NAME_PATTERN.match(step.name):
+            raise ValueError(
+                'invalid compile step name "{0}", each compile step requires '
+                'a name made of letters, digits, ".", "_" or "-"'
+                .format(step.name))
+        if step.name in by_name:
+            raise ValueError(
+                'duplicate compile step name "{0}"'.format(step.name))
+        by_name[step.name] = step
+    for step in steps:
+        for dep in step.depends_on:
+            if dep not in by_name:
+                raise ValueError(
+                    'compile step "{0}" depends on unknown step "{1}"'
+                    .format(step.name, dep))
+
+    result = []
+    visiting = set()
+    visited = set()
+
+    def visit(step):
+        if step.name in visited:
+            return
+        if step.name in visiting:
+            raise ValueError(
+                'compile step "{0}" depends on itself'.format(step.name))
+        visiting.add(step.name)
+        for dep in step.depends_on:
+            visit(by_name[dep])
+        visiting.discard(step.name)
+        visited.add(step.name)
+        result.append(step)
+
+    for step in steps:
+        visit(step)
+    return result
+
+class Compression(object):
+    """ The codec used to compress the slug.
+
+    If the compressor is not installed in the compile image the archive
+    is compressed using gzip instead. The codec that was actually used is
+    written next to the archive in a file with a ``.codec`` suffix. If it
+    is not installed in the runner image the slug is decompressed using
+    the compile image before it is extracted.
+
+    """
+    extensions = {
+        'gzip': '.tar.gz',
+        'pigz': '.tar.gz',
+        'zstd': '.tar.zst',
+        'lz4': '.tar.lz4',
+        'none': '.tar',
+    }
+
+    # the range of compression levels accepted by each codec, zstd requires
+    # the --ultra option above level 19
+    levels = {
+        'gzip': (1, 9),
+        'pigz': (1, 9),
+        'zstd': (1, 22),
+        'lz4': (1, 12),
+    }
+
+    def __init__(self, codec='gzip', level=None, threads=None):
+        if codec not in self.extensions:
+            raise ValueError(
+                'unknown compression codec "{0}", must be one of {1}'
+                .format(codec, ', '.join(sorted(self.extensions))))
+        self.codec = codec
+        self.level = None if level is None else int(level)
+        self.threads = None if threads is None else int(threads)
+
+    @classmethod
+    def from_settings(cls, settings):
+        if settings is None:
+            return cls()
+        if not isinstance(settings, dict):
+            return cls(settings)
+        return cls(
+            settings.get('codec', 'gzip'),
+            level=settings.get('level'),
+            threads=settings.get('threads'),
+        )
+
+    def override(self, codec=None, level=None, threads=None):
+        return Compression(
+            codec or self.codec,
+            level=self.level if level is None else level,
+            threads=self.threads if threads is None else threads,
+        )
+
+    @property
+    def extension(self):
+        return self.extensions[self.codec]
+
+    def compressor(self, codec=None, reproducible=False):
+        """ The shell command compressing stdin to stdout.
+
+        If ``reproducible`` is ``True`` the gzip header does not contain a
+        timestamp such that identical input is compressed identically. The
+        level is clamped to the range supported by the codec.
+
+        """
+        codec = codec or self.codec
+        level = self.level
+        if level is not None and codec in self.levels:
+            low, high = self.levels[codec]
+            level = max(min(level, high), low)
+        args = [codec]
+        if codec in ('gzip', 'pigz') and reproducible:
+            args.append('-n')
+        if codec == 'pigz' and self.threads:
+            args.append('-p {0}'.format(self.threads))
+        elif codec == 'zstd':
+            args.append('-q -T{0}'.format(self.threads or 0))
+            if level is not None and level > 19:
+                args.append('--ultra')
+        elif codec == 'lz4':
+            args.append('-q')
+        if level is not None:
+            args.append('-{0}'.format(level))
+        return ' '.join(args)
+
+    def render_archive_script(self, patterns, reproducible=False):
+        """ The shell script writing the slug to ``$BUILD_ARCHIVE_PATH``.
+
+        If ``reproducible`` is ``True`` the entries are sorted by name and
+        their owners and modification times are normalized such that
+        identical files result in an identical slug, see
+        :attr:`reproducible_script`.
+
+        """
+        files = ' '.join(u'"%s"' % pattern for pattern in patterns)
+        options = u'--posix'
+        lines = [u'BUILD_ARCHIVE_CODEC={0}'.format(self.codec)]
+        if reproducible:
+            lines.append(self.reproducible_script)
+            options += u' $BUILD_TAR_OPTIONS'
+        if self.codec == 'none':
+            lines.append(u'tar cf "$BUILD_ARCHIVE_PATH" {0} {1}'.format(
+                options, files))
+        elif self.codec == 'gzip' and self.level is None and not reproducible:
+            lines.append(u'tar czf "$BUILD_ARCHIVE_PATH" {0} {1}'.format(
+                options, files))
+        else:
+            if self.codec != 'gzip':
+                lines.append(self.fallback_script.format(codec=self.codec))
+            lines.append(self.pipeline_script.format(
+                options=options,
+                files=files,
+                compressor=self.compressor(reproducible=reproducible),
+                fallback=self.compressor('gzip', reproducible=reproducible),
+            ))
+        lines.append(
+            u'echo "$BUILD_ARCHIVE_CODEC" > "$BUILD_ARCHIVE_PATH.codec"')
+        return u'\n'.join(lines) + u'\n'
+
+    def extract_args(self, path, codec=None):
+        """ The arguments to ``tar`` for extracting the archive to ``/``."""
+        codec = codec or self.codec
+        if codec in ('gzip', 'pigz'):
+            args = ['xzf']
+        elif codec == 'none':
+            args = ['xf']
+        else:
+            args = ['-I', codec, '-xf']
+        return args + [path, '-C', '/']
+
+    fallback_script = u'''\
+if ! command -v {codec} > /dev/null 2>&1; then
+    echo "{codec} is not installed, falling back to gzip" >&2
+    BUILD_ARCHIVE_CODEC=gzip
+fi'''
+
+    pipeline_script = u'''\
+if [ "$BUILD_ARCHIVE_CODEC" = "gzip" ]; then
+    tar cf - {options} {files} | {fallback} > "$BUILD_ARCHIVE_PATH"
+else
+    tar cf - {options} {files} | {compressor} > "$BUILD_ARCHIVE_PATH"
+fi'''
+
+    # the modification times are clamped to SOURCE_DATE_EPOCH, see
+    # https://reproducible-builds.org/docs/source-date-epoch/
+    reproducible_script = u'''\
+: "${SOURCE_DATE_EPOCH:=0}"
+if tar --version 2> /dev/null | grep -q "GNU tar"; then
+    BUILD_TAR_OPTIONS="--sort=name --owner=0 --group=0 --numeric-owner \\
+--mtime=@$SOURCE_DATE_EPOCH --clamp-mtime \\
+--pax-option=exthdr.name=%d/PaxHeaders/%f,delete=atime,delete=ctime"
+else
+    echo "GNU tar is not installed, the archive is not reproducible" >&2
+    BUILD_TAR_OPTIONS=
+fi'''
+
 class BuildScript(object):
     """ The entry point for the build container."""
     rebuild_cache = False
+    reproducible = False
+    sync_context = False
+    cleanup_identity = False
+    compression = Compression()
 
     def __init__(self):
         self.commands = []
@@ -172,6 +975,9 @@ class BuildScript(object):
     def save(self, fp):
         fp.write(self.setup_script)
 
+        if self.cleanup_identity:
+            fp.write(self.cleanup_identity_script)
+
         if self.rebuild_cache:
             fp.write(u'find "$BUILD_CACHE" -mindepth 1 -delete\n')
 
@@ -182,12 +988,38 @@ class BuildScript(object):
 
         if self.archive_patterns:
             fp.write(self.archive_prefix_script)
-            fp.write(u'tar czf "$BUILD_ARCHIVE_PATH" --posix %s\n' % (
-                ' '.join(
-                    u'"%s"' % pattern
-                    for pattern in self.archive_patterns
-                )
-            ))
+            fp.write(self.compression.render_archive_script(
+                self.archive_patterns, reproducible=self.reproducible))
+
+    def save_command(self, fp, command):
+        """ Write a script running a single ``command``.
+
+        The ssh identity is removed when the script exits such that it is
+        not part of the snapshot of the container.
+
+        """
+        fp.write(self.setup_script)
+        fp.write(self.cleanup_identity_script)
+
+        if self.rebuild_cache:
+            fp.write(u'find "$BUILD_CACHE" -mindepth 1 -delete\n')
+
+        if self.sync_context:
+            fp.write(self.sync_context_script)
+
+        fp.write(self.command_prefix_script)
+        fp.write(u'%s\n' % command)
+
+    def save_archive(self, fp):
+        """ Write a script which only writes the slug."""
+        fp.write(self.archive_setup_script)
+        if self.sync_context:
+            fp.write(self.sync_context_script)
+        fp.write(u'\ncd "$BUILD_CONTEXT"\n')
+        if self.archive_patterns:
+            fp.write(self.archive_prefix_script)
+            fp.write(self.compression.render_archive_script(
+                self.archive_patterns, reproducible=self.reproducible))
 
     setup_script = u'''\
 set -eo pipefail
@@ -229,25 +1061,179 @@ cd "$BUILD_CONTEXT"
 # generate a binary archive
 '''
 
+    archive_setup_script = u'''\
+set -eo pipefail
+'''
+
+    # the files copied from the context are listed next to it such that
+    # the files removed from the context since the snapshot are removed
+    # while the files written by the commands are kept
+    sync_context_script = u'''
+# copy the context into the container such that it is snapshotted
+mkdir -p "$BUILD_CONTEXT"
+(cd "$BUILD_ROOT/context" && find . -mindepth 1 | LC_ALL=C sort) \\
+    > "$BUILD_CONTEXT.files.new"
+if [ -f "$BUILD_CONTEXT.files" ]; then
+    LC_ALL=C comm -23 "$BUILD_CONTEXT.files" "$BUILD_CONTEXT.files.new" |
+    while IFS= read -r path; do
+        rm -rf "$BUILD_CONTEXT/$path"
+    done
+fi
+mv "$BUILD_CONTEXT.files.new" "$BUILD_CONTEXT.files"
+cp -a "$BUILD_ROOT/context/." "$BUILD_CONTEXT/"
+'''
+
+    cleanup_identity_script = u'''
+# keep the identity out of the container once the script exits
+trap 'rm -f "$SSH_CONFIG_DIR/ssh_identity"' EXIT
+'''
+
+class BuildOutput(object):
+    """ Iterate over the decoded events of an image build.
+
+    The id of the built image is parsed from the ``aux`` events as they
+    stream, falling back to the ``Successfully built`` message emitted by
+    older daemons. Only the last ``max_chunks`` chunks of output are kept
+    in :attr:`tail` such that memory usage remains bounded regardless of
+    how chatty the build is.
+
+    An error event raises an exception containing the recent output.
+
+    """
+    max_chunks = 200
+
+    image_id_pattern = re.compile(r'Successfully built ([0-9a-f]+)')
+
+    def __init__(self, events, on_event=None, max_chunks=None):
+        self.events = events
+        self.on_event = on_event
+        if max_chunks is None:
+            max_chunks = self.max_chunks
+        self.tail = collections.deque(maxlen=max_chunks)
+        self.image_id = None
+
+    def __iter__(self):
+        for event in self.events:
+            if self.on_event is not None:
+                self.on_event(event)
+            if 'error' in event:
+                raise Exception(
+                    'error while building image: {0}'.format(event['error']),
+                    event, self.output,
+                )
+            aux = event.get('aux')
+            if isinstance(aux, dict) and aux.get('ID'):
+                self.image_id = aux['ID']
+            msg = event.get('stream')
+            if msg:
+                self.tail.append(msg)
+                if self.image_id is None:
+                    match = self.image_id_pattern.search(msg)
+                    if match:
+                        self.image_id = match.group(1)
+            yield event
+
+    @property
+    def output(self):
+        """ The most recent output of the build."""
+        return ''.join(self.tail)
+
+RunnerLayer = collections.namedtuple(
+    'RunnerLayer', ['name', 'slug', 'codec', 'paths'])
+# a layer of the runner image extracted from the paths within a slug, or
+# the entire slug if paths is None
+
+PoolKey = collections.namedtuple(
+    'PoolKey', ['app', 'step', 'image', 'root', 'cache', 'cache_path'])
+# identifies the warm compile containers which may be shared by builds,
+# covering everything fixed when the container is created
+
 class DockerBuilder(object):
     """ Execute a build on a docker client."""
     build = None
 
     src_volume = '/marina/src'
     dist_volume = '/marina/dist'
+    deps_volume = '/marina/deps'
+    # the slugs of the compile steps a step depends on are available in
+    # the compile container at <deps_volume>/<step>/
+    snapshot_context = '/marina/context'
+    # the context is copied out of the build folder when snapshotting such
+    # that it is part of the committed snapshots
 
     cache_volume = None
     cache_hostpath = None
     cache_path = None
     rebuild_cache = False
 
+    cache_max_size = None
+    # evict the least-recently-used entries from the cache after a
+    # successful build such that it remains within this many bytes
+
     archive_file = None
     archive_only = False
 
     extra_env = None
 
+    stage_mode = 'copy'
+    # how the build context is staged, see :func:`marina.utils.stage_tree`
+
+    stage_dir = None
+    # a persistent folder used to stage the context when stage_mode='sync'
+
     skip_cleanup = False
 
+    skip_unchanged = True
+    # reuse an existing image built from identical inputs
+
+    single_pass = False
+    # build the runner image using a single docker build with the slug
+    # as the build context instead of extracting it in a container and
+    # committing the result
+
+    # codecs that are supported by the docker ADD instruction
+    single_pass_codecs = ('gzip', 'pigz', 'none')
+
+    engine = None
+    # an optional :class:`marina.aio.AsyncEngine` used to attach to and
+    # wait for containers and to stream image builds
+
+    timeout = None
+    # the maximum number of seconds to wait on a container or image build,
+    # only supported by the asyncio engine
+
+    host_dist = False
+    # bind the dist volume to a folder in the build directory such that
+    # the slug may be read directly from the host
+
+    artifact_store = None
+    # an optional :class:`marina.artifacts.ArtifactStore` used to share
+    # slugs compiled from identical inputs, implies host_dist
+
+    container_pool = None
+    # an optional :class:`marina.pool.ContainerPool` of running compile
+    # containers into which the build script is exec'd, implies host_dist
+
+    pool_volume = '/marina/builds'
+    # the folder of the app within the build root, see _pool_root, is bound
+    # here in its pooled containers such that the build directory of each
+    # build is available at <pool_volume>/<name>/ while the folders of the
+    # other apps are not
+
+    digest_label = 'marina.build-digest'
+
+    snapshot_label = 'marina.snapshot'
+    # set to the repository of the snapshots committed by the builds, see
+    # _prune_snapshots
+
+    on_build_event = None
+    # an optional callback invoked with each decoded event of the image
+    # builds, see :class:`BuildOutput`
+
+    runner_files = None
+    # the files added to the context of a single-pass runner build when
+    # they are prepared once and shared by the run variants
+
     @staticmethod
     def stdout(msg):
         sys.stdout.write(msg)
@@ -255,48 +1241,321 @@ class DockerBuilder(object):
     def __init__(self, steps, connector):
         self.steps = steps
         self.connector = connector
+        self.puller = ImagePuller()
         self.source_container = None
-        self.runner_container = None
-        self.runner_base_image = None
+        self.runner_image = None
+        self.context_volume = None
+        self.runner_containers = []
+        self.runner_base_images = []
+        self.variant_builders = []
+        self.build_digest = None
+        self.artifact_key = None
+        self.archive_digest = None
+        self.image_digests = {}
+        self.dependencies = []
+        self.step_builders = []
+        self.pulls = {}
+        self.pulled = set()
+        self.metrics = BuildMetrics(steps.name, steps.version)
+        self.active_cache_volume = None
+        self.stale_cache_volumes = []
+        self.rotate_cache = False
+        self.cache_removal = None
+        self.pooled = False
 
     def run(self):
-        self._setup()
+        self.metrics = BuildMetrics(self.steps.name, self.steps.version)
+        client = self.client = self._acquire_client()
+        try:
+            with self.metrics.measure():
+                self._run()
+        finally:
+            self.client = None
+            self._release_client(client)
+
+    def _run(self):
+        self.image_digests = {}
+        self.variant_builders = []
+        with self.metrics.phase('digest'):
+            # the build digest only identifies the runner image
+            if not self.archive_only:
+                self.build_digest = self._compute_build_digest()
+            self.artifact_key = self._compute_artifact_key()
+        if self._reuse_existing_image():
+            self.metrics.reused = True
+            return
+
+        artifact = self._find_artifact()
+        self._start_pulls(
+            compile=artifact is None and not self.steps.multi_step)
+        lock = self._acquire_stage_lock()
         try:
+            with self.metrics.phase('setup') as phase:
+                self._setup()
+                if self.stage_stats is not None:
+                    phase.add_bytes(self.stage_stats.bytes)
+            try:
+                if self.steps.multi_step:
+                    self._compile_steps()
+                elif artifact is None or not self._fetch_artifact(artifact):
+                    self._compile()
+                if lock is not None:
+                    lock.release()
+                    lock = None
+                if self.archive_file:
+                    with self.metrics.phase('archive'):
+                        if not self._build_archive():
+                            raise RuntimeError('failed to build archive')
+                if self.archive_only:
+                    return
+                if not self._build_runner_images():
+                    raise RuntimeError('failed to build runner image')
+            finally:
+                with self.metrics.phase('teardown'):
+                    self._teardown()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _acquire_stage_lock(self):
+        """ Acquire the lock of the persistent folder into which the
+        context is synced, if any.
+
+        Concurrent builds of the same app, for example with another tag,
+        would otherwise replace the files of the context while the other
+        build compiles it. The lock is held until the compile is complete.
+
+        """
+        if self.stage_mode != 'sync' or self.steps.multi_step:
+            return None
+        path = self._sync_stage_dir()
+        lock = stage_lock(path)
+        if not lock.acquire(False):
+            log.info('waiting for another build staged into path=%s', path)
+            with self.metrics.phase('stage-wait'):
+                lock.acquire()
+        return lock
+
+    def _compile(self):
+        with self.metrics.phase('cache'):
             if not self._create_cache():
                 raise RuntimeError('failed to construct data cache')
+        self._wait_for_pull(self.steps.compiler.base_image)
+        with self.metrics.phase('compile'):
             if not self._build_source_container():
                 raise RuntimeError('failed to build source container')
-            if self.archive_file and not self._build_archive():
-                raise RuntimeError('failed to build archive')
-            if self.archive_only:
-                return
-            if not self._build_runner_image():
-                raise RuntimeError('failed to build runner image')
+        if self.artifact_key:
+            with self.metrics.phase('store'):
+                self._store_artifact()
+        if self.cache_max_size is not None:
+            with self.metrics.phase('cache-prune'):
+                self._prune_cache()
+        self._remove_stale_caches()
+
+    def _compile_steps(self):
+        """ Run each of the named compile steps in its own builder.
+
+        Each step starts as soon as the steps it depends on are complete
+        such that independent steps are compiled concurrently. The slugs
+        are collected in a folder per step within the dist folder.
+
+        """
+        builders = collections.OrderedDict(
+            (step.name, self._make_step_builder(step))
+            for step in self.steps.compilers
+        )
+        self.step_builders = list(builders.values())
+        futures = {}
+
+        def run(name):
+            builder = builders[name]
+            for dep in builder.steps.compiler.depends_on:
+                try:
+                    wait_for_future(futures[dep])
+                except Exception:
+                    raise RuntimeError(
+                        'skipped compile step "{0}" because step "{1}" '
+                        'failed'.format(name, dep))
+                dep_builder = builders[dep]
+                builder.dependencies.append((
+                    dep,
+                    os.path.dirname(dep_builder.archive_file),
+                    dep_builder.archive_digest,
+                ))
+            log.info('compiling step=%s', name)
+            try:
+                builder.run()
+            except Exception as ex:
+                raise RuntimeError('compile step "{0}" failed: {1}'.format(
+                    name, ex.args[0] if ex.args else ex))
+            finally:
+                builder.stdout.flush()
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(builders)) as pool:
+                for name in builders:
+                    futures[name] = pool.submit(run, name)
+                for name in builders:
+                    wait_for_future(futures[name])
         finally:
-            self._teardown()
+            for name, builder in builders.items():
+                for phase in builder.metrics.phases:
+                    phase.name = '{0}:{1}'.format(name, phase.name)
+                    self.metrics.phases.append(phase)
+
+    def _make_step_builder(self, step):
+        steps = self.steps.for_compile_step(step.name)
+        builder = DockerBuilder(steps, self.connector)
+        builder.stdout = LinePrefixer(self.stdout, '[{0}] '.format(step.name))
+        builder.puller = self.puller
+        builder.engine = self.engine
+        builder.timeout = self.timeout
+        builder.extra_env = self.extra_env
+        builder.skip_cleanup = self.skip_cleanup
+        builder.stage_mode = self.stage_mode
+        builder.stage_dir = os.path.join(self._sync_stage_dir(), step.name)
+        builder.artifact_store = self.artifact_store
+        builder.container_pool = self.container_pool
+        builder.cache_volume, builder.cache_hostpath = step_cache(
+            self.cache_volume, self.cache_hostpath, step.name)
+        builder.cache_path = self.cache_path
+        builder.rebuild_cache = self.rebuild_cache
+        builder.cache_max_size = self.cache_max_size
+        # the slug is moved into the dist folder of this build
+        builder.archive_only = True
+        builder.host_dist = True
+        builder.archive_file = os.path.join(
+            self.dist_dir, step.name,
+            '%s-%s%s' % (
+                steps.name, steps.version, step.compression.extension),
+        )
+        os.mkdir(os.path.dirname(builder.archive_file))
+        return builder
 
     def _setup(self):
-        self.build_dir = tempfile.mkdtemp(dir=self.steps.root_path)
+        self.pooled = self._can_use_container_pool()
+        build_root = self.steps.root_path
+        if self.pooled:
+            # only the folder of the app is bound into its warm containers
+            build_root = self._pool_root()
+            if not os.path.isdir(build_root):
+                os.makedirs(build_root)
+        self.build_dir = tempfile.mkdtemp(
+            prefix='.marina-build-', dir=build_root)
         log.debug('build directory=%s', self.build_dir)
 
-        self.steps.write_context(self.build_dir)
+        if self.pooled:
+            # the build directory is reached through the bound app folder
+            self.src_volume = posixpath.join(
+                self.pool_volume, os.path.basename(self.build_dir))
+            self.dist_volume = posixpath.join(self.src_volume, 'dist')
+
+        self.dist_dir = None
+        if (
+            self.artifact_store is not None or
+            self.steps.multi_step or
+            self.pooled or
+            self._has_file_groups()
+        ) and not self.host_dist:
+            log.debug('using a host-bound dist folder')
+            self.host_dist = True
+        if self.host_dist:
+            self.dist_dir = os.path.join(self.build_dir, 'dist')
+            os.mkdir(self.dist_dir)
+
+        if self.steps.multi_step:
+            # each compile step stages its own context
+            self.stage_stats = None
+            return
+
+        self.context_dir = os.path.join(self.build_dir, 'context')
+        self.context_volume = posixpath.join(self.src_volume, 'context')
+        if self.stage_mode == 'sync':
+            self.context_dir = self._sync_stage_dir()
+            # the mountpoint for the persistent context
+            os.mkdir(os.path.join(self.build_dir, 'context'))
+            if self.pooled:
+                # the pooled containers cannot bind it, it is reached
+                # through the bound app folder instead
+                self.context_volume = posixpath.join(
+                    self.pool_volume, *os.path.relpath(
+                        os.path.abspath(self.context_dir),
+                        os.path.abspath(self._pool_root()),
+                    ).split(os.sep))
+        self.stage_stats = stats = self.steps.write_context(
+            self.build_dir,
+            mode=self.stage_mode,
+            target=self.context_dir,
+        )
+        if stats is not None:
+            log.info('staged context %s', stats)
+            self.stdout('staged context %s\n' % stats)
+
         self.steps.write_identity_file(self.build_dir)
+        self.rotate_cache = self._can_rotate_cache()
         self.steps.write_build_script(
             self.build_dir,
-            rebuild_cache=self.rebuild_cache,
+            # local cache volumes are rotated instead, see _create_cache
+            rebuild_cache=self.rebuild_cache and not self.rotate_cache,
+            # the pooled containers are shared by later builds
+            cleanup_identity=self.pooled,
         )
 
-        self.client = self.connector()
+    def _sync_stage_dir(self):
+        if self.stage_dir:
+            return self.stage_dir
+        if self.container_pool is not None:
+            # within the folder bound into the warm containers
+            return os.path.join(self._pool_root(), 'stage')
+        return os.path.join(
+            self.steps.root_path, '.marina-stage', self.steps.name)
+
+    def _pool_root(self):
+        """ The folder of the app bound into its warm containers, which
+        contains its build directories.
+
+        """
+        return os.path.join(
+            self.steps.root_path, '.marina-pool', self.steps.name)
+
+    def _can_use_container_pool(self):
+        if self.container_pool is None or self.steps.multi_step:
+            return False
+        reason = None
+        if self.timeout is not None:
+            reason = 'the exec of the build script cannot be timed out'
+        elif self.dependencies:
+            reason = 'the compile step depends on other steps'
+        elif self.steps.compiler.snapshot:
+            reason = 'the compile container is snapshotted'
+        elif self.stage_mode == 'sync' and os.path.relpath(
+            os.path.abspath(self._sync_stage_dir()),
+            os.path.abspath(self._pool_root()),
+        ).startswith(os.pardir):
+            reason = 'the context is staged outside of the app pool folder'
+        if reason is not None:
+            log.info('not using a warm compile container as %s', reason)
+            return False
+        return True
+
+    def _acquire_client(self):
+        return acquire_client(self.connector)
+
+    def _release_client(self, client):
+        release_client(self.connector, client)
 
     def _teardown(self):
         if self.source_container and not self.skip_cleanup:
             self._remove_container(self.source_container)
 
-        if self.runner_container and not self.skip_cleanup:
-            self._remove_container(self.runner_container)
+        if not self.skip_cleanup:
+            for builder in [self] + self.variant_builders:
+                for container in builder.runner_containers:
+                    self._remove_container(container)
 
-        if self.runner_base_image and not self.skip_cleanup:
-            self._remove_image(self.runner_base_image)
+                # each image is the parent of the next
+                for image in reversed(builder.runner_base_images):
+                    self._remove_image(image)
 
         if not self.skip_cleanup:
             try:
@@ -306,6 +1565,241 @@ class DockerBuilder(object):
 
         self.client = None
 
+    def _compute_build_digest(self):
+        """ Compute a digest over every input that affects the runner image.
+
+        Returns ``None`` if any of the base images cannot be resolved.
+
+        """
+        h = hashlib.sha256()
+        self.steps.update_digest(h)
+        h.update(json.dumps(sorted(self._extra_env().items()))
+                 .encode('utf8'))
+        images = [step.base_image for step in self.steps.compilers]
+        images.extend(runner.base_image for runner in self.steps.runners)
+        for image in images:
+            image_digest = self._resolve_image_digest(image)
+            if image_digest is None:
+                log.info('could not resolve digest for image=%s', image)
+                return None
+            h.update(image_digest.encode('utf8'))
+        digest = h.hexdigest()
+        log.debug('build digest=%s', digest)
+        return digest
+
+    def _compute_artifact_key(self):
+        """ Compute a digest over every input that affects the slug.
+
+        Returns ``None`` if there is no artifact store or if the compile
+        image cannot be resolved.
+
+        """
+        if self.artifact_store is None or self.steps.multi_step:
+            return None
+        h = hashlib.sha256()
+        self.steps.update_compile_digest(h)
+        h.update(json.dumps(sorted(self._extra_env().items()))
+                 .encode('utf8'))
+        for name, _, digest in self.dependencies:
+            h.update(json.dumps([name, digest]).encode('utf8'))
+        image = self.steps.compiler.base_image
+        image_digest = self._resolve_image_digest(image)
+        if image_digest is None:
+            log.info('could not resolve digest for image=%s', image)
+            return None
+        h.update(image_digest.encode('utf8'))
+        key = h.hexdigest()
+        log.debug('artifact key=%s', key)
+        return key
+
+    def _resolve_image_digest(self, image):
+        # the digest of each image is resolved once per build
+        if image not in self.image_digests:
+            self.image_digests[image] = self._lookup_image_digest(image)
+        return self.image_digests[image]
+
+    def _lookup_image_digest(self, image):
+        # resolve the image that the pull policy will use for the build,
+        # the registry digest does not require a pull and the local image id
+        # supports unpublished images
+        def from_registry():
+            try:
+                info = self.client.inspect_distribution(image)
+                return info['Descriptor']['digest']
+            except docker.errors.APIError:
+                log.debug('failed to inspect distribution for image=%s',
+                          image, exc_info=True)
+
+        def from_local():
+            try:
+                return self.client.inspect_image(image)['Id']
+            except docker.errors.NotFound:
+                pass
+
+        if self.puller.policy == 'always':
+            resolvers = (from_registry, from_local)
+        elif self.puller.policy == 'missing':
+            resolvers = (from_local, from_registry)
+        else:
+            resolvers = (from_local,)
+        for resolver in resolvers:
+            image_digest = resolver()
+            if image_digest is not None:
+                return image_digest
+
+    def _start_pulls(self, compile=True):
+        # pull the base images concurrently while the build is prepared
+        self.pulls = {}
+        images = []
+        if compile:
+            images.append(self.steps.compiler.base_image)
+        if not self.archive_only:
+            images.extend(runner.base_image for runner in self.steps.runners)
+        for image in images:
+            self.pulls[image] = self.puller.start(self.connector, image)
+
+    def _wait_for_pull(self, image):
+        if image in self.pulled:
+            return
+        future = self.pulls.get(image)
+        if future is None:
+            future = self.pulls[image] = self.puller.start(
+                self.connector, image)
+        # only the time blocked on the pull delays the build
+        with self.metrics.phase('pull'):
+            wait_for_future(future)
+        self.pulled.add(image)
+
+    def _reuse_existing_image(self):
+        if (
+            not self.skip_unchanged or
+            not self.build_digest or
+            self.archive_file or
+            self.archive_only or
+            self.rebuild_cache
+        ):
+            return False
+
+        # the image of every variant must exist, the slug is compiled
+        # once for all of them otherwise
+        builders = [self]
+        if self.steps.run_variants:
+            builders = self._make_variant_builders()
+        images = []
+        for builder in builders:
+            image = builder._find_existing_image()
+            if image is None:
+                return False
+            images.append(image)
+
+        for builder, image in zip(builders, images):
+            builder.runner_image = image
+            self.client.tag(
+                image, builder._runner_repository(), tag=self.steps.version)
+            self.stdout('reused image=%s\n' % builder.runner_tag)
+        if builders[0] is not self:
+            self.variant_builders = builders
+            self.runner_image = images[0]
+        return True
+
+    def _find_existing_image(self):
+        images = self.client.images(
+            filters={'label': '{0}={1}'.format(
+                self.digest_label, self.build_digest)},
+            quiet=True,
+        )
+        if not images:
+            log.debug('no existing image found for digest=%s',
+                      self.build_digest)
+            return None
+        log.info('found existing image=%s for digest=%s',
+                 images[0], self.build_digest)
+        return images[0]
+
+    def _find_artifact(self):
+        # rebuilding the cache implies compiling from scratch
+        if not self.artifact_key or self.rebuild_cache:
+            return None
+        try:
+            artifact = self.artifact_store.get(self.artifact_key)
+        except Exception:
+            log.exception('failed to search artifact store=%s',
+                          self.artifact_store.path)
+            return None
+        if artifact is None:
+            log.debug('no artifact found for key=%s', self.artifact_key)
+            return None
+        if artifact.codec not in Compression.extensions:
+            log.warn('ignoring artifact key=%s with unknown codec=%s',
+                     artifact.key, artifact.codec)
+            return None
+        log.info('found artifact key=%s in store=%s',
+                 artifact.key, self.artifact_store.path)
+        return artifact
+
+    def _fetch_artifact(self, artifact):
+        """ Use a slug from the artifact store instead of compiling.
+
+        Returns ``False`` if the slug could not be fetched, for example if
+        it was evicted in the meantime, in which case the app is compiled.
+
+        """
+        self._init_archive()
+        path = self._dist_file(self.archive_name)
+        with self.metrics.phase('fetch'):
+            try:
+                digest = publish_file(artifact.path, path)
+            except OSError:
+                log.warn('failed to fetch artifact key=%s, compiling instead',
+                         artifact.key,
+                         exc_info=log.isEnabledFor(logging.DEBUG))
+                return False
+            self.metrics.record(num_bytes=artifact.size)
+        if artifact.sha256 is not None and digest != artifact.sha256:
+            log.warn('artifact key=%s is corrupt, expected sha256=%s but '
+                     'found sha256=%s, compiling instead',
+                     artifact.key, artifact.sha256, digest)
+            os.unlink(path)
+            return False
+        self.archive_codec = artifact.codec
+        self.stdout('reused slug from artifact store key=%s\n'
+                    % artifact.key[:12])
+        return True
+
+    def _store_artifact(self):
+        path = self._dist_file(self.archive_name)
+        try:
+            artifact = self.artifact_store.put(
+                self.artifact_key, path, self.archive_codec)
+        except Exception:
+            # the build itself succeeded
+            log.exception('failed to add artifact key=%s to store=%s',
+                          self.artifact_key, self.artifact_store.path)
+            return
+        self.metrics.record(num_bytes=artifact.size)
+
+    def _runner_repository(self):
+        if self.steps.runner.name is not None:
+            return '{0}-{1}'.format(self.steps.name, self.steps.runner.name)
+        return self.steps.name
+
+    @property
+    def runner_tag(self):
+        """ The tag of the runner image, or of the image of the run variant
+        built by this builder.
+
+        """
+        return '{0}:{1}'.format(self._runner_repository(), self.steps.version)
+
+    @property
+    def runner_images(self):
+        """ The id of each runner image built or reused, keyed by tag."""
+        return collections.OrderedDict(
+            (builder.runner_tag, builder.runner_image)
+            for builder in self.variant_builders or [self]
+            if builder.runner_image
+        )
+
     def _remove_container(self, container):
         try:
             self.client.stop(container)
@@ -323,89 +1817,558 @@ class DockerBuilder(object):
             log.exception('failed to remove image=%s', image)
 
     def _create_cache(self):
+        self.active_cache_volume = None
+        self.stale_cache_volumes = []
         if not self.cache_volume:
             log.info('no cache volume defined, skipping checks')
             return True
 
-        do_create_cache = False
-        try:
-            self.client.inspect_volume(self.cache_volume)
-        except docker.errors.NotFound:
-            do_create_cache = True
+        volumes = find_cache_volumes(self.client, self.cache_volume)
+        if self.rotate_cache:
+            # a fresh volume is much faster than deleting a large cache
+            generation = volumes[-1][0] + 1 if volumes else 0
+            log.debug('creating cache volume=%s generation=%s',
+                      self.cache_volume, generation)
+            self.active_cache_volume = create_cache_volume(
+                self.client, self.cache_volume, generation,
+                template=volumes[-1][1] if volumes else None,
+            )
+            self.stale_cache_volumes = [v for _, v in volumes]
+        elif volumes:
+            self.active_cache_volume = volumes[-1][1]
+            self.stale_cache_volumes = [v for _, v in volumes[:-1]]
+            log.info('found cache volume=%s', self.active_cache_volume)
+        else:
             log.debug('could not find cache volume=%s', self.cache_volume)
-
-        if do_create_cache:
             log.debug('creating cache volume=%s', self.cache_volume)
-            self.client.create_volume(self.cache_volume)
-        else:
-            log.info('found cache volume=%s', self.cache_volume)
+            self.active_cache_volume = create_cache_volume(
+                self.client, self.cache_volume)
         return True
 
+    def _can_rotate_cache(self):
+        """ Return ``True`` if ``--rebuild-cache`` creates a new generation
+        of the cache volume.
+
+        Only plain local volumes are rotated, the contents of a volume
+        created by the user using another driver or driver options are
+        deleted by the build script instead.
+
+        """
+        if not (self.rebuild_cache and self.cache_volume):
+            return False
+        volume = current_cache_volume(self.client, self.cache_volume)
+        if volume is None or is_rotatable_volume(self.client, volume):
+            return True
+        log.info('clearing cache volume=%s in place', volume)
+        return False
+
+    def _remove_stale_caches(self):
+        """ Remove old generations of the cache volume in the background.
+
+        The thread is not a daemon such that the removal completes before
+        the process exits, but it does not delay the build.
+
+        """
+        volumes = self.stale_cache_volumes
+        self.stale_cache_volumes = []
+        if not volumes:
+            return
+
+        if self.container_pool is not None:
+            # idle warm containers keep the old volumes in use
+            self.container_pool.discard(
+                self.client, lambda c: c.key.cache in volumes)
+
+        def remove():
+            client = self._acquire_client()
+            try:
+                remove_cache_volumes(client, volumes)
+            finally:
+                self._release_client(client)
+
+        log.info('removing old cache volumes=%s in the background',
+                 ', '.join(volumes))
+        th = threading.Thread(target=remove, name='marina-cache-remove')
+        th.start()
+        self.cache_removal = th
+
+    def _prune_cache(self):
+        if not (self.active_cache_volume or self.cache_hostpath):
+            return
+        cache = BuildCache(
+            self.client,
+            self.steps.compiler.base_image,
+            volume=self.active_cache_volume,
+            hostpath=self.cache_hostpath,
+        )
+        try:
+            evictions, remaining = cache.prune(self.cache_max_size)
+        except Exception:
+            # the cache is still usable, it is only larger than desired
+            log.exception('failed to prune cache=%s', cache.source)
+            return
+        for entry in evictions:
+            log.info('evicted entry=%s size=%s from cache=%s',
+                     entry.name, format_size(entry.size), cache.source)
+
     def _build_source_container(self):
         log.info('building source')
-        self.archive_name = '%s-%s.tar.gz' % (
-            self.steps.name, self.steps.version)
-        self.archive_path = posixpath.join(self.dist_volume, self.archive_name)
+        self._init_archive()
+
+        base_image = self.steps.compiler.base_image
+        self._wait_for_pull(base_image)
+
+        if self.steps.compiler.snapshot:
+            keys = self._compute_snapshot_keys()
+            if keys is not None:
+                return self._build_source_snapshots(keys)
+            log.warn('could not resolve digest for image=%s, compiling '
+                     'without snapshots', base_image)
+
+        if self.pooled:
+            return self._finish_source(self._exec_source_script(
+                base_image, 'build.sh', self._source_env()))
+
+        self.source_container, ret = self._run_source_script(
+            base_image, 'build.sh', self._source_env(),
+            volumes=[self.src_volume, self.dist_volume],
+        )
+        log.info('created source container=%s', self.source_container)
+        return self._finish_source(ret)
+
+    def _build_source_snapshots(self, keys):
+        """ Run each command in its own container, committing a snapshot
+        of the container after each command.
+
+        The commands before the newest existing snapshot are skipped and the
+        remaining commands run on top of it. The context is copied into the
+        container filesystem at :attr:`snapshot_context` by the first script
+        such that it is part of the snapshots.
+
+        """
+        commands = self.steps.compiler.commands
+        repository = self._snapshot_repository()
+        image = self.steps.compiler.base_image
+        start = 0
+        if not self.rebuild_cache:
+            for i in reversed(range(len(keys))):
+                snapshot = '{0}:{1}'.format(repository, keys[i])
+                if self._image_exists(snapshot):
+                    start, image = i + 1, snapshot
+                    break
+        if start:
+            log.info('resuming from snapshot=%s', image)
+            self.stdout('resuming from snapshot after command %d/%d\n' % (
+                start, len(commands)))
+
+        self.steps.write_snapshot_scripts(
+            self.build_dir,
+            start=start,
+            # local cache volumes are rotated instead, see _create_cache
+            rebuild_cache=self.rebuild_cache and not self.rotate_cache,
+        )
+        env = self._source_env()
+        env['BUILD_CONTEXT'] = self.snapshot_context
+        conf = self._snapshot_config(env)
+
+        for i in range(start, len(commands)):
+            self.stdout('running command %d/%d\n' % (i + 1, len(commands)))
+            with self.metrics.phase('command'):
+                container, ret = self._run_source_script(
+                    image, 'command-{0}.sh'.format(i), env,
+                    volumes=[self.src_volume],
+                )
+            if ret != 0:
+                # keep the failed container around for teardown
+                self.source_container = container
+                log.error('command %d/%d did not run successfully, '
+                          'status=%s', i + 1, len(commands), ret)
+                return False
+            with self.metrics.phase('snapshot'):
+                self.client.commit(container, repository=repository,
+                                   tag=keys[i], conf=conf)
+            image = '{0}:{1}'.format(repository, keys[i])
+            log.debug('committed command %d/%d to snapshot=%s',
+                      i + 1, len(commands), image)
+            if not self.skip_cleanup:
+                self._remove_container(container)
+
+        self.source_container, ret = self._run_source_script(
+            image, 'archive.sh', env,
+            volumes=[self.src_volume, self.dist_volume],
+        )
+        log.info('created source container=%s', self.source_container)
+        if ret == 0:
+            self._prune_snapshots(repository, keys)
+        return self._finish_source(ret)
+
+    def _snapshot_config(self, env):
+        """ The configuration committed with each snapshot.
+
+        The daemon merges the configuration of the container into the
+        committed one, so the variables set by the build are committed
+        without a value such that secrets passed using ``--env`` are not
+        part of the snapshots. The variables of the compile image keep
+        their value.
+
+        """
+        image_info = self.client.inspect_image(self.steps.compiler.base_image)
+        base_env = image_info['Config'].get('Env') or []
+        names = set(entry.split('=', 1)[0] for entry in base_env)
+        return {
+            'Env': base_env + [
+                '{0}='.format(name)
+                for name in sorted(env) if name not in names
+            ],
+            'Labels': {self.snapshot_label: self._snapshot_repository()},
+        }
+
+    def _prune_snapshots(self, repository, keys):
+        """ Remove the oldest snapshots of the step such that at most
+        ``max_snapshots`` are kept. The snapshots of this build are kept.
 
+        """
+        limit = self.steps.compiler.max_snapshots
+        try:
+            images = self.client.images(filters={'label': '{0}={1}'.format(
+                self.snapshot_label, repository)})
+        except Exception:
+            log.exception('failed to list the snapshots of %s', repository)
+            return
+        current = set('{0}:{1}'.format(repository, key) for key in keys)
+        tags = [
+            tag
+            for image in sorted(
+                images, key=lambda image: image['Created'], reverse=True)
+            for tag in image['RepoTags'] or []
+            if tag.startswith(repository + ':')
+        ]
+        kept = len(current)
+        for tag in tags:
+            if tag in current:
+                continue
+            if kept < limit:
+                kept += 1
+                continue
+            log.debug('removing snapshot=%s', tag)
+            self._remove_image(tag)
+
+    def _compute_snapshot_keys(self):
+        """ Compute the key of the snapshot taken after each command.
+
+        Each key covers the previous key, the command and the files of the
+        context declared as its ``inputs``, or the entire context if it
+        does not declare any. Returns ``None`` if the compile image cannot
+        be resolved.
+
+        """
+        image = self.steps.compiler.base_image
+        image_digest = self._resolve_image_digest(image)
+        if image_digest is None:
+            return None
+
+        # the version changes on every build and must not affect the keys
+        env = self._source_env()
+        env.pop('BUILD_VERSION')
+        env.pop('BUILD_ARCHIVE_PATH')
+        h = hashlib.sha256()
+        h.update(json.dumps([
+            self.steps.name,
+            self.steps.compiler.name,
+            image_digest,
+            sorted(env.items()),
+            [[name, digest] for name, _, digest in self.dependencies],
+        ]).encode('utf8'))
+        key = h.hexdigest()
+
+        context_digest = None
+        keys = []
+        compiler = self.steps.compiler
+        for command, inputs in zip(compiler.commands, compiler.command_inputs):
+            h = hashlib.sha256(key.encode('utf8'))
+            h.update(command.encode('utf8'))
+            if inputs is None:
+                if context_digest is None:
+                    context_digest = hash_tree(self.context_dir).hexdigest()
+                h.update(context_digest.encode('utf8'))
+            else:
+                h.update(json.dumps(inputs).encode('utf8'))
+                h.update(hash_tree(
+                    self.context_dir, ignore=select_paths(inputs),
+                ).hexdigest().encode('utf8'))
+            key = h.hexdigest()
+            keys.append(key)
+        log.debug('snapshot keys=%s', keys)
+        return keys
+
+    def _snapshot_repository(self):
+        name = self.steps.name
+        if self.steps.compiler.name:
+            name = '{0}-{1}'.format(name, self.steps.compiler.name)
+        return '{0}__snapshot'.format(name.lower())
+
+    def _image_exists(self, image):
+        try:
+            self.client.inspect_image(image)
+        except docker.errors.NotFound:
+            return False
+        return True
+
+    def _source_env(self):
         env = {
             'BUILD_ROOT': self.src_volume,
-            'BUILD_CONTEXT': posixpath.join(self.src_volume, 'context'),
+            'BUILD_CONTEXT': self.context_volume,
             'BUILD_ARCHIVE_PATH': self.archive_path,
             'BUILD_NAME': self.steps.name,
             'BUILD_VERSION': self.steps.version,
             'BUILD_CACHE': self.cache_path,
         }
-        if self.extra_env:
-            env.update(self.extra_env)
-        for k in sorted(env.keys()):
-            log.debug('builder env %s = %s', k, env[k])
+        if self.steps.compiler.name:
+            env['BUILD_STEP'] = self.steps.compiler.name
+        if self.dependencies:
+            env['BUILD_DEPS'] = self.deps_volume
+        env.update(self._extra_env())
+        return env
+
+    def _extra_env(self):
+        """ The ``--env`` variables along with ``SOURCE_DATE_EPOCH``, which
+        is forwarded from the environment to reproducible compile steps.
 
+        """
+        env = dict(self.extra_env or {})
+        if 'SOURCE_DATE_EPOCH' in os.environ and any(
+            step.reproducible for step in self.steps.compilers
+        ):
+            env.setdefault(
+                'SOURCE_DATE_EPOCH', os.environ['SOURCE_DATE_EPOCH'])
+        return env
+
+    def _source_binds(self):
         binds = {}
         binds[self.build_dir] = {
             'bind': self.src_volume,
             'rw': True,
         }
-        cache_volume = self.cache_volume or self.cache_hostpath
+        if self.context_dir != os.path.join(self.build_dir, 'context'):
+            binds[self.context_dir] = {
+                'bind': posixpath.join(self.src_volume, 'context'),
+                'rw': True,
+            }
+        if self.host_dist:
+            binds[self.dist_dir] = {
+                'bind': self.dist_volume,
+                'rw': True,
+            }
+        cache_volume = self.active_cache_volume or self.cache_hostpath
         if cache_volume:
             binds[cache_volume] = {
                 'bind': self.cache_path,
                 'rw': True,
             }
+        for name, path, _ in self.dependencies:
+            binds[path] = {
+                'bind': posixpath.join(self.deps_volume, name),
+                'ro': True,
+            }
+        return binds
 
-        base_image = self.steps.compiler.base_image
-        log.info('pulling image=%s', base_image)
-        self.client.pull(base_image)
+    def _run_source_script(self, image, script, env, volumes):
+        """ Run ``script`` from the build folder in a new container.
 
-        host_config = self.client.create_host_config(binds=binds)
+        Returns the id of the container and its exit status.
+
+        """
+        for k in sorted(env.keys()):
+            log.debug('builder env %s = %s', k, env[k])
+
+        host_config = self.client.create_host_config(
+            binds=self._source_binds())
 
         container = self.client.create_container(
-            base_image,
-            command='/bin/bash build.sh',
+            image,
+            command='/bin/bash {0}'.format(script),
             working_dir=self.src_volume,
             environment=env,
-            volumes=[
-                self.src_volume,
-                self.dist_volume,
-            ],
+            volumes=volumes,
             user='root',
             host_config=host_config,
         )
-        self.source_container = container.get('Id')
-        log.info('created source container=%s', self.source_container)
+        container = container.get('Id')
+
+        with self._attach(container):
+            log.debug('starting container=%s', container)
+            self.client.start(container)
+            log.debug('started container=%s', container)
+            ret = self._wait(container)
+        self.metrics.record(status=ret)
+        return container, ret
+
+    def _exec_source_script(self, image, script, env):
+        """ Exec ``script`` from the build folder in a warm container leased
+        from the :attr:`container_pool`.
+
+        The container is discarded if the script fails as it may have been
+        left in a bad state. Returns the exit status of the script.
+
+        """
+        for k in sorted(env.keys()):
+            log.debug('builder env %s = %s', k, env[k])
+
+        key = self._pool_key(image)
+        container = self.container_pool.acquire(
+            self.client, key, lambda client: self._create_pool_container(
+                client, key))
+        ret = None
+        try:
+            exec_id = self.client.exec_create(
+                container.id,
+                ['/bin/bash', script],
+                environment=env,
+                workdir=self.src_volume,
+                user='root',
+            ).get('Id')
+            log.debug('exec script=%s in warm container=%s',
+                      script, container.id)
+            num_bytes = 0
+            for chunk in self.client.exec_start(exec_id, stream=True):
+                num_bytes += len(chunk)
+                self.stdout(chunk.decode('utf8'))
+            ret = self.client.exec_inspect(exec_id).get('ExitCode')
+            log.debug('read %d bytes from exec=%s', num_bytes, exec_id)
+            phase = self.metrics.current
+            if phase is not None:
+                phase.add_bytes(num_bytes)
+        finally:
+            self.container_pool.release(
+                self.client, container, discard=ret != 0)
+        self.metrics.record(status=ret)
+        return ret
+
+    def _pool_key(self, image):
+        cache_volume = self.active_cache_volume or self.cache_hostpath
+        return PoolKey(
+            self.steps.name,
+            self.steps.compiler.name,
+            image,
+            os.path.abspath(self._pool_root()),
+            cache_volume,
+            self.cache_path,
+        )
 
-        with self._attach(self.source_container):
-            log.debug('starting container=%s', self.source_container)
-            self.client.start(self.source_container)
-            log.debug('started container=%s', self.source_container)
-            ret = self._wait(self.source_container)
+    def _create_pool_container(self, client, key):
+        binds = {
+            key.root: {
+                'bind': self.pool_volume,
+                'rw': True,
+            },
+        }
+        if key.cache:
+            binds[key.cache] = {
+                'bind': key.cache_path,
+                'rw': True,
+            }
+        host_config = client.create_host_config(binds=binds)
+        # the container idles until it is removed by the pool
+        container = client.create_container(
+            key.image,
+            entrypoint=['tail'],
+            command=['-f', '/dev/null'],
+            user='root',
+            labels={self.container_pool.label: key.app},
+            host_config=host_config,
+        )
+        container = container.get('Id')
+        client.start(container)
+        return container
+
+    def _finish_source(self, ret):
         if ret != 0:
             log.error('source did not build successfully, status=%s', ret)
-        else:
-            log.info('source compiled successfully')
-        return ret == 0
+            return False
+        log.info('source compiled successfully')
+        self.archive_codec = self._read_archive_codec()
+        return True
+
+    def _init_archive(self):
+        compression = self.steps.compiler.compression
+        self.archive_name = '%s-%s%s' % (
+            self.steps.name, self.steps.version, compression.extension)
+        self.archive_codec = compression.codec
+        self.archive_path = posixpath.join(self.dist_volume, self.archive_name)
+
+    def _read_archive_codec(self):
+        compression = self.steps.compiler.compression
+        try:
+            if self.host_dist:
+                with io.open(
+                    self._dist_file(self.archive_name + '.codec'), 'rb',
+                ) as fp:
+                    codec = fp.read()
+            else:
+                codec = self._read_container_file(
+                    self.source_container, self.archive_path + '.codec',
+                )
+            codec = codec.decode('utf8').strip()
+        except Exception:
+            log.debug('failed to read the archive codec', exc_info=True)
+            codec = None
+        if codec not in compression.extensions:
+            log.warn('could not determine the archive codec, assuming '
+                     'codec=%s', compression.codec)
+            return compression.codec
+        if codec != compression.codec:
+            log.warn('archive was compressed using codec=%s instead of '
+                     'codec=%s', codec, compression.codec)
+        return codec
+
+    def _update_archive_extension(self):
+        """ Rename the archive file after the compile step fell back to
+        another codec such that its extension matches the contents.
+
+        """
+        compression = self.steps.compiler.compression
+        extension = compression.extensions[self.archive_codec]
+        if extension == compression.extension:
+            return
+        if not self.archive_file.endswith(compression.extension):
+            log.warn('archive file=%s is compressed using codec=%s',
+                     self.archive_file, self.archive_codec)
+            return
+        archive_file = self.archive_file[:-len(compression.extension)]
+        archive_file += extension
+        log.warn('writing archive to file=%s instead of file=%s as it is '
+                 'compressed using codec=%s',
+                 archive_file, self.archive_file, self.archive_codec)
+        self.archive_file = archive_file
+
+    def _read_container_file(self, container, path):
+        stream, _ = self.client.get_archive(container, path)
+        fp = io.BytesIO(b''.join(stream))
+        with tarfile.open(fileobj=fp) as tf:
+            member = tf.next()
+            return tf.extractfile(member).read()
 
     def _build_archive(self):
         log.info('archiving build products')
+        self._update_archive_extension()
+
+        if self.host_dist:
+            # the build container is done with the slug when archive_only
+            # the slug may be linked into the artifact store so the archive
+            # must not share its inode
+            digest = publish_file(
+                self._dist_file(self.archive_name),
+                self.archive_file,
+                move=self.archive_only,
+                link=False,
+            )
+            self.archive_digest = digest
+            write_checksum_file(self.archive_file, digest)
+            log.info('archive written to file=%s sha256=%s',
+                     self.archive_file, digest)
+            self.metrics.record(
+                num_bytes=os.path.getsize(self.archive_file))
+            return True
 
         # docker api 1.20 introduces the archive concept but it returns a
         # tarball containing a single file. This requires a double copy to
@@ -423,11 +2386,16 @@ class DockerBuilder(object):
         )
         self.archive_container = container.get('Id')
 
+        h = hashlib.sha256()
         try:
             with io.open(self.archive_file, 'wb') as fp:
+                def write(chunk):
+                    h.update(chunk)
+                    fp.write(chunk)
+
                 with self._attach(
                     self.archive_container,
-                    stdout=fp.write,
+                    stdout=write,
                     encoding=None,
                 ):
                     log.debug('starting container=%s', self.archive_container)
@@ -436,88 +2404,458 @@ class DockerBuilder(object):
                     ret = self._wait(self.archive_container)
         finally:
             self._remove_container(self.archive_container)
+        self.metrics.record(status=ret)
 
         if ret:
             log.error('failed to write archive to file, status=%s', ret)
             os.unlink(self.archive_file)
         else:
-            log.info('archive written to file=%s', self.archive_file)
+            self.archive_digest = h.hexdigest()
+            write_checksum_file(self.archive_file, h.hexdigest())
+            log.info('archive written to file=%s sha256=%s',
+                     self.archive_file, h.hexdigest())
         return ret == 0
 
+    def _dist_file(self, name):
+        """ The path on the host to a file in the host-bound dist volume."""
+        return os.path.join(self.dist_dir, name)
+
+    def _build_runner_images(self):
+        """ Build the runner image, or the image of each run variant.
+
+        The variants are built concurrently from the same slug, each by a
+        copy of this builder whose steps only contain the variant.
+
+        """
+        if not self.steps.run_variants:
+            self._wait_for_pull(self.steps.runner.base_image)
+            return self._build_runner_image()
+
+        builders = self.variant_builders = self._make_variant_builders()
+        if self._wants_single_pass() and self._can_build_single_pass():
+            # the slug is split into layers once for every variant
+            files = self._runner_context_files()
+            for builder in builders:
+                builder.runner_files = files
+
+        def run(builder):
+            client = builder.client = self._acquire_client()
+            try:
+                builder._wait_for_pull(builder.steps.runner.base_image)
+                return builder._build_runner_image()
+            finally:
+                builder.client = None
+                self._release_client(client)
+                builder.stdout.flush()
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(builders)) as pool:
+                futures = [pool.submit(run, builder) for builder in builders]
+                results = [wait_for_future(future) for future in futures]
+        finally:
+            for builder in builders:
+                for phase in builder.metrics.phases:
+                    phase.name = '{0}:{1}'.format(
+                        builder.steps.runner.name, phase.name)
+                    self.metrics.phases.append(phase)
+        self.runner_image = builders[0].runner_image
+        return all(results)
+
+    def _make_variant_builders(self):
+        builders = []
+        for name in self.steps.run_variants:
+            builder = copy.copy(self)
+            builder.steps = self.steps.for_run_variant(name)
+            builder.stdout = LinePrefixer(self.stdout, '[{0}] '.format(name))
+            builder.metrics = BuildMetrics(
+                self.steps.name, self.steps.version)
+            builder.runner_image = None
+            builder.runner_containers = []
+            builder.runner_base_images = []
+            builder.variant_builders = []
+            # each variant is labeled with its own digest such that it is
+            # reused independently of the other variants
+            if self.build_digest:
+                builder.build_digest = hashlib.sha256(
+                    '{0}:{1}'.format(self.build_digest, name).encode('utf8')
+                ).hexdigest()
+            builders.append(builder)
+        return builders
+
+    def _has_file_groups(self):
+        return any(len(step.file_groups) > 1 for step in self.steps.compilers)
+
+    def _wants_single_pass(self):
+        """ Return ``True`` if the runner image should be built using the
+        ADD instruction.
+
+        Grouped files imply the single-pass build because only the layers
+        split on the host are identical for unchanged groups.
+
+        """
+        return self.single_pass or self._has_file_groups()
+
+    def _can_build_single_pass(self):
+        layers = self._runner_layers()
+        codecs = set(layer.codec for layer in layers)
+        unsupported = codecs.difference(self.single_pass_codecs)
+        if unsupported:
+            log.warn('the docker ADD instruction cannot extract an '
+                     'archive compressed with codec=%s, falling back to '
+                     'the two-pass runner build',
+                     ', '.join(sorted(unsupported)))
+            return False
+        if not self.host_dist and any(
+            layer.paths is not None for layer in layers
+        ):
+            log.warn('splitting the slug into layers in a single pass '
+                     'requires --host-dist, falling back to the two-pass '
+                     'runner build')
+            return False
+        return True
+
     def _build_runner_image(self):
         log.info('building runner image')
 
+        if self._wants_single_pass() and (
+            self.runner_files is not None or self._can_build_single_pass()
+        ):
+            return self._build_runner_image_single_pass()
+
         # we cannot mount the slug into the new image using something like:
         #     docker build --volumes-from <builder_container>
         # so instead we inject the slug via:
         #     docker run --volumes-from <builder_container> \
         #     <runner_base_image> tar xzf <archive_file> -C /"
-        if not self._build_runner_container():
-            return False
-
-        # commit the runner container as the new base image
-        image = self.client.commit(self.runner_container)
-        self.runner_base_image = image.get('Id')
-        log.debug('committed runner to image=%s', self.runner_base_image)
+        # each layer is extracted from the image committed for the previous
+        # layer. A committed layer records the time of the commit and the
+        # changes to the container, so it is never byte-identical to the
+        # layer of a previous build
+        layers = self._runner_layers()
+        if any(layer.paths is not None for layer in layers):
+            log.warn('the grouped files are installed as layers which '
+                     'change on every build because the runner image '
+                     'cannot be built in a single pass')
+        elif len(layers) > 1 and any(
+            step.reproducible for step in self.steps.compilers
+        ):
+            log.warn('the layers of the runner image are only reproducible '
+                     'when built using --single-pass')
+        base_image = self.steps.runner.base_image
+        self._wait_for_pull(base_image)
+        image = base_image
+        tarballs = {}
+        for layer in layers:
+            if layer.slug in tarballs:
+                layer = layer._replace(slug=tarballs[layer.slug], codec='none')
+            with self.metrics.phase('extract'):
+                container = self._build_runner_container(image, layer)
+                if container is None and layer.codec not in ('gzip', 'none'):
+                    # the runner image may not contain the codec
+                    log.warn('extracting the slug compressed with codec=%s '
+                             'failed, decompressing it using the compile '
+                             'image', layer.codec)
+                    tarball = self._decompress_slug(layer.slug, layer.codec)
+                    if tarball is None:
+                        log.error('either the runner image or the compile '
+                                  'image must contain %s in order to '
+                                  'extract the slug', layer.codec)
+                        return False
+                    tarballs[layer.slug] = tarball
+                    layer = layer._replace(slug=tarball, codec='none')
+                    container = self._build_runner_container(image, layer)
+                if container is None:
+                    return False
+
+            # commit the runner container as the new base image
+            with self.metrics.phase('commit'):
+                image = self.client.commit(container).get('Id')
+            self.runner_base_images.append(image)
+            log.debug('committed runner layer=%s to image=%s',
+                      layer.name, image)
 
         # configure the desired image metadata for the runner
-        base_image_info = self.client.inspect_image(
-            self.steps.runner.base_image,
-        )
+        base_image_info = self.client.inspect_image(base_image)
         runner_conf = self._get_runner_config(
             base_image_info,
             self.steps.runner.override_config,
         )
 
-        buildfile = self._render_buildfile(self.runner_base_image, runner_conf)
+        buildfile = self._render_buildfile(image, runner_conf)
         log.debug('buildfile: %r', buildfile)
 
-        runner_tag = '{0}:{1}'.format(self.steps.name, self.steps.version)
+        runner_tag = self.runner_tag
+        labels = {}
+        if self.build_digest:
+            labels[self.digest_label] = self.build_digest
         self.runner_image, _ = self._build_image(
             fileobj=io.BytesIO(buildfile.encode('utf-8')),
             tag=runner_tag,
+            labels=labels,
         )
 
         if not self.runner_image:
             log.error('failed to build runner image')
             return False
 
-        # we do not want to delete the base image, it's part of a chain
-        self.runner_base_image = None
+        # we do not want to delete the base images, they're part of a chain
+        self.runner_base_images = []
 
         log.info('runner compiled successfully to image=%s', self.runner_image)
         self.stdout('created image=%s\n' % runner_tag)
         return True
 
-    def _build_runner_container(self):
+    def _build_runner_image_single_pass(self):
+        # stream the archive out of the builder container and into the
+        # build context where the ADD instruction will extract it
         base_image = self.steps.runner.base_image
+        self._wait_for_pull(base_image)
 
-        log.info('pulling image=%s', base_image)
-        self.client.pull(base_image)
+        base_image_info = self.client.inspect_image(base_image)
+        runner_conf = self._get_runner_config(
+            base_image_info,
+            self.steps.runner.override_config,
+        )
 
-        host_config = self.client.create_host_config(
-            volumes_from=self.source_container,
+        files = self.runner_files
+        if files is None:
+            files = self._runner_context_files()
+        buildfile = self._render_buildfile(
+            base_image, runner_conf,
+            slugs=[arcname for arcname, _ in files],
+        )
+        log.debug('buildfile: %r', buildfile)
+
+        runner_tag = self.runner_tag
+        labels = {}
+        if self.build_digest:
+            labels[self.digest_label] = self.build_digest
+        self.runner_image, _ = self._build_image(
+            fileobj=self._iter_runner_context(buildfile, files),
+            custom_context=True,
+            tag=runner_tag,
+            labels=labels,
         )
 
+        if not self.runner_image:
+            log.error('failed to build runner image')
+            return False
+
+        log.info('runner compiled successfully to image=%s', self.runner_image)
+        self.stdout('created image=%s\n' % runner_tag)
+        return True
+
+    def _runner_slugs(self):
+        """ The slugs to install into the runner image, in order.
+
+        Returns a list of ``(name, codec, step)`` tuples where each name is
+        the path of the slug relative to the dist folder and the step is
+        the :class:`BuildSteps.CompileStep` which produced it.
+
+        """
+        if self.step_builders:
+            return [
+                (
+                    posixpath.join(
+                        b.steps.compiler.name,
+                        os.path.basename(b.archive_file)),
+                    b.archive_codec,
+                    b.steps.compiler,
+                )
+                for b in self.step_builders
+            ]
+        return [(self.archive_name, self.archive_codec, self.steps.compiler)]
+
+    def _runner_layers(self):
+        """ The layers of the runner image, in order.
+
+        Each slug is a single layer unless the files of its compile step
+        are split into groups, in which case each group is a layer
+        containing the ``paths`` of the group within the slug.
+
+        """
+        layers = []
+        for slug, codec, step in self._runner_slugs():
+            groups = step.file_groups
+            if len(groups) == 1:
+                name = step.name or groups[0][0] or slug
+                layers.append(RunnerLayer(name, slug, codec, None))
+                continue
+            for group, patterns in groups:
+                name = '/'.join(n for n in (step.name, group) if n)
+                paths = [
+                    posixpath.normpath(pattern).lstrip('/')
+                    for pattern in patterns
+                ]
+                layers.append(RunnerLayer(name, slug, codec, paths))
+        return layers
+
+    def _runner_context_files(self):
+        """ The files to add to the context of the single-pass runner build.
+
+        Returns a list of ``(arcname, path)`` tuples. Slugs split into
+        several layers are split on the host into an uncompressed tarball
+        per layer. The path is ``None`` if the slug must be streamed out of
+        the source container instead.
+
+        """
+        if not self.host_dist:
+            return [(self.archive_name, None)]
+
+        files = []
+        splits = collections.OrderedDict()
+        for i, layer in enumerate(self._runner_layers()):
+            if layer.paths is None:
+                files.append((layer.slug, self._dist_file(layer.slug)))
+                continue
+            arcname = posixpath.join('layers', 'layer-{0}.tar'.format(i))
+            path = os.path.join(self.build_dir, 'layers', os.path.basename(
+                arcname))
+            splits.setdefault(layer.slug, []).append((path, layer.paths))
+            files.append((arcname, path))
+
+        if splits:
+            os.mkdir(os.path.join(self.build_dir, 'layers'))
+            with self.metrics.phase('split'):
+                for slug, groups in splits.items():
+                    counts = split_tarball(self._dist_file(slug), groups)
+                    log.debug('split slug=%s into layers with %s members',
+                              slug, counts)
+        return files
+
+    def _iter_runner_context(self, buildfile, files):
+        """ Generate a tarball containing the Dockerfile and the slugs.
+
+        The archive api returns a tarball containing only the slug so it is
+        streamed as-is after a Dockerfile entry.
+
+        """
+        data = buildfile.encode('utf-8')
+        info = tarfile.TarInfo('Dockerfile')
+        info.size = len(data)
+        info.mtime = time.time()
+        yield info.tobuf()
+        yield data + tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE)
+
+        if self.host_dist:
+            stream = self._iter_host_files(files)
+        else:
+            stream, _ = self.client.get_archive(
+                self.source_container, self.archive_path)
+
+        num_bytes = 0
+        for chunk in stream:
+            num_bytes += len(chunk)
+            yield chunk
+        log.debug('streamed %d bytes of slugs', num_bytes)
+
+    def _iter_host_files(self, files, chunk_size=1024 * 1024):
+        # the remainder of a tarball containing only the given files
+        for arcname, path in files:
+            info = tarfile.TarInfo(arcname)
+            info.size = os.path.getsize(path)
+            info.mtime = os.path.getmtime(path)
+            yield info.tobuf()
+            with io.open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), b''):
+                    yield chunk
+            yield tarfile.NUL * (-info.size % tarfile.BLOCKSIZE)
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+    def _build_runner_container(self, image, layer):
+        """ Extract a layer into a new container created from ``image``.
+
+        Returns the id of the container or ``None`` if it failed.
+
+        """
+        if self.host_dist:
+            # the source container does not exist if the slug was fetched
+            # from the artifact store
+            host_config = self.client.create_host_config(binds={
+                self.dist_dir: {'bind': self.dist_volume, 'ro': True},
+            })
+        else:
+            host_config = self.client.create_host_config(
+                volumes_from=self.source_container,
+            )
+
+        compression = self.steps.compiler.compression
+        command = compression.extract_args(
+            posixpath.join(self.dist_volume, layer.slug), codec=layer.codec)
+        if layer.paths is not None:
+            command += layer.paths
+
         container = self.client.create_container(
-            base_image,
+            image,
             entrypoint='tar',
-            command='xzf "%s" -C /' % self.archive_path,
+            command=command,
             user='root',
             host_config=host_config,
         )
-        self.runner_container = container.get('Id')
+        container = container.get('Id')
+        self.runner_containers.append(container)
+
+        with self._attach(container):
+            log.debug('starting container=%s', container)
+            self.client.start(container)
+            log.debug('started container=%s', container)
+            ret = self._wait(container)
+        self.metrics.record(status=ret)
+        if ret:
+            log.error('failed to install layer=%s into runner, status=%s',
+                      layer.name, ret)
+            return None
+        log.debug('layer=%s installed into runner container', layer.name)
+        return container
 
-        with self._attach(self.runner_container):
-            log.debug('starting container=%s', self.runner_container)
-            self.client.start(self.runner_container)
-            log.debug('started container=%s', self.runner_container)
-            ret = self._wait(self.runner_container)
+    def _decompress_slug(self, slug, codec):
+        """ Decompress a slug into a tarball next to it using the image of
+        the compile step which produced it.
+
+        This is used when the runner image does not contain the codec.
+        Returns the name of the tarball or ``None`` if it failed.
+
+        """
+        image = self.steps.compiler.base_image
+        for name, _, step in self._runner_slugs():
+            if name == slug:
+                image = step.base_image
+        tarball = posixpath.splitext(slug)[0]
+        if not tarball.endswith('.tar'):
+            tarball += '.tar'
+        if self.host_dist:
+            host_config = self.client.create_host_config(binds={
+                self.dist_dir: {'bind': self.dist_volume, 'ro': False},
+            })
+        else:
+            host_config = self.client.create_host_config(
+                volumes_from=self.source_container,
+            )
+
+        container = self.client.create_container(
+            image,
+            entrypoint='/bin/sh',
+            command=[
+                '-c', '{0} -dc "$1" > "$2"'.format(codec), 'sh',
+                posixpath.join(self.dist_volume, slug),
+                posixpath.join(self.dist_volume, tarball),
+            ],
+            user='root',
+            host_config=host_config,
+        )
+        container = container.get('Id')
+        self.runner_containers.append(container)
+
+        with self._attach(container):
+            self.client.start(container)
+            ret = self._wait(container)
+        self.metrics.record(status=ret)
         if ret:
-            log.error('failed to install slug into runner, status=%s', ret)
-            return False
-        log.debug('slug installed into runner container')
-        return True
+            log.error('failed to decompress slug=%s using image=%s, '
+                      'status=%s', slug, image, ret)
+            return None
+        log.debug('decompressed slug=%s to %s', slug, tarball)
+        return tarball
 
     def _get_runner_config(self, base_image_info, overrides):
         conf = overrides.copy()
@@ -547,12 +2885,18 @@ class DockerBuilder(object):
 
         return conf
 
-    def _render_buildfile(self, base_image, conf):
+    def _render_buildfile(self, base_image, conf, slugs=()):
         """ Convert an image metadata into a file-like object that can be used
         as a Dockerfile in a build context.
 
+        Each of the ``slugs`` is a tarball in the build context which will be
+        extracted into the root of the image.
+
         """
-        opts = ['FROM {0}'.format(self.runner_base_image)]
+        opts = ['FROM {0}'.format(base_image)]
+
+        for slug in slugs:
+            opts.append('ADD {0} /'.format(slug))
 
         author = conf.get('Author')
         if author:  # avoid an invalid maintainer
@@ -599,28 +2943,50 @@ class DockerBuilder(object):
         """ Thin wrapper around :meth:`docker.Client.build` that can stream
         the build output.
 
-        """
-        stream = io.StringIO()
-        for chunk in self.client.build(rm=True, decode=True, **kw):
-            if 'error' in chunk:
-                raise Exception(
-                    'error while building image: {0}'.format(chunk['error']),
-                    chunk, stream.getvalue(),
-                )
-            elif 'stream' in chunk:
-                msg = chunk['stream']
-                self.stdout(msg)
-                stream.write(msg)
+        Returns the id of the image and the most recent output.
 
-        output = stream.getvalue()
-
-        srch = r'Successfully built ([0-9a-f]+)'
-        match = re.search(srch, output)
-        if not match:
-            return None, output
-        return match.group(1), output
+        """
+        with self.metrics.phase('image') as phase:
+            kw['fileobj'] = self._count_context_bytes(kw['fileobj'], phase)
+            if self.engine is not None:
+                events = self._build_image_async(**kw)
+            else:
+                events = self.client.build(rm=True, decode=True, **kw)
+
+            output = BuildOutput(events, on_event=self.on_build_event)
+            for event in output:
+                msg = event.get('stream')
+                if msg:
+                    self.stdout(msg)
+        return output.image_id, output.output
+
+    def _count_context_bytes(self, fileobj, phase):
+        # the context is either a file-like object or an iterable of chunks
+        if hasattr(fileobj, 'getbuffer'):
+            phase.add_bytes(fileobj.getbuffer().nbytes)
+            return fileobj
+
+        def counter():
+            for chunk in fileobj:
+                phase.add_bytes(len(chunk))
+                yield chunk
+        return counter()
+
+    def _build_image_async(self, fileobj, custom_context=False, tag=None,
+                           labels=None):
+        if not custom_context:
+            fileobj = [make_build_context(fileobj.read())]
+        params = {'rm': 1}
+        if tag:
+            params['t'] = tag
+        if labels:
+            params['labels'] = json.dumps(labels)
+        return self.engine.build(fileobj, params=params, timeout=self.timeout)
+
+    def _wait(self, container):
+        if self.engine is not None:
+            return self.engine.wait(container, timeout=self.timeout)
 
-    def _wait(self, container, timeout=1):
         result = {}
 
         def waiter():
@@ -644,10 +3010,16 @@ class DockerBuilder(object):
 
     @contextmanager
     def _attach(self, container, stdout=None, encoding='utf8'):
-        client = self.connector()
         if stdout is None:
             stdout = self.stdout
+        if self.engine is not None:
+            with self._attach_async(container, stdout, encoding):
+                yield
+            return
+
+        client = self._acquire_client()
         should_stop = False
+        phase = self.metrics.current
 
         signal = threading.Condition()
         exc_info = []
@@ -662,6 +3034,9 @@ class DockerBuilder(object):
                           container, exc_info=True)
                 log.error('failed to attach to container=%s', container)
                 exc_info.append(sys.exc_info())
+                # wake up the caller to report the error
+                with signal:
+                    signal.notify_all()
                 return
             else:
                 log.debug('attached to container=%s', container)
@@ -682,6 +3057,8 @@ class DockerBuilder(object):
                         break
                 log.debug('read %d bytes from container=%s',
                           num_bytes, container)
+                if phase is not None:
+                    phase.add_bytes(num_bytes)
             except BaseException:
                 log.debug('exception caught while reading from container=%s',
                           container, exc_info=True)
@@ -699,6 +3076,8 @@ class DockerBuilder(object):
         # wait until attached before continuing
         signal.wait()
         signal.release()
+        if exc_info:
+            reraise(*exc_info[0])
         # it'd be nice to cleanup if there's an exception but currently
         # the stream has no way to specify a timeout so we just daemonize
         # the thread and let it hang until the process dies
@@ -714,6 +3093,49 @@ class DockerBuilder(object):
             should_stop = True
             log.debug('detaching early from container=%s', container)
             raise
+        # the stream is complete and the client may be reused
+        self._release_client(client)
+
+    @contextmanager
+    def _attach_async(self, container, stdout, encoding):
+        attached = Future()
+
+        def on_attached():
+            log.debug('attached to container=%s', container)
+            attached.set_result(None)
+
+        log.debug('attaching to container=%s', container)
+        future = self.engine.submit(
+            self.engine.client.attach(
+                container, stdout,
+                on_attached=on_attached,
+                encoding=encoding,
+            ),
+            timeout=self.timeout,
+        )
+        try:
+            # wait until attached before continuing, unless it failed
+            while not attached.done() and not future.done():
+                wait_for_futures(
+                    [attached, future],
+                    timeout=0.1,
+                    return_when=FIRST_COMPLETED,
+                )
+            if not attached.done():
+                log.error('failed to attach to container=%s', container)
+                future.result()
+
+            yield
+
+            num_bytes = wait_for_future(future)
+            log.debug('read %d bytes from container=%s',
+                      num_bytes, container)
+            self.metrics.record(num_bytes=num_bytes)
+        except BaseException:
+            # cancelling the coroutine closes the stream
+            if future.cancel():
+                log.debug('detaching early from container=%s', container)
+            raise
 
 def get_default_ssh_searchpaths():
     for searchpath in (
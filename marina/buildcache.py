@@ -0,0 +1,365 @@
+""" Manage the contents of the cache shared between builds of an app.
+
+The cache is a docker volume, or a folder on the docker host, which is
+mounted into the compile container. Its contents are inspected and
+modified from short-lived helper containers such that the same code works
+for volumes and remote daemons.
+
+"""
+import gzip
+import logging
+import posixpath
+
+import docker.errors
+
+log = __import__('logging').getLogger(__name__)
+
+def parse_cache_spec(spec, name, default_path='/tmp/cache', step=None):
+    """ Parse the ``--cache`` option of an app named ``name``.
+
+    Returns a tuple of ``(volume, hostpath, path)`` where exactly one of
+    ``volume`` or ``hostpath`` is set. Raises a ``ValueError`` if the path
+    within the build container is not absolute.
+
+    If ``step`` is set the cache of the named compile step is returned
+    instead, see :func:`step_cache`.
+
+    """
+    volume = '{0}__buildcache'.format(name)
+    hostpath = None
+    path = default_path
+    if spec:
+        parts = spec.split(':', 1)
+        if posixpath.isabs(parts[0]):
+            hostpath = parts[0]
+            volume = None
+        else:
+            volume = parts[0]
+        if len(parts) == 2:
+            path = parts[1]
+        if not posixpath.isabs(path):
+            raise ValueError('The cache "path" must be an absolute path.')
+    if step:
+        volume, hostpath = step_cache(volume, hostpath, step)
+    return volume, hostpath, path
+
+def step_cache(volume, hostpath, step):
+    """ Return the ``(volume, hostpath)`` of the cache of the compile step
+    named ``step``.
+
+    Each compile step of an app has its own cache, either a volume whose
+    name is suffixed by the step or a folder within the ``hostpath``.
+
+    """
+    if volume:
+        volume = '{0}-{1}'.format(volume, step)
+    if hostpath:
+        hostpath = posixpath.join(hostpath, step)
+    return volume, hostpath
+
+CACHE_LABEL = 'marina.cache'
+# the name of the cache shared by every generation of its volumes
+
+GENERATION_LABEL = 'marina.cache.generation'
+
+def find_cache_volumes(client, name):
+    """ Find every generation of the cache volume named ``name``.
+
+    Rebuilding a cache creates a new volume labeled with the next generation
+    instead of deleting the contents of the current volume. An unlabeled
+    volume named ``name``, created by older versions, is generation 0.
+
+    Returns a list of ``(generation, volume)`` tuples, oldest first.
+
+    """
+    result = {}
+    response = client.volumes(filters={
+        'label': '{0}={1}'.format(CACHE_LABEL, name)})
+    for volume in (response or {}).get('Volumes') or []:
+        labels = volume.get('Labels') or {}
+        try:
+            generation = int(labels.get(GENERATION_LABEL, 0))
+        except ValueError:
+            continue
+        result[volume['Name']] = generation
+    if name not in result:
+        try:
+            client.inspect_volume(name)
+        except docker.errors.NotFound:
+            pass
+        else:
+            result[name] = 0
+    return sorted((g, v) for v, g in result.items())
+
+def is_rotatable_volume(client, volume):
+    """ Return ``True`` if the volume named ``volume`` may be replaced by a
+    new generation.
+
+    Only plain local volumes are rotated. A volume using another driver or
+    driver options, for example one backed by a network filesystem or a
+    bind mount, is configured by the user and must be cleared in place.
+
+    """
+    info = client.inspect_volume(volume)
+    return (
+        (info.get('Driver') or 'local') == 'local' and
+        not info.get('Options')
+    )
+
+def create_cache_volume(client, name, generation=0, template=None):
+    """ Create a generation of the cache volume named ``name``.
+
+    The new volume keeps the labels of the existing volume named
+    ``template``, if any.
+
+    Returns the name of the new volume.
+
+    """
+    volume = name
+    if generation:
+        volume = '{0}.{1}'.format(name, generation)
+    labels = {}
+    if template is not None:
+        info = client.inspect_volume(template)
+        labels.update(info.get('Labels') or {})
+    labels.update({
+        CACHE_LABEL: name,
+        GENERATION_LABEL: str(generation),
+    })
+    client.create_volume(volume, labels=labels)
+    return volume
+
+def current_cache_volume(client, name):
+    """ Return the name of the newest generation of the cache volume named
+    ``name``, or ``None`` if it does not exist.
+
+    """
+    volumes = find_cache_volumes(client, name)
+    if volumes:
+        return volumes[-1][1]
+
+def remove_cache_volumes(client, volumes):
+    """ Remove old generations of a cache volume.
+
+    Volumes still in use, for example by a concurrent build, are skipped
+    and will be removed after a later build.
+
+    """
+    removed = []
+    for volume in volumes:
+        try:
+            client.remove_volume(volume)
+        except docker.errors.APIError:
+            log.warn('failed to remove old cache volume=%s', volume,
+                     exc_info=log.isEnabledFor(logging.DEBUG))
+        else:
+            log.info('removed old cache volume=%s', volume)
+            removed.append(volume)
+    return removed
+
+class CacheEntry(object):
+    """ A top-level file or folder in the cache."""
+    def __init__(self, name, size, atime, mtime):
+        self.name = name
+        self.size = size
+        self.atime = atime
+        self.mtime = mtime
+
+    @property
+    def last_used(self):
+        return max(self.atime, self.mtime)
+
+    def __repr__(self):
+        return '<CacheEntry name={0!r} size={1}>'.format(self.name, self.size)
+
+def select_evictions(entries, max_size):
+    """ Select the least-recently-used entries to remove from the cache in
+    order to reduce its total size to at most ``max_size`` bytes.
+
+    """
+    total = sum(entry.size for entry in entries)
+    evictions = []
+    for entry in sorted(entries, key=lambda e: (e.last_used, e.name)):
+        if total <= max_size:
+            break
+        evictions.append(entry)
+        total -= entry.size
+    return evictions
+
+def parse_entries(output):
+    entries = []
+    for line in output.splitlines():
+        parts = line.split(' ', 3)
+        if len(parts) != 4:
+            continue
+        size_kb, atime, mtime, name = parts
+        try:
+            entries.append(CacheEntry(
+                name, int(size_kb) * 1024, int(atime), int(mtime)))
+        except ValueError:
+            log.debug('ignoring unexpected cache entry line=%r', line)
+    return entries
+
+class BuildCache(object):
+    """ A cache volume or host folder.
+
+    Helper containers are created from ``image``, which must provide a
+    POSIX shell along with ``du``, ``stat`` and ``rm``. The compile image
+    of the app is a sensible choice as it is already available.
+
+    """
+    mount_path = '/cache'
+
+    # the recency of an entry is the newest of its access and modification
+    # times, nested files do not always update the times of the entry
+    inspect_script = u'''\
+cd /cache || exit 1
+for entry in * .[!.]* ..?*; do
+    if [ ! -e "$entry" ] && [ ! -L "$entry" ]; then
+        continue
+    fi
+    size=$(du -sk "$entry" 2>/dev/null | cut -f1)
+    times=$(stat -c '%X %Y' "$entry")
+    echo "${size:-0} $times $entry"
+done
+'''
+
+    def __init__(self, client, image, volume=None, hostpath=None):
+        if not volume and not hostpath:
+            raise ValueError('a cache volume or hostpath is required')
+        self.client = client
+        self.image = image
+        self.volume = volume
+        self.hostpath = hostpath
+
+    @property
+    def source(self):
+        return self.volume or self.hostpath
+
+    def exists(self):
+        if self.hostpath:
+            return True
+        try:
+            self.client.inspect_volume(self.volume)
+        except docker.errors.NotFound:
+            return False
+        return True
+
+    def create(self):
+        if self.volume:
+            create_cache_volume(self.client, self.volume)
+
+    def _ensure_image(self):
+        # a fresh build node may not have the image yet
+        try:
+            self.client.inspect_image(self.image)
+        except docker.errors.NotFound:
+            log.info('pulling image=%s', self.image)
+            self.client.pull(self.image)
+
+    def _create_container(self, entrypoint, command, read_only=False):
+        self._ensure_image()
+        host_config = self.client.create_host_config(binds={
+            self.source: {'bind': self.mount_path, 'ro': read_only},
+        })
+        container = self.client.create_container(
+            self.image,
+            entrypoint=entrypoint,
+            command=command,
+            user='root',
+            host_config=host_config,
+        )
+        return container.get('Id')
+
+    def _run(self, entrypoint, command, read_only=False):
+        container = self._create_container(
+            entrypoint, command, read_only=read_only)
+        try:
+            self.client.start(container)
+            status = self.client.wait(container)['StatusCode']
+            output = self.client.logs(container, stdout=True, stderr=False)
+            if status != 0:
+                errors = self.client.logs(
+                    container, stdout=False, stderr=True)
+                raise RuntimeError(
+                    'cache helper failed with status={0}: {1}'.format(
+                        status, errors.decode('utf8', 'replace').strip()))
+            return output.decode('utf8', 'replace')
+        finally:
+            self._remove_container(container)
+
+    def _remove_container(self, container):
+        try:
+            self.client.remove_container(container, force=True)
+        except Exception:
+            log.exception('failed to remove container=%s', container)
+
+    def entries(self):
+        """ Return a list of the top-level :class:`CacheEntry` objects."""
+        output = self._run(
+            ['/bin/sh', '-c'], [self.inspect_script], read_only=True)
+        return parse_entries(output)
+
+    def remove(self, entries):
+        names = [posixpath.join(self.mount_path, e.name) for e in entries]
+        if names:
+            self._run(['rm', '-rf', '--'], names)
+
+    def prune(self, max_size, dry_run=False):
+        """ Remove the least-recently-used entries until the cache is at
+        most ``max_size`` bytes.
+
+        Returns a tuple of the evicted entries and the remaining entries.
+
+        """
+        entries = self.entries()
+        evictions = select_evictions(entries, max_size)
+        if evictions and not dry_run:
+            log.info('evicting %d entries from cache=%s',
+                     len(evictions), self.source)
+            self.remove(evictions)
+        remaining = [e for e in entries if e not in evictions]
+        return evictions, remaining
+
+    def export(self, fileobj, compresslevel=6):
+        """ Write the contents of the cache to ``fileobj`` as a gzipped
+        tarball. Returns the number of uncompressed bytes written.
+
+        """
+        container = self._create_container(None, ['true'], read_only=True)
+        try:
+            stream, _ = self.client.get_archive(container, self.mount_path)
+            num_bytes = 0
+            with gzip.GzipFile(
+                fileobj=fileobj, mode='wb', compresslevel=compresslevel,
+            ) as gz:
+                for chunk in stream:
+                    num_bytes += len(chunk)
+                    gz.write(chunk)
+            return num_bytes
+        finally:
+            self._remove_container(container)
+
+    def import_(self, fileobj, chunk_size=1024 * 1024):
+        """ Extract a tarball written by :meth:`export` into the cache.
+
+        The cache is created if it does not exist. Existing entries are
+        kept unless they are overwritten by the tarball.
+
+        """
+        if not self.exists():
+            self.create()
+        container = self._create_container(None, ['true'])
+
+        def read():
+            with gzip.GzipFile(fileobj=fileobj, mode='rb') as gz:
+                for chunk in iter(lambda: gz.read(chunk_size), b''):
+                    yield chunk
+
+        try:
+            # the archive contains the cache folder itself
+            parent = posixpath.dirname(self.mount_path)
+            if not self.client.put_archive(container, parent, read()):
+                raise RuntimeError('failed to import the cache')
+        finally:
+            self._remove_container(container)
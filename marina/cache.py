@@ -0,0 +1,122 @@
+import io
+import os.path
+import time
+
+from .build import parse_build_steps_from_file
+from .buildcache import BuildCache
+from .buildcache import current_cache_volume
+from .buildcache import parse_cache_spec
+from .utils import format_size
+from .utils import parse_size
+
+log = __import__('logging').getLogger(__name__)
+
+def main(cli, args):
+    context_path = os.path.normpath(args.app)
+    try:
+        steps = parse_build_steps_from_file(
+            os.path.join(context_path, 'meta.yml'))
+        if steps.multi_step and not args.step:
+            raise ValueError(
+                'The --step option is required as the app has several '
+                'compile steps.')
+        step = steps.compiler
+        if args.step:
+            step = steps.get_compile_step(args.step)
+        volume, hostpath, _ = parse_cache_spec(
+            args.cache, steps.name, step=step.name)
+        max_size = parse_size(args.max_size)
+    except ValueError as ex:
+        cli.abort(ex.args[0])
+    if max_size is None:
+        max_size = steps.cache_max_size
+
+    if args.action in ('export', 'import') and not args.file:
+        cli.abort('The --file option is required to {0} a cache.'.format(
+            args.action))
+
+    with cli.docker_pool.client() as client:
+        if volume:
+            # use the newest generation of the volume
+            volume = current_cache_volume(client, volume) or volume
+        cache = BuildCache(
+            client,
+            args.image or step.base_image,
+            volume=volume,
+            hostpath=hostpath,
+        )
+        if args.action != 'import' and not cache.exists():
+            cli.abort('Could not find cache volume "{0}".'.format(volume))
+        return ACTIONS[args.action](cli, args, cache, max_size)
+
+def _inspect(cli, args, cache, max_size):
+    entries = sorted(
+        cache.entries(), key=lambda e: e.last_used, reverse=True)
+    total = sum(e.size for e in entries)
+    cli.out('{0:>10}  {1:<19}  {2}\n'.format('size', 'last used', 'entry'))
+    for entry in entries:
+        cli.out('{0:>10}  {1:<19}  {2}\n'.format(
+            format_size(entry.size),
+            time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(entry.last_used)),
+            entry.name,
+        ))
+    cli.out('total={0} entries={1} quota={2} cache={3}\n'.format(
+        format_size(total),
+        len(entries),
+        format_size(max_size) if max_size is not None else 'none',
+        cache.source,
+    ))
+
+def _prune(cli, args, cache, max_size):
+    if max_size is None:
+        cli.abort('A quota is required to prune the cache. Either use '
+                  '--max-size or set "cache: max_size" in the meta.yml.')
+    evictions, remaining = cache.prune(max_size, dry_run=args.dry_run)
+    for entry in evictions:
+        cli.out('{0} entry={1} size={2}\n'.format(
+            'would evict' if args.dry_run else 'evicted',
+            entry.name,
+            format_size(entry.size),
+        ))
+    cli.out('total={0} entries={1} evicted={2} cache={3}\n'.format(
+        format_size(sum(e.size for e in remaining)),
+        len(remaining),
+        len(evictions),
+        cache.source,
+    ))
+
+def _export(cli, args, cache, max_size):
+    start = time.time()
+    tmp_path = args.file + '.tmp'
+    try:
+        with io.open(tmp_path, 'wb') as fp:
+            num_bytes = cache.export(fp)
+        os.replace(tmp_path, args.file)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    cli.out('exported cache={0} to file={1} size={2} in {3:.2f}s\n'.format(
+        cache.source,
+        args.file,
+        format_size(os.path.getsize(args.file)),
+        time.time() - start,
+    ))
+    log.debug('exported %d uncompressed bytes', num_bytes)
+
+def _import(cli, args, cache, max_size):
+    if not os.path.exists(args.file):
+        cli.abort('Could not find file "{0}".'.format(args.file))
+    start = time.time()
+    with io.open(args.file, 'rb') as fp:
+        cache.import_(fp)
+    cli.out('imported file={0} into cache={1} in {2:.2f}s\n'.format(
+        args.file, cache.source, time.time() - start))
+
+ACTIONS = {
+    'inspect': _inspect,
+    'prune': _prune,
+    'export': _export,
+    'import': _import,
+}
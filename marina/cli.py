@@ -1,12 +1,14 @@
+import argparse
 import logging
 import os
 import sys
+import threading
 
-import docker
-import pkg_resources
 from subparse import CLI
 from subparse import command
 
+from .clients import ClientPool
+
 log = __import__('logging').getLogger(__name__)
 
 @command('.build')
@@ -16,6 +18,20 @@ def build(parser):
 
     The build will be.
     """
+    add_build_options(parser)
+    parser.add_argument(
+        'app',
+        nargs='+',
+        help=(
+            'Path to an application folder with a meta.yml file. May be '
+            'specified more than once to build several apps, in which case '
+            'the output of each build is prefixed by the app name and a '
+            'summary is written once all of the builds are complete.'
+        ),
+    )
+
+def add_build_options(parser):
+    """ The options shared by the ``build`` and ``serve`` commands."""
     parser.add_argument(
         '-i', '--identity-file',
         help=(
@@ -41,10 +57,98 @@ def build(parser):
             'This folder should be accessible from the docker instance.'
         ),
     )
+    parser.add_argument(
+        '--stage',
+        dest='stage_mode',
+        choices=['copy', 'hardlink', 'reflink', 'sync'],
+        default='copy',
+        help=(
+            'How the build context is staged into the build directory. '
+            'Paths matching the patterns in a .marinaignore file in the app '
+            'folder are always excluded.'
+            '\n\n'
+            '  copy - copy every file (default)\n'
+            '  hardlink - hardlink every file, the build commands must not '
+            'modify files in-place\n'
+            '  reflink - clone every file on copy-on-write filesystems\n'
+            '  sync - only copy changed files into a persistent folder'
+        ),
+    )
+    parser.add_argument(
+        '--stage-dir',
+        help=(
+            'The persistent folder used by --stage=sync. This will default '
+            'to ".marina-stage/<name>" inside the build directory.'
+        ),
+    )
     parser.add_argument(
         '--archive',
         help=(
-            'Archive the build files into a local tarball.'
+            'Archive the build files into a local tarball. The sha256 '
+            'checksum of the tarball is written next to it in a file with '
+            'a ".sha256" suffix.'
+        ),
+    )
+    parser.add_argument(
+        '--compression',
+        choices=['gzip', 'pigz', 'zstd', 'lz4', 'none'],
+        help=(
+            'The codec used to compress the slug, overriding the '
+            '"compression" setting in the meta.yml. Defaults to gzip. If '
+            'the compressor is not installed in the compile image then '
+            'gzip is used instead. If the runner image cannot extract '
+            'the archive using tar and the codec then the slug is '
+            'decompressed using the compile image.'
+        ),
+    )
+    parser.add_argument(
+        '--compression-level',
+        type=int,
+        help=(
+            'The compression level passed to the compressor, clamped to '
+            'the levels supported by the codec: 1-9 for gzip and pigz, '
+            '1-22 for zstd and 1-12 for lz4.'
+        ),
+    )
+    parser.add_argument(
+        '--compression-threads',
+        type=int,
+        help=(
+            'The number of threads used by the compressor. This is '
+            'supported by pigz and zstd. The default for zstd is to use '
+            'one thread per core.'
+        ),
+    )
+    parser.add_argument(
+        '--reproducible',
+        action='store_true',
+        default=False,
+        help=(
+            'Write the slug such that identical files always result in an '
+            'identical slug by sorting the entries, resetting their owners '
+            'and clamping their modification times to SOURCE_DATE_EPOCH, '
+            'which is forwarded from the environment and defaults to 0. '
+            'Requires GNU tar in the compile image.'
+        ),
+    )
+    parser.add_argument(
+        '--snapshot',
+        action='store_true',
+        default=False,
+        help=(
+            'Commit the compile container to an image after each command '
+            'and resume a later build from the newest snapshot whose '
+            'command and inputs are unchanged.'
+        ),
+    )
+    parser.add_argument(
+        '--host-dist',
+        action='store_true',
+        default=False,
+        help=(
+            'Bind the folder containing the slug to a folder inside the '
+            'build directory. The --archive is then written by linking or '
+            'copying the file instead of streaming it out of a container.'
         ),
     )
     parser.add_argument(
@@ -55,6 +159,19 @@ def build(parser):
             'Skip tagging and building the runner image.'
         ),
     )
+    parser.add_argument(
+        '--single-pass',
+        action='store_true',
+        default=False,
+        help=(
+            'Build the runner image with a single docker build that '
+            'streams the slug into the build context and extracts it '
+            'using ADD. This avoids running and committing a container and '
+            'results in a single layer. Requires the gzip, pigz or none '
+            'compression codecs. Implied when the files of a compile step '
+            'are split into groups.'
+        ),
+    )
     parser.add_argument(
         '-t', '--tag',
         help=(
@@ -62,6 +179,16 @@ def build(parser):
             'This will default to the current date/time.'
         ),
     )
+    parser.add_argument(
+        '--pull',
+        choices=['always', 'missing', 'never'],
+        default='always',
+        help=(
+            'When to pull the base images from the registry. The default '
+            'is "always". Use "missing" to only pull images that are not '
+            'available locally and "never" to fail if they are not.'
+        ),
+    )
     parser.add_argument(
         '--no-cache',
         dest='use_cache',
@@ -107,7 +234,25 @@ def build(parser):
         action='store_true',
         default=False,
         help=(
-            'Delete any cached artifacts prior to building.'
+            'Delete any cached artifacts prior to building. A local cache '
+            'volume is replaced by a new, empty generation of the volume and '
+            'the old generations are removed in the background once the '
+            'build is complete. A volume using another driver or driver '
+            'options and a cache on the host filesystem are emptied.'
+        ),
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        default=False,
+        help=(
+            'Always run the build, even if an image built from identical '
+            'inputs already exists.'
+            '\n\n'
+            'By default a digest is computed over the meta.yml, the build '
+            'context, the --env variables and the base images. If an image '
+            'labelled with that digest exists it is tagged with the new '
+            'version instead of being rebuilt.'
         ),
     )
     parser.add_argument(
@@ -118,10 +263,300 @@ def build(parser):
             'Skip removal of images and containers.'
         ),
     )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'asyncio'],
+        default='threads',
+        help=(
+            'How containers are supervised while they are running. The '
+            '"asyncio" engine drives every attached stream, wait and image '
+            'build on a single event loop talking directly to the docker '
+            'unix socket instead of using a thread for each. It is best '
+            'suited for building many apps concurrently.'
+        ),
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        help=(
+            'The maximum number of seconds to wait for each container or '
+            'image build to complete. Requires --engine=asyncio and is not '
+            'supported with --warm-pool.'
+        ),
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help=(
+            'The number of apps to build concurrently when more than one '
+            'app is specified. Defaults to 1.'
+        ),
+    )
+    parser.add_argument(
+        '--artifact-store',
+        metavar='PATH',
+        help=(
+            'A folder, such as an NFS mount shared by the build nodes, in '
+            'which compiled slugs are stored by a digest of the inputs of '
+            'the compile step. A stored slug is used instead of compiling '
+            'the app again. Implies --host-dist.'
+        ),
+    )
+    parser.add_argument(
+        '--artifact-store-max-size',
+        metavar='SIZE',
+        help=(
+            'Evict the least-recently-used slugs from the --artifact-store '
+            'such that it remains within this size, for example "20G".'
+        ),
+    )
+    parser.add_argument(
+        '--warm-pool',
+        action='store_true',
+        default=False,
+        help=(
+            'Exec the build script in long-lived compile containers shared '
+            'by the builds of an app instead of creating a new container '
+            'for each build. Implies --host-dist.'
+        ),
+    )
+    parser.add_argument(
+        '--warm-pool-max-uses',
+        metavar='N',
+        type=int,
+        default=20,
+        help=(
+            'Recycle a warm compile container after it served this many '
+            'builds. Defaults to 20.'
+        ),
+    )
+    parser.add_argument(
+        '--warm-pool-idle-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=300,
+        help=(
+            'Recycle a warm compile container after it was idle for this '
+            'many seconds. Defaults to 300.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help=(
+            'Write the duration, bytes streamed and exit status of each '
+            'phase of the builds to a file. The file is written in the '
+            'Prometheus textfile format if it ends with ".prom" and as '
+            'JSON otherwise, see --metrics-format.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics-format',
+        choices=['json', 'prometheus'],
+        help=(
+            'The format of the --metrics-file.'
+        ),
+    )
+
+@command('.serve')
+def serve(parser):
+    """
+    Run a build daemon accepting jobs from "marina submit".
+
+    Jobs are built using the build options given to the daemon, up to
+    --jobs at a time. Identical requests for an app whose build is already
+    queued or running share that build and its output.
+    """
+    add_build_options(parser)
+    parser.add_argument(
+        '--socket',
+        metavar='PATH',
+        help=(
+            'The unix socket on which to listen. Defaults to $MARINA_SOCKET '
+            'or "marina.sock" in $XDG_RUNTIME_DIR.'
+        ),
+    )
+    parser.add_argument(
+        '--listen',
+        metavar='HOST:PORT',
+        help=(
+            'Listen for http requests on a tcp port instead of a unix '
+            'socket. The daemon is not authenticated, bind it to a trusted '
+            'interface only.'
+        ),
+    )
+    parser.add_argument(
+        '--history',
+        type=int,
+        default=100,
+        help=(
+            'The number of finished jobs reported by the /jobs endpoint. '
+            'Defaults to 100.'
+        ),
+    )
+
+@command('.submit')
+def submit(parser):
+    """
+    Submit a build to a daemon started by "marina serve".
+
+    The output of the build is streamed until it is complete.
+    """
+    parser.add_argument(
+        '--socket',
+        metavar='PATH',
+        help=(
+            'The unix socket of the daemon. Defaults to $MARINA_SOCKET or '
+            '"marina.sock" in $XDG_RUNTIME_DIR.'
+        ),
+    )
+    parser.add_argument(
+        '--connect',
+        metavar='HOST:PORT',
+        help=(
+            'Connect to a daemon listening for http requests on a tcp port '
+            'instead of a unix socket.'
+        ),
+    )
+    parser.add_argument(
+        '-e', '--env',
+        action='append',
+        default=[],
+        help=(
+            'Add environ variables to the build, in addition to the '
+            'variables given to the daemon. May be specified more than '
+            'once.'
+        ),
+    )
+    parser.add_argument(
+        '-t', '--tag',
+        help=(
+            'Tag to apply to the built image. '
+            'This will default to the current date/time.'
+        ),
+    )
     parser.add_argument(
         'app',
         help=(
-            'Path to an application folder with a meta.yml file'
+            'Path to an application folder with a meta.yml file. It must '
+            'be accessible by the daemon at the same path.'
+        ),
+    )
+
+@command('.watch')
+def watch(parser):
+    """
+    Rebuild an application each time its build context changes.
+
+    Changes are detected using inotify, or by polling where it is not
+    available. Only the changed files are staged and the compile commands
+    are run in a warm compile container kept for the lifetime of the watch.
+    The duration of each rebuild and its latency since the first change are
+    reported. The image is tagged "dev" unless --tag is given.
+    """
+    add_build_options(parser)
+    parser.add_argument(
+        '--debounce',
+        metavar='SECONDS',
+        type=float,
+        default=0.3,
+        help=(
+            'Wait until the context did not change for this many seconds '
+            'before rebuilding. Defaults to 0.3.'
+        ),
+    )
+    parser.add_argument(
+        '--poll',
+        action='store_true',
+        default=False,
+        help=(
+            'Detect changes by polling the context instead of using inotify.'
+        ),
+    )
+    parser.add_argument(
+        '--poll-interval',
+        metavar='SECONDS',
+        type=float,
+        default=0.5,
+        help=(
+            'The number of seconds between each poll of the context. '
+            'Defaults to 0.5.'
+        ),
+    )
+    parser.add_argument(
+        'app',
+        help=(
+            'Path to an application folder with a meta.yml file.'
+        ),
+    )
+
+@command('.cache')
+def cache(parser):
+    """
+    Manage the cache shared between the builds of an application.
+
+    The "inspect" action lists the top-level entries of the cache along with
+    their size and when they were last used. The "prune" action evicts the
+    least-recently-used entries until the cache is within its quota. The
+    "export" and "import" actions save the cache to a gzipped tarball and
+    restore it, for example to seed the cache on a new build node.
+    """
+    parser.add_argument(
+        'action',
+        choices=['inspect', 'prune', 'export', 'import'],
+    )
+    parser.add_argument(
+        '--cache',
+        metavar='CONTAINER',
+        help=(
+            'The volume or absolute path on the host filesystem containing '
+            'the cache. Defaults to the "<name>__buildcache" volume. This '
+            'should match the --cache option used when building the app.'
+        ),
+    )
+    parser.add_argument(
+        '--max-size',
+        help=(
+            'The maximum size of the cache, such as "500M" or "2G", '
+            'overriding the "cache: max_size" setting in the meta.yml.'
+        ),
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help=(
+            'Report the entries that would be evicted by "prune" without '
+            'removing them.'
+        ),
+    )
+    parser.add_argument(
+        '-f', '--file',
+        help=(
+            'The path of the tarball written by "export" and read by '
+            '"import".'
+        ),
+    )
+    parser.add_argument(
+        '--step',
+        help=(
+            'The name of the compile step owning the cache. Required by '
+            'apps with several compile steps as each step has its own '
+            'cache.'
+        ),
+    )
+    parser.add_argument(
+        '--image',
+        help=(
+            'The image used to run the helper containers that access the '
+            'cache. It must contain a shell, du and stat. Defaults to the '
+            'compile base image of the app.'
+        ),
+    )
+    parser.add_argument(
+        'app',
+        help=(
+            'Path to an application folder with a meta.yml file.'
         ),
     )
 
@@ -141,10 +576,29 @@ def generic_options(parser):
             'Override any verbosity settings and suppress all output.'
         ),
     )
+    parser.add_argument(
+        '--docker-pool-size',
+        type=int,
+        default=4,
+        help=(
+            'The number of idle docker api clients kept open such that '
+            'concurrent builds and attached streams may reuse their '
+            'connections to the daemon. Defaults to 4.'
+        ),
+    )
+    parser.add_argument(
+        '--docker-timeout',
+        type=float,
+        default=60,
+        help=(
+            'The number of seconds to wait for a response to an api request '
+            'from the docker daemon. Defaults to 60.'
+        ),
+    )
 
 class AbortCLI(Exception):
     def __init__(self, msg, status):
-        Exception.__init__(msg)
+        Exception.__init__(self, msg)
         self.status = status
 
 def context_factory(cli, args):
@@ -158,6 +612,8 @@ class MarinaApp(object):
 
     def __init__(self, args):
         self.args = args
+        self._docker_pool = None
+        self._docker_pool_lock = threading.Lock()
 
     def setup_logging(self):
         if self.args.quiet:
@@ -176,7 +632,7 @@ class MarinaApp(object):
         )
 
     def abort(self, msg, status=1):
-        self.err(msg)
+        self.error(msg)
         raise AbortCLI(msg, status)
 
     def error(self, msg):
@@ -190,14 +646,40 @@ class MarinaApp(object):
             self.stdout.flush()
 
     def docker_client(self):
-        client = docker.from_env()
+        # deferred until a command needs a client as it is slow to import
+        import docker
+        client = docker.from_env(timeout=self.args.docker_timeout)
         return client
 
+    @property
+    def docker_pool(self):
+        """ A :class:`marina.clients.ClientPool` shared by every build."""
+        with self._docker_pool_lock:
+            if self._docker_pool is None:
+                self._docker_pool = ClientPool(
+                    lambda: self.docker_client().api,
+                    size=self.args.docker_pool_size,
+                )
+            return self._docker_pool
+
+class VersionAction(argparse.Action):
+    """ Print the version of marina, which is only looked up if requested.
+    """
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        argparse.Action.__init__(
+            self, option_strings, dest=dest, default=default, nargs=0,
+            help=help or "show program's version number and exit",
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        from importlib.metadata import version
+        sys.stdout.write(version('marina') + '\n')
+        parser.exit()
+
 def main(argv=None):
-    cli = CLI(
-        version=pkg_resources.get_distribution('marina').version,
-        context_factory=context_factory,
-    )
+    cli = CLI(context_factory=context_factory)
+    cli.add_generic_option('-V', '--version', action=VersionAction)
     cli.add_generic_options(generic_options)
     cli.load_commands(__name__)
     try:
@@ -0,0 +1,96 @@
+""" A pool of docker api clients shared between builds."""
+from contextlib import contextmanager
+import threading
+
+log = __import__('logging').getLogger(__name__)
+
+class ClientPool(object):
+    """ Lease docker api clients created by ``factory``.
+
+    Each client is leased to a single caller at a time. Up to ``size`` idle
+    clients are kept open once released such that subsequent builds and
+    attach streams reuse their keep-alive connections to the daemon
+    instead of opening new ones.
+
+    The pool never blocks. If every client is leased then a new one is
+    created, the surplus clients are closed when released. A build holds
+    a client while attaching to a container with another, so blocking
+    could deadlock concurrent builds.
+
+    """
+    def __init__(self, factory, size=4):
+        self.factory = factory
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop()
+            self.created += 1
+        log.debug('creating docker client, total=%d', self.created)
+        return self.factory()
+
+    def release(self, client):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(client)
+                return
+        _close_client(client)
+
+    @contextmanager
+    def client(self):
+        """ Lease a client for the duration of the block.
+
+        The client is discarded instead of being returned to the pool if
+        the block raises an exception as it may be left in a bad state.
+
+        """
+        client = self.acquire()
+        try:
+            yield client
+        except BaseException:
+            _close_client(client)
+            raise
+        self.release(client)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for client in idle:
+            _close_client(client)
+
+def acquire_client(connector):
+    """ Lease a client from ``connector``, which is either a
+    :class:`ClientPool` or a function which creates a new client each time
+    it is called.
+
+    """
+    acquire = getattr(connector, 'acquire', None)
+    if acquire is not None:
+        return acquire()
+    return connector()
+
+def release_client(connector, client):
+    """ Return a client leased by :func:`acquire_client`.
+
+    A client created by a function is closed.
+
+    """
+    release = getattr(connector, 'release', None)
+    if release is not None:
+        release(client)
+    else:
+        _close_client(client)
+
+def _close_client(client):
+    close = getattr(client, 'close', None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            log.debug('failed to close docker client', exc_info=True)
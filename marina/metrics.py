@@ -0,0 +1,229 @@
+""" Timing and size metrics collected while building an app.
+
+A :class:`BuildMetrics` records the duration, number of bytes streamed and
+exit status of each phase of a build. The metrics of many builds may be
+written to a file as JSON or in the Prometheus textfile format using
+:func:`write_metrics_file`.
+
+"""
+from contextlib import contextmanager
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+METRICS_FORMATS = ('json', 'prometheus')
+
+class Phase(object):
+    """ A single timed phase of a build."""
+    def __init__(self, name):
+        self.name = name
+        self.started_at = None
+        self.duration = None
+        self.bytes = 0
+        self.status = None
+        self.error = None
+
+    def add_bytes(self, num_bytes):
+        self.bytes += num_bytes
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'bytes': self.bytes,
+            'status': self.status,
+            'error': self.error,
+        }
+
+class BuildMetrics(object):
+    """ The metrics of a single build."""
+    def __init__(self, app, version=None):
+        self.app = app
+        self.version = version
+        self.phases = []
+        self.started_at = None
+        self.duration = None
+        self.reused = False
+        self.error = None
+        self._active = threading.local()
+
+    @property
+    def current(self):
+        """ The innermost phase active on the calling thread, if any."""
+        stack = getattr(self._active, 'stack', None)
+        return stack[-1] if stack else None
+
+    def record(self, status=None, num_bytes=0):
+        """ Record the exit status and bytes streamed by the current phase."""
+        phase = self.current
+        if phase is None:
+            return
+        if status is not None:
+            phase.status = status
+        phase.add_bytes(num_bytes)
+
+    @property
+    def success(self):
+        return self.duration is not None and self.error is None
+
+    @contextmanager
+    def measure(self):
+        """ Time the entire build."""
+        self.started_at = time.time()
+        start = time.perf_counter()
+        try:
+            yield self
+        except BaseException as ex:
+            self.error = str(ex) or ex.__class__.__name__
+            raise
+        finally:
+            self.duration = time.perf_counter() - start
+
+    @contextmanager
+    def phase(self, name):
+        """ Time a phase of the build.
+
+        The :class:`Phase` is yielded such that the caller may record the
+        number of bytes streamed and the exit status.
+
+        """
+        phase = Phase(name)
+        phase.started_at = time.time()
+        self.phases.append(phase)
+        stack = self._active.__dict__.setdefault('stack', [])
+        stack.append(phase)
+        start = time.perf_counter()
+        try:
+            yield phase
+        except BaseException as ex:
+            phase.error = str(ex) or ex.__class__.__name__
+            raise
+        finally:
+            phase.duration = time.perf_counter() - start
+            stack.pop()
+
+    def as_dict(self):
+        return {
+            'app': self.app,
+            'version': self.version,
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'success': self.success,
+            'reused': self.reused,
+            'error': self.error,
+            'phases': [phase.as_dict() for phase in self.phases],
+        }
+
+def render_json(metrics):
+    return json.dumps(
+        {'builds': [m.as_dict() for m in metrics]},
+        indent=2,
+        sort_keys=True,
+    ) + '\n'
+
+def _escape_label(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+def _labels(**kw):
+    return '{' + ','.join(
+        '{0}="{1}"'.format(k, _escape_label(v))
+        for k, v in sorted(kw.items())
+    ) + '}'
+
+def render_prometheus(metrics):
+    """ Render the metrics in the Prometheus text exposition format.
+
+    Phases that occur several times in a build, such as pulls, are summed.
+
+    """
+    samples = {}
+
+    def add(name, help, value, **labels):
+        samples.setdefault(name, (help, []))[1].append((labels, value))
+
+    for m in metrics:
+        add('marina_build_duration_seconds',
+            'Total duration of the build.',
+            m.duration or 0, app=m.app)
+        add('marina_build_success',
+            'Whether the build completed successfully.',
+            int(m.success), app=m.app)
+        add('marina_build_reused',
+            'Whether an existing image was reused instead of building.',
+            int(m.reused), app=m.app)
+        add('marina_build_started_timestamp_seconds',
+            'Time at which the build started.',
+            m.started_at or 0, app=m.app)
+
+        totals = {}
+        for phase in m.phases:
+            total = totals.get(phase.name)
+            if total is None:
+                total = totals[phase.name] = Phase(phase.name)
+                total.duration = 0
+            total.duration += phase.duration or 0
+            total.bytes += phase.bytes
+            if phase.status is not None and not total.status:
+                total.status = phase.status
+        for phase in totals.values():
+            add('marina_build_phase_duration_seconds',
+                'Duration of a phase of the build.',
+                phase.duration, app=m.app, phase=phase.name)
+            add('marina_build_phase_bytes',
+                'Number of bytes streamed during a phase of the build.',
+                phase.bytes, app=m.app, phase=phase.name)
+            if phase.status is not None:
+                add('marina_build_phase_exit_status',
+                    'Exit status of the container run during a phase.',
+                    phase.status, app=m.app, phase=phase.name)
+
+    lines = []
+    for name in sorted(samples):
+        help, values = samples[name]
+        lines.append('# HELP {0} {1}'.format(name, help))
+        lines.append('# TYPE {0} gauge'.format(name))
+        for labels, value in values:
+            lines.append('{0}{1} {2}'.format(
+                name, _labels(**labels), float(value)))
+    return '\n'.join(lines) + '\n'
+
+def guess_metrics_format(path):
+    if path.endswith('.prom'):
+        return 'prometheus'
+    return 'json'
+
+def write_metrics_file(path, metrics, format=None):
+    """ Atomically write the metrics of many builds to ``path``.
+
+    The file is replaced in a single step such that collectors never read
+    a partially written file.
+
+    """
+    if format is None:
+        format = guess_metrics_format(path)
+    if format == 'prometheus':
+        data = render_prometheus(metrics)
+    elif format == 'json':
+        data = render_json(metrics)
+    else:
+        raise ValueError('unknown metrics format "{0}"'.format(format))
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.metrics-')
+    try:
+        with io.open(fd, 'w') as fp:
+            fp.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
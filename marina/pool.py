@@ -0,0 +1,131 @@
+""" A pool of long-lived compile containers shared between builds."""
+import threading
+import time
+
+log = __import__('logging').getLogger(__name__)
+
+class WarmContainer(object):
+    """ A running container leased from the :class:`ContainerPool`."""
+    def __init__(self, id, key):
+        self.id = id
+        self.key = key
+        self.uses = 0
+        self.last_used = time.time()
+
+    def __repr__(self):
+        return '<WarmContainer id={0} uses={1}>'.format(
+            self.id[:12], self.uses)
+
+class ContainerPool(object):
+    """ Lease running compile containers into which builds exec their
+    build script instead of creating a new container for each build.
+
+    Containers are grouped by a ``key`` covering everything fixed when the
+    container is created, such as the image and the binds. Each container
+    is leased to a single build at a time. Up to ``max_idle`` idle
+    containers are kept per key once released and a container is recycled
+    after serving ``max_uses`` builds or after being idle for more than
+    ``idle_timeout`` seconds.
+
+    Like the :class:`marina.clients.ClientPool` the pool never blocks, a
+    new container is created if every container for the key is leased.
+
+    """
+    label = 'marina.warm-pool'
+
+    def __init__(self, max_uses=20, idle_timeout=300, max_idle=4):
+        self.max_uses = max_uses
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self, client, key, factory):
+        """ Lease a :class:`WarmContainer` for ``key``.
+
+        ``factory(client)`` is called to create and start a new container
+        if there are no idle containers for the key and must return its id.
+
+        """
+        self.reap(client)
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                self.reused += 1
+                container = idle.pop()
+                log.debug('reusing warm container=%s', container.id)
+                return container
+            self.created += 1
+        container = WarmContainer(factory(client), key)
+        log.info('created warm container=%s', container.id)
+        return container
+
+    def release(self, client, container, discard=False):
+        """ Return a leased container to the pool.
+
+        The container is removed instead if ``discard`` is ``True``, for
+        example because the build failed and left it in an unknown state,
+        or if it served ``max_uses`` builds.
+
+        """
+        container.uses += 1
+        container.last_used = time.time()
+        if not discard and container.uses < self.max_uses:
+            with self.lock:
+                idle = self.idle.setdefault(container.key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(container)
+                    container = None
+        if container is not None:
+            self._remove(client, container)
+        self.reap(client)
+
+    def reap(self, client):
+        """ Remove the containers that were idle for too long."""
+        if self.idle_timeout is None:
+            return
+        expired = self.discard(
+            client,
+            lambda c: time.time() - c.last_used > self.idle_timeout,
+        )
+        for container in expired:
+            log.debug('recycled idle warm container=%s', container.id)
+
+    def discard(self, client, predicate):
+        """ Remove the idle containers for which ``predicate(container)``
+        is true.
+
+        Returns the removed containers.
+
+        """
+        removed = []
+        with self.lock:
+            for key, idle in list(self.idle.items()):
+                keep = []
+                for container in idle:
+                    if predicate(container):
+                        removed.append(container)
+                    else:
+                        keep.append(container)
+                if keep:
+                    self.idle[key] = keep
+                else:
+                    del self.idle[key]
+        for container in removed:
+            self._remove(client, container)
+        return removed
+
+    def close(self, client):
+        """ Remove every idle container."""
+        self.discard(client, lambda c: True)
+
+    def _remove(self, client, container):
+        log.debug('removing warm container=%s after uses=%d',
+                  container.id, container.uses)
+        try:
+            client.remove_container(container.id, v=True, force=True)
+        except Exception:
+            log.exception('failed to remove warm container=%s',
+                          container.id)
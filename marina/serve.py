@@ -0,0 +1,487 @@
+""" A long-lived build daemon accepting jobs over a unix socket or http.
+
+A client submits a build by posting a json object to ``/builds``::
+
+    {"app": "/path/to/app", "tag": "1.2.3", "env": {"KEY": "VALUE"}}
+
+Only ``app`` is required. The response is a stream of newline-delimited
+json events::
+
+    {"event": "queued", "job": "<id>", "shared": false, "position": 0}
+    {"event": "started", "job": "<id>"}
+    {"event": "log", "data": "..."}
+    {"event": "result", "job": "<id>", "status": 0, "image": "...", ...}
+
+Requests for the same app with identical inputs, tag and environment are
+merged into the job already queued or running for them such that every
+client receives the log and result of a single build. A client joining a job
+whose early log was discarded receives a
+``{"event": "truncated", "job": "<id>", "skipped": <count>}`` event first. ``GET /jobs`` lists
+the queued, running and recently finished jobs.
+
+"""
+import collections
+import copy
+from http.server import BaseHTTPRequestHandler
+import hashlib
+import itertools
+import json
+import os
+import os.path
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+
+from .artifacts import ArtifactStore
+from .build import ImagePuller
+from .build import make_builder
+from .build import make_engine
+from .build import parse_build_steps_from_file
+from .build import run_builder
+from .metrics import write_metrics_file
+from .pool import ContainerPool
+from .submit import default_socket_path
+from .utils import parse_build_env
+from .utils import parse_size
+
+log = __import__('logging').getLogger(__name__)
+
+def main(cli, args):
+    if args.archive:
+        cli.abort('The --archive option is not supported by the daemon.')
+    env = parse_build_env(cli, args)
+    puller = ImagePuller(policy=args.pull)
+    build = JobRunner(cli, args, env, puller)
+    jobs = BuildQueue(build, jobs=args.jobs, history=args.history)
+
+    if args.listen:
+        host, _, port = args.listen.rpartition(':')
+        try:
+            server = TCPBuildServer((host or '127.0.0.1', int(port)), jobs)
+        except ValueError:
+            cli.abort('The --listen option must be of the form HOST:PORT.')
+        address = 'http://{0}:{1}'.format(*server.server_address[:2])
+    else:
+        path = args.socket or default_socket_path()
+        if os.path.exists(path):
+            if _socket_in_use(path):
+                cli.abort('Another daemon is listening on "{0}".'.format(
+                    path))
+            os.unlink(path)
+        server = UnixBuildServer(path, jobs)
+        address = path
+
+    def on_terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, on_terminate)
+
+    log.info('listening on %s with jobs=%d', address, args.jobs)
+    cli.out('listening on {0}\n'.format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('shutting down')
+    finally:
+        server.server_close()
+        if not args.listen and os.path.exists(address):
+            os.unlink(address)
+        jobs.close()
+        build.close()
+    return 0
+
+def _socket_in_use(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+class JobRunner(object):
+    """ Build a :class:`BuildJob` using the options the daemon was started
+    with.
+
+    The image puller, artifact store and warm container pool are shared by
+    every job for the lifetime of the daemon.
+
+    """
+    def __init__(self, cli, args, env, puller):
+        self.cli = cli
+        self.args = args
+        self.env = env
+        self.puller = puller
+        self.artifact_store = None
+        self.container_pool = None
+        self.metrics = collections.deque(maxlen=args.history)
+        self.lock = threading.Lock()
+        self.engine = make_engine(cli, args)
+
+        if args.artifact_store:
+            try:
+                self.artifact_store = ArtifactStore(
+                    args.artifact_store,
+                    max_size=parse_size(args.artifact_store_max_size),
+                )
+            except ValueError as ex:
+                cli.abort(ex.args[0])
+        if args.warm_pool:
+            self.container_pool = ContainerPool(
+                max_uses=args.warm_pool_max_uses,
+                idle_timeout=args.warm_pool_idle_timeout,
+            )
+
+    def __call__(self, job):
+        args = copy.copy(self.args)
+        if job.tag:
+            args.tag = job.tag
+        env = dict(self.env)
+        env.update(job.env)
+        try:
+            builder = make_builder(
+                self.cli, args, job.app,
+                env=env,
+                puller=self.puller,
+                artifact_store=self.artifact_store,
+                container_pool=self.container_pool,
+                engine=self.engine,
+            )
+        except Exception as ex:
+            return {'status': -1, 'error': str(ex)}
+        builder.stdout = job.write
+        try:
+            status = run_builder(builder)
+        finally:
+            # completed pulls are repeated by later jobs such that the
+            # daemon follows the pull policy
+            self.puller.forget_completed()
+        self._write_metrics(builder.metrics)
+        return {
+            'status': status,
+            'app': builder.steps.name,
+            'version': builder.steps.version,
+            'image': builder.runner_image,
+            'tag': builder.runner_tag if builder.runner_image else None,
+            'images': builder.runner_images,
+            'reused': builder.metrics.reused,
+            'duration': builder.metrics.duration,
+            'error': builder.metrics.error,
+        }
+
+    def _write_metrics(self, metrics):
+        if not self.args.metrics_file:
+            return
+        with self.lock:
+            self.metrics.append(metrics)
+            try:
+                write_metrics_file(
+                    self.args.metrics_file,
+                    list(self.metrics),
+                    format=self.args.metrics_format,
+                )
+            except Exception:
+                log.exception('failed to write metrics to file=%s',
+                              self.args.metrics_file)
+
+    def close(self):
+        if self.container_pool is not None:
+            with self.cli.docker_pool.client() as client:
+                self.container_pool.close(client)
+        if self.engine is not None:
+            self.engine.close()
+
+class BuildJob(object):
+    """ A build requested by one or more clients.
+
+    Only the last ``max_events`` events of the job are kept such that memory
+    usage remains bounded regardless of how chatty the build is. A client
+    joining a running job receives a ``truncated`` event with the number of
+    skipped events if the beginning of the log was discarded.
+
+    """
+    max_events = 10000
+
+    def __init__(self, id, key, app, tag=None, env=None, max_events=None):
+        self.id = id
+        self.key = key
+        self.app = app
+        self.tag = tag
+        self.env = env or {}
+        self.state = 'queued'
+        self.clients = 1
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        if max_events is None:
+            max_events = self.max_events
+        self.events = collections.deque(maxlen=max_events)
+        # the number of events emitted, including the discarded ones
+        self.emitted = 0
+        self.cond = threading.Condition()
+
+    def write(self, msg):
+        self._emit({'event': 'log', 'data': msg})
+
+    def start(self):
+        self.state = 'running'
+        self.started_at = time.time()
+        self._emit({'event': 'started', 'job': self.id})
+
+    def finish(self, result):
+        result = dict(result, event='result', job=self.id)
+        with self.cond:
+            self.state = 'done'
+            self.finished_at = time.time()
+            self.result = result
+            self.events.append(result)
+            self.emitted += 1
+            self.cond.notify_all()
+
+    def _emit(self, event):
+        with self.cond:
+            self.events.append(event)
+            self.emitted += 1
+            self.cond.notify_all()
+
+    def follow(self):
+        """ Yield every event of the job until it is complete."""
+        index = 0
+        while True:
+            with self.cond:
+                while index >= self.emitted and self.state != 'done':
+                    self.cond.wait()
+                first = self.emitted - len(self.events)
+                events = []
+                if index < first:
+                    events.append({
+                        'event': 'truncated',
+                        'job': self.id,
+                        'skipped': first - index,
+                    })
+                    index = first
+                events.extend(itertools.islice(
+                    self.events, index - first, None))
+                index = self.emitted
+                done = self.state == 'done'
+            for event in events:
+                yield event
+            # the result is always the last event
+            if done:
+                return
+
+    def summary(self):
+        summary = {
+            'job': self.id,
+            'app': self.app,
+            'tag': self.tag,
+            'state': self.state,
+            'clients': self.clients,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.result is not None:
+            summary['status'] = self.result.get('status')
+        return summary
+
+class BuildQueue(object):
+    """ Run the submitted jobs using up to ``jobs`` concurrent builds.
+
+    A request identical to a job that is queued or running is merged into
+    that job instead of queueing another build.
+
+    """
+    def __init__(self, build, jobs=1, history=100):
+        self.build = build
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.pending = collections.OrderedDict()
+        self.running = {}
+        self.finished = collections.deque(maxlen=history)
+        self.counter = 0
+        self.workers = []
+        for _ in range(max(jobs, 1)):
+            th = threading.Thread(target=self._worker)
+            th.start()
+            self.workers.append(th)
+
+    def submit(self, app, tag=None, env=None):
+        """ Queue a build of ``app`` or join an identical one.
+
+        Returns the :class:`BuildJob` and whether it is shared with an
+        earlier request. Raises a ``ValueError`` if the app is invalid.
+
+        """
+        env = env or {}
+        key = job_key(app, tag, env)
+        with self.lock:
+            for job in list(self.pending.values()) + list(
+                self.running.values()
+            ):
+                if job.key == key:
+                    job.clients += 1
+                    log.info('merged request into job=%s clients=%d',
+                             job.id, job.clients)
+                    return job, True
+            self.counter += 1
+            job = BuildJob(
+                '{0}-{1}'.format(int(time.time()), self.counter),
+                key, app, tag=tag, env=env)
+            self.pending[job.id] = job
+        log.info('queued job=%s app=%s', job.id, app)
+        self.queue.put(job)
+        return job, False
+
+    def position(self, job):
+        with self.lock:
+            ids = list(self.pending)
+        return ids.index(job.id) if job.id in ids else 0
+
+    def jobs(self):
+        with self.lock:
+            return list(self.finished) + [
+                job.summary()
+                for job in (
+                    list(self.running.values()) +
+                    list(self.pending.values())
+                )
+            ]
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                if self.pending.pop(job.id, None) is None:
+                    # cancelled by close
+                    continue
+                self.running[job.id] = job
+            log.info('starting job=%s app=%s', job.id, job.app)
+            job.start()
+            try:
+                result = self.build(job)
+            except Exception as ex:
+                log.exception('job=%s failed', job.id)
+                result = {'status': -1, 'error': str(ex)}
+            job.finish(result)
+            # only a summary is kept such that the log may be released once
+            # the clients have received it
+            with self.lock:
+                self.running.pop(job.id, None)
+                self.finished.append(job.summary())
+            log.info('finished job=%s status=%s', job.id, result['status'])
+
+    def close(self):
+        """ Cancel the queued jobs and wait for the running jobs."""
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for job in pending:
+            job.finish({'status': -1, 'error': 'the daemon is shutting down'})
+        # the workers skip the cancelled jobs
+        for _ in self.workers:
+            self.queue.put(None)
+        for th in self.workers:
+            th.join()
+
+def job_key(app, tag, env):
+    """ A digest identifying builds of ``app`` with identical inputs."""
+    steps = parse_build_steps_from_file(os.path.join(app, 'meta.yml'))
+    steps.context_path = app
+    h = hashlib.sha256()
+    steps.update_digest(h)
+    h.update(json.dumps([app, tag, sorted(env.items())]).encode('utf8'))
+    return h.hexdigest()
+
+class BuildRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.debug('request ' + format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/jobs':
+            return self.send_json({'jobs': self.server.jobs.jobs()})
+        self.send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/builds':
+            return self.send_json({'error': 'not found'}, status=404)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf8'))
+            app = os.path.abspath(request['app'])
+            env = request.get('env') or {}
+            if not isinstance(env, dict):
+                raise ValueError('env must be an object')
+            job, shared = self.server.jobs.submit(
+                app,
+                tag=request.get('tag'),
+                env=dict((str(k), str(v)) for k, v in env.items()),
+            )
+        except (KeyError, TypeError, ValueError, IOError) as ex:
+            return self.send_json(
+                {'error': 'invalid request: {0}'.format(ex)}, status=400)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            self.write_event({
+                'event': 'queued',
+                'job': job.id,
+                'shared': shared,
+                'position': self.server.jobs.position(job),
+            })
+            for event in job.follow():
+                self.write_event(event)
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (IOError, socket.error):
+            # the build continues for the other clients
+            log.info('client disconnected from job=%s', job.id)
+        self.close_connection = True
+
+    def write_event(self, event):
+        data = json.dumps(event).encode('utf8') + b'\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class UnixBuildServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, path, jobs):
+        self.jobs = jobs
+        socketserver.UnixStreamServer.__init__(
+            self, path, BuildRequestHandler)
+
+    def get_request(self):
+        # the handler expects a (host, port) client address
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        return request, ('local', 0)
+
+class TCPBuildServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, address, jobs):
+        self.jobs = jobs
+        socketserver.TCPServer.__init__(self, address, BuildRequestHandler)
@@ -0,0 +1,107 @@
+""" A client of the build daemon started by ``marina serve``.
+
+This module does not import docker such that submitting a build is fast.
+
+"""
+from http.client import HTTPConnection
+import json
+import os
+import os.path
+import socket
+import tempfile
+
+from .utils import parse_build_env
+
+log = __import__('logging').getLogger(__name__)
+
+def default_socket_path():
+    """ The unix socket used by ``marina serve`` and ``marina submit``."""
+    path = os.environ.get('MARINA_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'marina.sock')
+    return os.path.join(
+        tempfile.gettempdir(), 'marina-{0}.sock'.format(os.getuid()))
+
+def main(cli, args):
+    env = parse_build_env(cli, args)
+    if args.connect:
+        host, _, port = args.connect.rpartition(':')
+        try:
+            conn = HTTPConnection(host or '127.0.0.1', int(port))
+        except ValueError:
+            cli.abort('The --connect option must be of the form HOST:PORT.')
+        address = args.connect
+    else:
+        address = args.socket or default_socket_path()
+        conn = UnixHTTPConnection(address)
+
+    result = None
+    try:
+        for event in submit_build(conn, args.app, tag=args.tag, env=env):
+            kind = event.get('event')
+            if kind == 'log':
+                cli.out(event['data'])
+            elif kind == 'queued':
+                log.info('submitted job=%s shared=%s position=%s',
+                         event['job'], event['shared'], event['position'])
+                if event['shared']:
+                    cli.out('joined build job={0}\n'.format(event['job']))
+            elif kind == 'truncated':
+                cli.out('[{0} earlier events of job={1} were discarded]\n'
+                        .format(event['skipped'], event['job']))
+            elif kind == 'result':
+                result = event
+    except (IOError, socket.error) as ex:
+        cli.abort('Could not connect to the daemon at "{0}": {1}'.format(
+            address, ex))
+    except RuntimeError as ex:
+        cli.abort('The daemon rejected the build: {0}'.format(ex))
+    finally:
+        conn.close()
+
+    if result is None:
+        cli.abort('The daemon closed the connection before the build was '
+                  'complete.')
+    if result['status'] != 0:
+        if result.get('error'):
+            cli.error(result['error'])
+        return -1
+    return 0
+
+class UnixHTTPConnection(HTTPConnection):
+    """ An http connection to a daemon listening on a unix socket."""
+    def __init__(self, path, timeout=None):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def submit_build(conn, app, tag=None, env=None):
+    """ Submit a build to the daemon using the http ``conn``.
+
+    Yields each event of the build as it is received.
+
+    """
+    body = json.dumps({
+        'app': os.path.abspath(app),
+        'tag': tag,
+        'env': env or {},
+    }).encode('utf8')
+    conn.request('POST', '/builds', body=body, headers={
+        'Content-Type': 'application/json',
+    })
+    response = conn.getresponse()
+    if response.status != 200:
+        data = json.loads(response.read().decode('utf8') or '{}')
+        raise RuntimeError(data.get('error') or response.reason)
+    while True:
+        line = response.readline()
+        if not line:
+            break
+        yield json.loads(line.decode('utf8'))
@@ -1,5 +1,19 @@
+import fnmatch
+import hashlib
+import io
+import os
+import posixpath
+import shutil
+import stat
 import tarfile
 import tempfile
+import time
+from concurrent.futures import wait as wait_for_futures
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 def tar(path):
     f = tempfile.NamedTemporaryFile()
@@ -8,3 +22,479 @@ def tar(path):
     t.close()
     f.seek(0)
     return f
+
+def walk_tree(path, ignore=None):
+    """ Yield ``(relpath, fullpath)`` for every entry below ``path``.
+
+    Entries are yielded in a stable order so that the output may be used
+    to compute digests. Symlinks are reported but never followed.
+
+    ``ignore`` may be a callable accepting a relative path and returning
+    ``True`` if the entry should be skipped. Ignored folders are not
+    traversed.
+
+    """
+    for root, dirs, files in os.walk(path):
+        relroot = os.path.relpath(root, path)
+        names = []
+        for name in sorted(dirs) + sorted(files):
+            relpath = os.path.normpath(os.path.join(relroot, name))
+            if ignore is not None and ignore(relpath):
+                continue
+            names.append(name)
+            yield relpath, os.path.join(root, name)
+        dirs[:] = [name for name in sorted(dirs) if name in names]
+
+def hash_tree(path, h=None, ignore=None, chunk_size=64 * 1024):
+    """ Update the hash ``h`` with the names, types and contents of every
+    entry below ``path``.
+
+    Timestamps and ownership are ignored. Only the executable bit of the
+    mode is considered because it is the only bit preserved reliably by
+    version control systems.
+
+    """
+    if h is None:
+        h = hashlib.sha256()
+    for relpath, fullpath in walk_tree(path, ignore=ignore):
+        st = os.lstat(fullpath)
+        if stat.S_ISLNK(st.st_mode):
+            kind, extra = 'l', os.readlink(fullpath)
+        elif stat.S_ISDIR(st.st_mode):
+            kind, extra = 'd', ''
+        else:
+            kind = 'f'
+            extra = '{0}{1}'.format(
+                'x' if st.st_mode & 0o111 else '-', st.st_size)
+        h.update(u'{0}\0{1}\0{2}\0'.format(kind, relpath, extra).encode('utf8'))
+        if kind == 'f':
+            with open(fullpath, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(chunk_size), b''):
+                    h.update(chunk)
+    return h
+
+def select_paths(patterns):
+    """ Return an ``ignore`` callable for :func:`walk_tree` which skips
+    every entry except those matching one of the ``patterns``, the entries
+    within them and the folders leading to them.
+
+    The patterns are relative paths which may contain shell wildcards.
+
+    """
+    patterns = [
+        posixpath.normpath(pattern.strip('/')).split('/')
+        for pattern in patterns
+    ]
+
+    def ignore(relpath):
+        parts = relpath.replace(os.sep, '/').split('/')
+        for pattern in patterns:
+            n = min(len(parts), len(pattern))
+            if all(
+                fnmatch.fnmatchcase(parts[i], pattern[i]) for i in range(n)
+            ):
+                return False
+        return True
+    return ignore
+
+class IgnoreRules(object):
+    """ A small subset of the ``.gitignore`` syntax.
+
+    - Blank lines and lines starting with ``#`` are skipped.
+    - A leading ``!`` negates the pattern, re-including matched entries.
+    - A trailing ``/`` only matches folders.
+    - Patterns with a leading ``/`` or containing a ``/`` are anchored and
+      matched against the path relative to the root one segment at a time
+      such that ``*`` never matches a ``/``, ``**`` matches any number of
+      segments. Other patterns are matched against the name of the entry at
+      any depth.
+
+    The last matching pattern wins.
+
+    """
+    def __init__(self, root, patterns):
+        self.root = root
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+            if not pattern:
+                continue
+            if anchored:
+                pattern = pattern.split('/')
+            self.rules.append((pattern, negate, dir_only, anchored))
+
+    @classmethod
+    def from_file(cls, root, fname):
+        path = os.path.join(root, fname)
+        if not os.path.exists(path):
+            return None
+        with io.open(path, 'r', encoding='utf8') as fp:
+            return cls(root, fp.read().splitlines())
+
+    def __call__(self, relpath):
+        relpath = relpath.replace(os.sep, '/')
+        parts = relpath.split('/')
+        ignored = False
+        for pattern, negate, dir_only, anchored in self.rules:
+            if anchored:
+                matched = _match_segments(parts, pattern)
+            else:
+                matched = fnmatch.fnmatchcase(parts[-1], pattern)
+            if matched:
+                if dir_only and not os.path.isdir(
+                    os.path.join(self.root, relpath)
+                ):
+                    continue
+                ignored = not negate
+        return ignored
+
+def _match_segments(parts, pattern):
+    if not pattern:
+        return not parts
+    if pattern[0] == '**':
+        return any(
+            _match_segments(parts[i:], pattern[1:])
+            for i in range(len(parts) + 1)
+        )
+    return (
+        bool(parts) and
+        fnmatch.fnmatchcase(parts[0], pattern[0]) and
+        _match_segments(parts[1:], pattern[1:])
+    )
+
+class StageStats(object):
+    """ Counters describing the work performed by :func:`stage_tree`."""
+    def __init__(self):
+        self.files = 0
+        # number of files copied or linked into the target
+
+        self.bytes = 0
+        # number of bytes copied or linked into the target
+
+        self.unchanged = 0
+        # number of files already up-to-date in the target
+
+        self.removed = 0
+        # number of stale entries deleted from the target
+
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return (
+            'files={0} bytes={1} unchanged={2} removed={3} in {4:.2f}s'
+            .format(self.files, self.bytes, self.unchanged, self.removed,
+                    self.elapsed)
+        )
+
+STAGE_MODES = ('copy', 'hardlink', 'reflink', 'sync')
+
+def stage_tree(src, dst, mode='copy', ignore=None):
+    """ Populate ``dst`` with the contents of ``src``.
+
+    ``mode`` may be one of:
+
+    - ``copy`` - copy every file into a new ``dst``.
+    - ``hardlink`` - hardlink every file into a new ``dst``, falling back
+      to a copy when crossing filesystems.
+    - ``reflink`` - clone every file into a new ``dst`` on filesystems
+      supporting copy-on-write, falling back to a copy.
+    - ``sync`` - update an existing ``dst`` in-place, only copying files
+      whose size or mtime differ and removing anything not found in
+      ``src``.
+
+    Returns a :class:`StageStats`.
+
+    """
+    if mode not in STAGE_MODES:
+        raise ValueError('unknown stage mode "{0}"'.format(mode))
+    start = time.time()
+    stats = StageStats()
+    if mode != 'sync' and os.path.exists(dst):
+        raise ValueError(
+            'target folder already exists, path={0}'.format(dst))
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+
+    seen = set()
+    for relpath, srcpath in walk_tree(src, ignore=ignore):
+        seen.add(relpath)
+        dstpath = os.path.join(dst, relpath)
+        st = os.lstat(srcpath)
+        if stat.S_ISDIR(st.st_mode):
+            if os.path.islink(dstpath) or (
+                os.path.exists(dstpath) and not os.path.isdir(dstpath)
+            ):
+                _remove_path(dstpath)
+            if not os.path.isdir(dstpath):
+                os.mkdir(dstpath)
+            continue
+
+        if mode == 'sync' and os.path.lexists(dstpath):
+            dst_st = os.lstat(dstpath)
+            if stat.S_ISLNK(st.st_mode):
+                if (
+                    stat.S_ISLNK(dst_st.st_mode) and
+                    os.readlink(dstpath) == os.readlink(srcpath)
+                ):
+                    stats.unchanged += 1
+                    continue
+            elif (
+                stat.S_ISREG(dst_st.st_mode) and
+                dst_st.st_size == st.st_size and
+                dst_st.st_mtime_ns == st.st_mtime_ns
+            ):
+                stats.unchanged += 1
+                continue
+            _remove_path(dstpath)
+
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(srcpath), dstpath)
+        elif mode == 'hardlink':
+            try:
+                os.link(srcpath, dstpath)
+            except OSError:
+                shutil.copy2(srcpath, dstpath)
+        else:
+            # sync and reflink both attempt to clone the file
+            clone_file(srcpath, dstpath, reflink=mode != 'copy')
+        stats.files += 1
+        stats.bytes += st.st_size
+
+    if mode == 'sync':
+        for relpath, dstpath in reversed(list(walk_tree(dst))):
+            if relpath not in seen and os.path.lexists(dstpath):
+                _remove_path(dstpath)
+                stats.removed += 1
+
+    stats.elapsed = time.time() - start
+    return stats
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def clone_file(src, dst, reflink=True):
+    """ Copy ``src`` to ``dst`` preserving the mode and timestamps.
+
+    If ``reflink`` is ``True`` the data will be shared copy-on-write with
+    ``src`` on filesystems that support it (btrfs, xfs) and otherwise
+    silently fallback to a regular copy.
+
+    """
+    if reflink and fcntl is not None:
+        try:
+            with open(src, 'rb') as src_fp:
+                with open(dst, 'wb') as dst_fp:
+                    fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except (IOError, OSError):
+            pass
+        else:
+            shutil.copystat(src, dst)
+            return
+    shutil.copy2(src, dst)
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def publish_file(src, dst, move=False, link=True, chunk_size=1024 * 1024):
+    """ Make the file at ``src`` available at ``dst``.
+
+    If ``move`` is ``True`` the file is renamed, otherwise it is hardlinked.
+    If neither is possible, for example when crossing filesystems, the file
+    is copied instead.
+
+    If ``link`` is ``False`` the file is never renamed nor hardlinked such
+    that modifying ``dst`` cannot modify ``src``. It is cloned using
+    :func:`clone_file` instead and ``src`` is removed if ``move`` is
+    ``True``.
+
+    Returns the sha256 hexdigest of the file which is computed while it is
+    copied, or by reading it back if it was renamed, linked or cloned.
+
+    """
+    h = hashlib.sha256()
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        if not link:
+            clone_file(src, dst)
+            if move:
+                os.unlink(src)
+        elif move:
+            os.rename(src, dst)
+        else:
+            os.link(src, dst)
+    except OSError:
+        if not link:
+            raise
+        with io.open(src, 'rb') as src_fp:
+            with io.open(dst, 'wb') as dst_fp:
+                for chunk in iter(lambda: src_fp.read(chunk_size), b''):
+                    h.update(chunk)
+                    dst_fp.write(chunk)
+        shutil.copymode(src, dst)
+        if move:
+            os.unlink(src)
+    else:
+        with io.open(dst, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def write_checksum_file(path, digest):
+    """ Write a ``<path>.sha256`` file compatible with ``sha256sum -c``."""
+    checksum_path = path + '.sha256'
+    with io.open(checksum_path, 'w') as fp:
+        fp.write(u'{0}  {1}\n'.format(digest, os.path.basename(path)))
+    return checksum_path
+
+def match_tar_member(name, paths):
+    """ Return ``True`` if the member ``name`` of a tarball is one of the
+    ``paths`` or is contained within one of them.
+
+    """
+    name = name.rstrip('/')
+    for path in paths:
+        if name == path or name.startswith(path + '/'):
+            return True
+    return False
+
+def split_tarball(src, groups):
+    """ Split the tarball at ``src`` into several uncompressed tarballs.
+
+    ``groups`` is a list of ``(dst, paths)`` tuples. Each member is written
+    to the tarball of the first group containing it, see
+    :func:`match_tar_member`, and members outside of every group are
+    written to the last one. The member headers are copied as-is such that
+    the output is identical for identical input.
+
+    The parent folders of each member are written to every tarball in
+    which they are missing, with a fixed modification time, such that a
+    group never depends on the folders written to another group. Otherwise
+    docker would create them with the current time and the layer would
+    change on every build.
+
+    Returns the number of members written to each group.
+
+    """
+    counts = [0] * len(groups)
+    outputs = []
+    written = [set() for _ in groups]
+    folders = {}
+    try:
+        for dst, _ in groups:
+            outputs.append(tarfile.open(dst, 'w', format=tarfile.PAX_FORMAT))
+        with tarfile.open(src, 'r|*') as tf:
+            for member in tf:
+                index = len(groups) - 1
+                for i, (_, paths) in enumerate(groups):
+                    if match_tar_member(member.name, paths):
+                        index = i
+                        break
+                name = member.name.rstrip('/')
+                parts = name.split('/')
+                for i in range(1, len(parts)):
+                    parent = '/'.join(parts[:i])
+                    if parent in ('', '.') or parent in written[index]:
+                        continue
+                    outputs[index].addfile(
+                        _folder_member(parent, folders.get(parent)))
+                    written[index].add(parent)
+                if member.isdir():
+                    folders[name] = member
+                    written[index].add(name)
+                fileobj = tf.extractfile(member) if member.isreg() else None
+                outputs[index].addfile(member, fileobj)
+                counts[index] += 1
+    finally:
+        for output in outputs:
+            output.close()
+    return counts
+
+def _folder_member(name, source=None):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = source.mode if source is not None else 0o755
+    info.uid = source.uid if source is not None else 0
+    info.gid = source.gid if source is not None else 0
+    info.mtime = 0
+    return info
+
+def wait_for_future(future, poll_interval=0.1):
+    """ Wait for the result of a future.
+
+    This avoids blocking the main thread as it would also block signal
+    handlers like KeyboardInterrupt.
+
+    """
+    while not future.done():
+        wait_for_futures([future], timeout=poll_interval)
+    return future.result()
+
+SIZE_UNITS = {
+    '': 1,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+}
+
+def parse_build_env(cli, args):
+    """ Parse the ``--env`` variables passed to the build containers."""
+    env = {}
+    for entry in args.env:
+        parts = entry.split('=', 1)
+        if len(parts) != 2:
+            cli.abort(
+                'Environment variables must follow the KEY=VALUE '
+                'format. Invalid entry: "{0}".'.format(entry))
+        k, v = parts
+        env[k] = v
+    return env
+
+def parse_size(value):
+    """ Parse a size such as ``512M`` or ``2GiB`` into a number of bytes.
+
+    Units are powers of 1024. Returns ``None`` if ``value`` is ``None``.
+
+    """
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value
+    text = str(value).strip().lower()
+    for suffix in ('ib', 'b'):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            break
+    unit = text[-1:] if text[-1:].isalpha() else ''
+    if unit not in SIZE_UNITS:
+        raise ValueError('invalid size "{0}"'.format(value))
+    number = text[:-1] if unit else text
+    try:
+        return int(float(number) * SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError('invalid size "{0}"'.format(value))
+
+def format_size(num_bytes):
+    """ Format a number of bytes for humans."""
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(num_bytes) < 1024:
+            break
+        num_bytes /= 1024.0
+    else:
+        unit = 'T'
+    if unit == 'B':
+        return '{0}B'.format(int(num_bytes))
+    return '{0:.1f}{1}'.format(num_bytes, unit)
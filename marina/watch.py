@@ -0,0 +1,383 @@
+import collections
+import ctypes
+import ctypes.util
+import os
+import os.path
+import select
+import struct
+import sys
+import time
+
+from .artifacts import ArtifactStore
+from .build import ImagePuller
+from .build import make_builder
+from .build import make_engine
+from .build import parse_build_steps_from_file
+from .build import run_builder
+from .cli import AbortCLI
+from .pool import ContainerPool
+from .utils import parse_build_env
+from .utils import parse_size
+from .utils import walk_tree
+
+log = __import__('logging').getLogger(__name__)
+
+def main(cli, args):
+    if args.archive:
+        cli.abort('The --archive option is not supported when watching.')
+    if args.timeout is not None:
+        # the build script is exec'd without the engine in a warm container
+        cli.abort('The --timeout option is not supported when watching.')
+    context_path = os.path.normpath(args.app)
+    try:
+        steps = parse_build_steps_from_file(
+            os.path.join(context_path, 'meta.yml'))
+    except ValueError as ex:
+        cli.abort('Invalid meta.yml in app "{0}": {1}'.format(
+            args.app, ex.args[0]))
+    steps.context_path = context_path
+
+    env = parse_build_env(cli, args)
+    if not args.tag:
+        args.tag = 'dev'
+    # only the changed files are staged and the commands are exec'd in a
+    # warm compile container kept for the lifetime of the watch
+    args.stage_mode = 'sync'
+    args.single_pass = True
+    container_pool = ContainerPool(
+        max_uses=args.warm_pool_max_uses,
+        idle_timeout=None,
+    )
+    puller = ImagePuller(policy=args.pull)
+    artifact_store = None
+    if args.artifact_store:
+        try:
+            artifact_store = ArtifactStore(
+                args.artifact_store,
+                max_size=parse_size(args.artifact_store_max_size),
+            )
+        except ValueError as ex:
+            cli.abort(ex.args[0])
+
+    engine = make_engine(cli, args)
+
+    def build():
+        try:
+            builder = make_builder(
+                cli, args, args.app,
+                env=env,
+                puller=puller,
+                artifact_store=artifact_store,
+                container_pool=container_pool,
+                engine=engine,
+            )
+        except AbortCLI:
+            # the error, such as an invalid meta.yml, was already reported
+            return -1, None
+        return run_builder(builder), builder
+
+    def watch():
+        ignore = make_watch_ignore(
+            context_path, args.build_dir, steps.get_context_ignore())
+        watcher = make_watcher(
+            context_path, ignore=ignore, poll=args.poll,
+            interval=args.poll_interval,
+        )
+        log.info('watching path=%s using %s', context_path,
+                 watcher.__class__.__name__)
+        return watcher
+
+    watcher = watch()
+
+    cycle = 0
+    changes, first_change = [], time.time()
+    try:
+        while True:
+            start = time.time()
+            ret, builder = build()
+            end = time.time()
+            cli.out('cycle={0} status={1} changes={2} build={3:.2f}s '
+                    'latency={4:.2f}s {5}\n'.format(
+                        cycle,
+                        'ok' if ret == 0 else 'failed',
+                        len(changes),
+                        end - start,
+                        end - first_change,
+                        format_phases(builder.metrics if builder else None),
+                    ))
+            cli.out('watching for changes in {0}\n'.format(context_path))
+            cycle += 1
+            changes, first_change = wait_for_changes(watcher, args.debounce)
+            log.info('detected changes=%s', ', '.join(changes[:10]))
+            if steps.ignore_file in changes:
+                # the folders watched depend upon the ignore rules
+                log.info('reloading the rules from %s', steps.ignore_file)
+                watcher.close()
+                watcher = watch()
+    except KeyboardInterrupt:
+        log.info('stopped watching')
+    finally:
+        watcher.close()
+        with cli.docker_pool.client() as client:
+            container_pool.close(client)
+        if engine is not None:
+            engine.close()
+    return 0
+
+def format_phases(metrics, names=('setup', 'compile', 'image')):
+    durations = collections.OrderedDict((name, 0.0) for name in names)
+    for phase in metrics.phases if metrics is not None else []:
+        # the phases of compile steps and run variants are prefixed
+        name = phase.name.rpartition(':')[2]
+        if name in durations and phase.duration is not None:
+            durations[name] += phase.duration
+    return ' '.join(
+        '{0}={1:.2f}s'.format(name, duration)
+        for name, duration in durations.items()
+    )
+
+def make_watch_ignore(context_path, build_dir, rules=None):
+    """ Return an ``ignore`` callable for the watchers.
+
+    Paths matched by the ``.marinaignore`` ``rules`` are ignored, as are
+    the build directories and the staged context if the build directory is
+    within the context.
+
+    """
+    build_root = os.path.relpath(
+        os.path.abspath(build_dir), os.path.abspath(context_path))
+    if build_root == os.curdir:
+        build_root = ''
+    elif build_root.startswith(os.pardir):
+        build_root = None
+
+    def ignore(relpath):
+        if build_root is not None:
+            parent, name = os.path.split(relpath)
+            if parent == build_root and name.startswith('.marina-'):
+                return True
+        return rules is not None and rules(relpath)
+    return ignore
+
+def wait_for_changes(watcher, delay):
+    """ Wait for the tree to change and then until it has not changed for
+    ``delay`` seconds.
+
+    Returns the sorted relative paths that changed and the time of the
+    first change. An empty path means the entire tree may have changed.
+
+    """
+    changes = set()
+    while not changes:
+        changes.update(watcher.wait())
+    first_change = time.time()
+    while True:
+        more = watcher.wait(timeout=delay)
+        if not more:
+            return sorted(changes), first_change
+        changes.update(more)
+
+def make_watcher(path, ignore=None, poll=False, interval=0.5):
+    """ Return an :class:`InotifyWatcher` if inotify is available and a
+    :class:`PollingWatcher` otherwise.
+
+    """
+    if not poll:
+        libc = load_inotify()
+        if libc is not None:
+            try:
+                return InotifyWatcher(path, ignore=ignore, libc=libc)
+            except OSError as ex:
+                log.warn('failed to watch using inotify, falling back to '
+                         'polling: %s', ex)
+    return PollingWatcher(path, ignore=ignore, interval=interval)
+
+def load_inotify():
+    """ Load the inotify functions from libc or return ``None``."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        log.debug('inotify is not available', exc_info=True)
+        return None
+    return libc
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+class InotifyWatcher(object):
+    """ Watch a tree for changes using inotify.
+
+    A watch is added for every folder in the tree, including the folders
+    created after the watcher started.
+
+    """
+    mask = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    )
+
+    event_struct = struct.Struct('iIII')
+
+    def __init__(self, path, ignore=None, libc=None):
+        self.path = path
+        self.ignore = ignore
+        self.libc = libc or load_inotify()
+        if self.libc is None:
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watches = {}
+        try:
+            self._add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def _add_tree(self, relpath):
+        pending = [relpath]
+        while pending:
+            relpath = pending.pop()
+            fullpath = os.path.join(self.path, relpath)
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(fullpath), self.mask | IN_ONLYDIR)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno == 28:
+                    # ENOSPC, see fs.inotify.max_user_watches
+                    raise OSError(errno, 'too many folders to watch')
+                # removed before it could be watched
+                continue
+            self.watches[wd] = relpath
+            try:
+                names = sorted(os.listdir(fullpath))
+            except OSError:
+                continue
+            for name in names:
+                child = os.path.join(relpath, name) if relpath else name
+                childpath = os.path.join(self.path, child)
+                if (
+                    os.path.isdir(childpath) and
+                    not os.path.islink(childpath) and
+                    not self._ignored(child)
+                ):
+                    pending.append(child)
+
+    def _ignored(self, relpath):
+        return self.ignore is not None and self.ignore(relpath)
+
+    def wait(self, timeout=None):
+        """ Wait up to ``timeout`` seconds for changes.
+
+        Returns the relative paths that changed, which is empty if the
+        timeout elapsed.
+
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        changes = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            changes.update(self._parse(data))
+        return sorted(changes)
+
+    def _parse(self, data):
+        offset = 0
+        size = self.event_struct.size
+        while offset < len(data):
+            wd, mask, _, length = self.event_struct.unpack_from(data, offset)
+            name = os.fsdecode(
+                data[offset + size:offset + size + length].rstrip(b'\0'))
+            offset += size + length
+
+            if mask & IN_Q_OVERFLOW:
+                log.warn('missed some changes, the inotify queue overflowed')
+                yield ''
+                continue
+            parent = self.watches.get(wd)
+            if parent is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            relpath = os.path.join(parent, name) if parent else name
+            if name and self._ignored(relpath):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._add_tree(relpath)
+            yield relpath
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class PollingWatcher(object):
+    """ Watch a tree for changes by comparing the size, mode and
+    modification time of every entry each ``interval`` seconds.
+
+    """
+    def __init__(self, path, ignore=None, interval=0.5):
+        self.path = path
+        self.ignore = ignore
+        self.interval = interval
+        self.state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for relpath, fullpath in walk_tree(self.path, ignore=self.ignore):
+            try:
+                st = os.lstat(fullpath)
+            except OSError:
+                continue
+            state[relpath] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        return state
+
+    def wait(self, timeout=None):
+        """ Wait up to ``timeout`` seconds for changes.
+
+        Returns the relative paths that changed, which is empty if the
+        timeout elapsed.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._scan()
+            changes = sorted(
+                relpath
+                for relpath in set(state).union(self.state)
+                if state.get(relpath) != self.state.get(relpath)
+            )
+            self.state = state
+            if changes:
+                return changes
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+                if delay <= 0:
+                    return []
+            time.sleep(delay)
+
+    def close(self):
+        pass
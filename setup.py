@@ -13,7 +13,6 @@ with open(os.path.join(here, 'CHANGES.rst')) as fp:
 requires = [
     'docker >= 3.0',
     'PyYAML',
-    'setuptools',
     'subparse',
 ]
 
@@ -39,6 +38,7 @@ setup(
         "Intended Audience :: Developers",
         "Intended Audience :: System Administrators",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 3",
         "Topic :: System :: Installation/Setup",
         "Topic :: System :: Software Distribution",
         "Topic :: System :: Systems Administration",
@@ -46,6 +46,7 @@ setup(
     keywords='docker devops deploy build orchestration',
     packages=find_packages(exclude=['tests']),
     include_package_data=True,
+    python_requires='>=3.8',
     install_requires=requires,
     tests_require=tests_require,
     extras_require={
@@ -0,0 +1,240 @@
+""" Benchmarks of marina's own overhead using a fake docker daemon.
+
+Run from the root of the repository::
+
+    python tests/bench_build.py [--repeat N] [--json] [scenario ...]
+
+The fake daemon (see ``fakedocker.py``) does not run anything, it simply
+streams output of a configurable size, so the timings measure the work
+done by marina itself. Each scenario runs in a new process against a
+daemon served by another process such that the reported cpu time and peak
+rss only include the build.
+
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.abspath(os.path.dirname(__file__))
+dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+
+MB = 1024 * 1024
+
+SCENARIOS = {
+    'baseline': {
+        'description': 'a single build of the dummy app',
+        'server': {},
+        'argv': ['build', '--force', '{app}'],
+    },
+    'builder': {
+        'description': 'DockerBuilder.run without the cli',
+        'server': {},
+        'builder': True,
+    },
+    'large-output': {
+        'description': '256MB of compile output',
+        'server': {'attach_size': 256 * MB},
+        'argv': ['build', '--force', '{app}'],
+    },
+    'large-output-asyncio': {
+        'description': '256MB of compile output using --engine=asyncio',
+        'server': {'attach_size': 256 * MB},
+        'argv': ['build', '--force', '--engine', 'asyncio', '{app}'],
+    },
+    'chatty-image-build': {
+        'description': '100k lines of image build output',
+        'server': {'build_lines': 100000},
+        'argv': ['build', '--force', '{app}'],
+    },
+    'parallel': {
+        'description': '32 apps built using 16 workers',
+        'server': {'latency': 0.2},
+        'apps': 32,
+        'argv': ['build', '--force', '-j', '16', '{apps}'],
+    },
+    'parallel-asyncio': {
+        'description': '32 apps built using 16 workers and --engine=asyncio',
+        'server': {'latency': 0.2},
+        'apps': 32,
+        'argv': [
+            'build', '--force', '-j', '16', '--engine', 'asyncio', '{apps}',
+        ],
+    },
+    'big-archive': {
+        'description': 'a 512MB archive streamed out of a container',
+        'server': {'attach_size': 512 * MB},
+        'argv': [
+            'build', '--archive-only', '--archive', '{tmp}/app.tar.gz',
+            '{app}',
+        ],
+    },
+    'big-archive-host-dist': {
+        'description': 'a 512MB archive read from a host-bound dist folder',
+        'server': {'archive_size': 512 * MB},
+        'argv': [
+            'build', '--archive-only', '--host-dist',
+            '--archive', '{tmp}/app.tar.gz', '{app}',
+        ],
+    },
+}
+
+def make_apps(tmp, count):
+    apps = []
+    for i in range(count):
+        path = os.path.join(tmp, 'app-{0}'.format(i))
+        shutil.copytree(dummy_path, path)
+        meta_path = os.path.join(path, 'meta.yml')
+        with open(meta_path) as fp:
+            meta = fp.read()
+        with open(meta_path, 'w') as fp:
+            fp.write(meta.replace('name: dummy', 'name: dummy{0}'.format(i)))
+        apps.append(path)
+    return apps
+
+def usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    maxrss = usage.ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return usage.ru_utime + usage.ru_stime, maxrss
+
+def run_scenario(name, tmp):
+    """ Run the scenario in the current process and report the usage."""
+    scenario = SCENARIOS[name]
+    apps = make_apps(tmp, scenario.get('apps', 1))
+    devnull = open(os.devnull, 'w')
+
+    start_cpu, _ = usage()
+    start = time.perf_counter()
+    if scenario.get('builder'):
+        import docker
+        import logging
+        from marina.build import DockerBuilder
+        from marina.build import parse_build_steps_from_file
+
+        logging.basicConfig(level=logging.ERROR)
+        steps = parse_build_steps_from_file(os.path.join(apps[0], 'meta.yml'))
+        steps.root_path = tmp
+        steps.context_path = apps[0]
+        builder = DockerBuilder(steps, lambda: docker.from_env().api)
+        builder.stdout = devnull.write
+        builder.skip_unchanged = False
+        builder.cache_volume = steps.name + '__buildcache'
+        builder.cache_path = '/tmp/cache'
+        builder.run()
+        rc = 0
+    else:
+        from marina.cli import main
+
+        argv = []
+        for arg in scenario['argv']:
+            if arg == '{apps}':
+                argv.extend(apps)
+            else:
+                argv.append(arg.format(app=apps[0], tmp=tmp))
+        rc = main(argv[:1] + ['--build-dir', tmp] + argv[1:])
+    wall = time.perf_counter() - start
+    cpu, maxrss = usage()
+    return {
+        'scenario': name,
+        'rc': rc,
+        'wall': wall,
+        'cpu': cpu - start_cpu,
+        'maxrss': maxrss,
+    }
+
+def start_server(tmp, knobs):
+    path = os.path.join(tmp, 'docker.sock')
+    cmd = [sys.executable, os.path.join(here, 'fakedocker.py'), path]
+    for k, v in sorted(knobs.items()):
+        cmd.extend(['--' + k.replace('_', '-'), str(v)])
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    # the server writes the path of the socket once it is ready
+    proc.stdout.readline()
+    return proc, path
+
+def bench(name):
+    tmp = tempfile.mkdtemp()
+    try:
+        server, path = start_server(tmp, SCENARIOS[name]['server'])
+        try:
+            env = dict(os.environ, DOCKER_HOST='unix://' + path)
+            # the output of the build is discarded
+            subprocess.check_call(
+                [sys.executable, __file__, '--child', name, tmp],
+                env=env,
+                stdout=subprocess.DEVNULL,
+            )
+        finally:
+            server.terminate()
+            server.wait()
+        with open(os.path.join(tmp, 'result.json')) as fp:
+            return json.load(fp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument(
+        'scenario',
+        nargs='*',
+        help='The scenarios to run. Defaults to all of them: {0}.'.format(
+            ', '.join(sorted(SCENARIOS))),
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Run each scenario several times and report the fastest.',
+    )
+    parser.add_argument(
+        '--json',
+        action='store_true',
+        help='Write the results as JSON.',
+    )
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        name, tmp = args.child
+        result = run_scenario(name, tmp)
+        with open(os.path.join(tmp, 'result.json'), 'w') as fp:
+            json.dump(result, fp)
+        return 0
+
+    names = args.scenario or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario "{0}"'.format(name))
+
+    results = []
+    if not args.json:
+        print('{0:<24} {1:>8} {2:>8} {3:>10}  {4}'.format(
+            'scenario', 'wall', 'cpu', 'maxrss', 'description'))
+    for name in names:
+        runs = [bench(name) for _ in range(args.repeat)]
+        result = min(runs, key=lambda r: r['wall'])
+        results.append(result)
+        if not args.json:
+            print('{0:<24} {1:>7.3f}s {2:>7.3f}s {3:>8.1f}MB  {4}{5}'.format(
+                name,
+                result['wall'],
+                result['cpu'],
+                result['maxrss'] / MB,
+                SCENARIOS[name]['description'],
+                '' if result['rc'] == 0 else ' (failed)',
+            ))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import pytest
+
+@pytest.fixture
+def fake_docker(tmpdir, monkeypatch):
+    """ Run a fake docker daemon and point ``DOCKER_HOST`` at it."""
+    import fakedocker
+    path = str(tmpdir.join('docker.sock'))
+    with fakedocker.serve(path) as server:
+        monkeypatch.setenv('DOCKER_HOST', 'unix://' + path)
+        yield server
@@ -0,0 +1,794 @@
+""" A stand-in for the docker engine api served over a local unix socket.
+
+The server implements just enough of the api for :class:`marina.build.
+DockerBuilder` to run a complete build. Containers do not execute anything,
+they simply stream a configurable amount of output to any attached clients
+and exit with a configurable status code.
+
+"""
+import argparse
+import base64
+from contextlib import contextmanager
+import hashlib
+import io
+import json
+import os
+import re
+import signal
+import socketserver
+import struct
+import tarfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+API_VERSION = '1.41'
+
+class FakeDockerState(object):
+    """ The simulated daemon state and the knobs used to shape the output."""
+    attach_size = 1024
+    # number of bytes streamed to each attached client per container
+
+    chunk_size = 16 * 1024
+    # size of each multiplexed frame written to attached clients
+
+    build_lines = 10
+    # number of ``stream`` events emitted per image build
+
+    archive_size = 1024
+    # size of the file returned when fetching an archive from a container
+
+    archive_data = None
+    # the content of the slug written to a host-bound dist folder instead
+    # of archive_size bytes, such as a real tarball
+
+    pull_lines = 5
+    # number of progress events emitted per image pull
+
+    stderr_size = 0
+    # size of the stderr output of an attached container, written after
+    # the stdout output
+
+    exit_code = 0
+    # status code reported by every container
+
+    exit_codes = None
+    # a function returning the status code of a container given its
+    # config, or None to report exit_code
+
+    archive_codec = 'gzip'
+    # the codec recorded next to the slug written to a host-bound dist
+    # folder
+
+    latency = 0.0
+    # seconds each container "runs" before exiting
+
+    log_output = ''
+    # the stdout returned when fetching the logs of any container
+
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
+        self.lock = threading.Lock()
+        self.images = {}
+        self.containers = {}
+        self.volumes = {}
+        self.execs = {}
+        self.calls = []
+        self.counter = 0
+        self.created = []
+        self.uploads = []
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            seed = '%s-%s' % (self.counter, time.time())
+        return hashlib.sha256(seed.encode('ascii')).hexdigest()
+
+    def record(self, method, path):
+        with self.lock:
+            self.calls.append((method, path))
+
+    def exit_code_of(self, container):
+        if self.exit_codes is not None:
+            ret = self.exit_codes(container.config)
+            if ret is not None:
+                return ret
+        return self.exit_code
+
+    def count(self, method, pattern):
+        return len([
+            path for m, path in self.calls
+            if m == method and re.search(pattern, path)
+        ])
+
+    def add_image(self, ref, labels=None, config=None):
+        image_id = 'sha256:' + self.next_id()
+        image = {
+            'Id': image_id,
+            'Created': self.counter,
+            'RepoTags': [ref] if ref else [],
+            'RepoDigests': [],
+            'Author': '',
+            'Config': dict({
+                'Cmd': ['/bin/bash'],
+                'Entrypoint': None,
+                'User': '',
+                'WorkingDir': '',
+                'Env': ['PATH=/usr/bin:/bin'],
+                'Volumes': None,
+                'ExposedPorts': None,
+                'Labels': labels or {},
+            }, **(config or {})),
+        }
+        with self.lock:
+            self.images[image_id] = image
+        return image
+
+    def find_image(self, ref):
+        ref = normalize_ref(ref)
+        with self.lock:
+            for image in self.images.values():
+                if (
+                    image['Id'] == ref or
+                    image['Id'].startswith('sha256:' + ref) or
+                    ref in image['RepoTags']
+                ):
+                    return image
+
+class Container(object):
+    def __init__(self, id, config):
+        self.id = id
+        self.config = config
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.attached = 0
+        self.lock = threading.Lock()
+
+def normalize_ref(ref):
+    if ref.startswith('sha256:'):
+        return ref
+    name, _, tag = ref.rpartition(':')
+    if not name or '/' in tag:
+        return ref + ':latest'
+    return ref
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'/_ping$', 'ping'),
+        ('HEAD', r'/_ping$', 'ping'),
+        ('GET', r'/version$', 'version'),
+        ('POST', r'/images/create$', 'pull'),
+        ('GET', r'/images/json$', 'list_images'),
+        ('GET', r'/images/(?P<name>.+)/json$', 'inspect_image'),
+        ('POST', r'/images/(?P<name>.+)/tag$', 'tag_image'),
+        ('DELETE', r'/images/(?P<name>.+)$', 'remove_image'),
+        ('GET', r'/distribution/(?P<name>.+)/json$', 'inspect_distribution'),
+        ('GET', r'/volumes/(?P<name>[^/]+)$', 'inspect_volume'),
+        ('POST', r'/volumes/create$', 'create_volume'),
+        ('DELETE', r'/volumes/(?P<name>[^/]+)$', 'remove_volume'),
+        ('GET', r'/volumes$', 'list_volumes'),
+        ('POST', r'/containers/create$', 'create_container'),
+        ('GET', r'/containers/json$', 'list_containers'),
+        ('GET', r'/containers/(?P<id>[^/]+)/json$', 'inspect_container'),
+        ('POST', r'/containers/(?P<id>[^/]+)/start$', 'start'),
+        ('POST', r'/containers/(?P<id>[^/]+)/attach$', 'attach'),
+        ('POST', r'/containers/(?P<id>[^/]+)/wait$', 'wait'),
+        ('POST', r'/containers/(?P<id>[^/]+)/stop$', 'stop'),
+        ('GET', r'/containers/(?P<id>[^/]+)/logs$', 'logs'),
+        ('GET', r'/containers/(?P<id>[^/]+)/archive$', 'get_archive'),
+        ('PUT', r'/containers/(?P<id>[^/]+)/archive$', 'put_archive'),
+        ('POST', r'/containers/(?P<id>[^/]+)/exec$', 'create_exec'),
+        ('DELETE', r'/containers/(?P<id>[^/]+)$', 'remove_container'),
+        ('POST', r'/exec/(?P<id>[^/]+)/start$', 'start_exec'),
+        ('GET', r'/exec/(?P<id>[^/]+)/json$', 'inspect_exec'),
+        ('POST', r'/commit$', 'commit'),
+        ('POST', r'/build$', 'build'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self.state.record(method, path)
+        for route_method, pattern, name in self.routes:
+            if route_method != method:
+                continue
+            match = re.match(pattern, path)
+            if match:
+                kw = {k: unquote(v) for k, v in match.groupdict().items()}
+                return getattr(self, name)(**kw)
+        self.send_json({'message': 'not found: %s' % path}, status=404)
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = io.BytesIO()
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+            return body.getvalue()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def read_json(self):
+        body = self.read_body()
+        return json.loads(body.decode('utf8')) if body else {}
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status=204):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def not_found(self, what):
+        self.send_json({'message': 'No such %s' % what}, status=404)
+
+    def start_chunked(self, content_type='application/json', headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def end_chunked(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def stream_events(self, events):
+        self.start_chunked()
+        for event in events:
+            self.write_chunk(json.dumps(event).encode('utf8') + b'\r\n')
+        self.end_chunked()
+
+    def upgrade(self):
+        self.read_body()
+        self.send_response(101)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Upgrade', 'tcp')
+        self.end_headers()
+        self.wfile.flush()
+        self.close_connection = True
+
+    def write_frames(self, size):
+        for stream, size, fill in (
+            (1, size, b'x'),
+            (2, self.state.stderr_size, b'e'),
+        ):
+            chunk = fill * (self.state.chunk_size - 1) + b'\n'
+            remaining = size
+            while remaining > 0:
+                data = chunk[:remaining]
+                self.wfile.write(
+                    struct.pack('>BxxxL', stream, len(data)) + data)
+                remaining -= len(data)
+        self.wfile.flush()
+
+    # system
+
+    def ping(self):
+        body = b'OK'
+        self.send_response(200)
+        self.send_header('Api-Version', API_VERSION)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def version(self):
+        self.send_json({
+            'Version': '20.10.0',
+            'ApiVersion': API_VERSION,
+            'MinAPIVersion': '1.12',
+            'Os': 'linux',
+            'Arch': 'amd64',
+        })
+
+    # images
+
+    def pull(self):
+        ref = self.query['fromImage']
+        if self.query.get('tag'):
+            ref = '%s:%s' % (ref, self.query['tag'])
+        ref = normalize_ref(ref)
+        if not self.state.find_image(ref):
+            self.state.add_image(ref)
+        self.stream_events(
+            [{'status': 'Pulling from %s' % ref}] +
+            [
+                {'status': 'Downloading', 'progressDetail': {}, 'id': str(i)}
+                for i in range(self.state.pull_lines)
+            ] +
+            [{'status': 'Status: Image is up to date for %s' % ref}]
+        )
+
+    def list_images(self):
+        filters = json.loads(self.query.get('filters') or '{}')
+        labels = filters.get('label') or []
+        if isinstance(labels, dict):
+            labels = list(labels)
+        result = []
+        with self.state.lock:
+            images = list(self.state.images.values())
+        for image in images:
+            image_labels = image['Config'].get('Labels') or {}
+            ok = True
+            for label in labels:
+                k, _, v = label.partition('=')
+                if k not in image_labels or (v and image_labels[k] != v):
+                    ok = False
+            if ok:
+                result.append({
+                    'Id': image['Id'],
+                    'RepoTags': image['RepoTags'],
+                    'Labels': image_labels,
+                    'Created': image['Created'],
+                })
+        self.send_json(result)
+
+    def inspect_image(self, name):
+        image = self.state.find_image(name)
+        if not image:
+            return self.not_found('image: %s' % name)
+        self.send_json(image)
+
+    def inspect_distribution(self, name):
+        self.send_json({'Descriptor': {
+            'mediaType': 'application/vnd.docker.distribution.manifest.v2',
+            'digest': 'sha256:' + hashlib.sha256(
+                normalize_ref(name).encode('utf8')).hexdigest(),
+            'size': 1024,
+        }})
+
+    def tag_image(self, name):
+        image = self.state.find_image(name)
+        if not image:
+            return self.not_found('image: %s' % name)
+        ref = self.query['repo']
+        if self.query.get('tag'):
+            ref = '%s:%s' % (ref, self.query['tag'])
+        with self.state.lock:
+            for other in self.state.images.values():
+                if ref in other['RepoTags']:
+                    other['RepoTags'].remove(ref)
+            image['RepoTags'].append(normalize_ref(ref))
+        self.send_empty(201)
+
+    def remove_image(self, name):
+        image = self.state.find_image(name)
+        if not image:
+            return self.not_found('image: %s' % name)
+        with self.state.lock:
+            self.state.images.pop(image['Id'], None)
+        self.send_json([{'Deleted': image['Id']}])
+
+    # volumes
+
+    def inspect_volume(self, name):
+        with self.state.lock:
+            volume = self.state.volumes.get(name)
+        if not volume:
+            return self.not_found('volume: %s' % name)
+        self.send_json(volume)
+
+    def create_volume(self):
+        data = self.read_json()
+        volume = {
+            'Name': data.get('Name') or self.state.next_id(),
+            'Driver': data.get('Driver') or 'local',
+            'Options': data.get('DriverOpts') or None,
+            'Labels': data.get('Labels') or {},
+            'Mountpoint': '/var/lib/docker/volumes/x/_data',
+        }
+        with self.state.lock:
+            self.state.volumes[volume['Name']] = volume
+        self.send_json(volume, status=201)
+
+    def remove_volume(self, name):
+        with self.state.lock:
+            volume = self.state.volumes.pop(name, None)
+        if not volume:
+            return self.not_found('volume: %s' % name)
+        self.send_empty()
+
+    def list_volumes(self):
+        filters = json.loads(self.query.get('filters') or '{}')
+        labels = filters.get('label') or []
+        with self.state.lock:
+            volumes = list(self.state.volumes.values())
+        result = []
+        for volume in volumes:
+            ok = True
+            for label in labels:
+                k, _, v = label.partition('=')
+                if k not in volume['Labels'] or (
+                    v and volume['Labels'][k] != v
+                ):
+                    ok = False
+            if ok:
+                result.append(volume)
+        self.send_json({'Volumes': result, 'Warnings': None})
+
+    # containers
+
+    def get_container(self, id):
+        with self.state.lock:
+            return self.state.containers.get(id)
+
+    def create_container(self):
+        config = self.read_json()
+        if not self.state.find_image(config['Image']):
+            return self.not_found('image: %s' % config['Image'])
+        container = Container(self.state.next_id(), config)
+        with self.state.lock:
+            self.state.containers[container.id] = container
+            self.state.created.append(config)
+        self.send_json({'Id': container.id, 'Warnings': None}, status=201)
+
+    def list_containers(self):
+        filters = json.loads(self.query.get('filters') or '{}')
+        labels = filters.get('label') or []
+        with self.state.lock:
+            containers = list(self.state.containers.values())
+        result = []
+        for container in containers:
+            container_labels = container.config.get('Labels') or {}
+            ok = True
+            for label in labels:
+                k, _, v = label.partition('=')
+                if k not in container_labels or (
+                    v and container_labels[k] != v
+                ):
+                    ok = False
+            if ok:
+                result.append({
+                    'Id': container.id,
+                    'Image': container.config['Image'],
+                    'Labels': container_labels,
+                    'State': (
+                        'exited' if container.exited.is_set() else
+                        'running' if container.started.is_set() else
+                        'created'
+                    ),
+                })
+        self.send_json(result)
+
+    def inspect_container(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        self.send_json({
+            'Id': container.id,
+            'Config': dict(container.config, Tty=False),
+            'State': {
+                'Running': (
+                    container.started.is_set() and
+                    not container.exited.is_set()
+                ),
+                'ExitCode': self.state.exit_code_of(container),
+            },
+        })
+
+    def start(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        self.read_body()
+        self.write_archive(container)
+        container.started.set()
+
+        def run():
+            if self.state.latency:
+                time.sleep(self.state.latency)
+            if not container.attached:
+                container.exited.set()
+
+        threading.Thread(target=run, daemon=True).start()
+        self.send_empty()
+
+    def write_archive(self, container, env=None):
+        # simulate the build script writing the slug into a host-bound
+        # dist folder, possibly below the folder of the bind
+        if env is None:
+            env = container.config.get('Env')
+        # variables without a value are not set
+        env = dict(
+            entry.split('=', 1) for entry in env or [] if '=' in entry)
+        archive_path = env.get('BUILD_ARCHIVE_PATH')
+        if not archive_path:
+            return
+        binds = (container.config.get('HostConfig') or {}).get('Binds') or []
+        for bind in binds:
+            host_path, container_path = bind.split(':')[:2]
+            if archive_path.startswith(container_path + '/'):
+                path = os.path.join(
+                    host_path, archive_path[len(container_path) + 1:])
+                data = self.state.archive_data
+                if data is None:
+                    data = b'x' * self.state.archive_size
+                with io.open(path, 'wb') as fp:
+                    fp.write(data)
+                with io.open(path + '.codec', 'w') as fp:
+                    fp.write(self.state.archive_codec + u'\n')
+
+    def attach(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        with container.lock:
+            container.attached += 1
+        self.upgrade()
+        container.started.wait()
+        try:
+            self.write_frames(self.state.attach_size)
+        finally:
+            with container.lock:
+                container.attached -= 1
+            if self.state.latency:
+                time.sleep(self.state.latency)
+            container.exited.set()
+
+    def wait(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        container.exited.wait()
+        self.send_json({'StatusCode': self.state.exit_code_of(container)})
+
+    def stop(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        container.exited.set()
+        self.send_empty()
+
+    def remove_container(self, id):
+        with self.state.lock:
+            container = self.state.containers.pop(id, None)
+        if not container:
+            return self.not_found('container: %s' % id)
+        container.exited.set()
+        self.send_empty()
+
+    def logs(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        body = b''
+        if self.query.get('stdout') in ('1', 'true', 'True'):
+            data = self.state.log_output.encode('utf8')
+            if data:
+                body = struct.pack('>BxxxL', 1, len(data)) + data
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_archive(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        path = self.query['path']
+        name = os.path.basename(path.rstrip('/.')) or 'root'
+        data = b'x' * self.state.archive_size
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tf:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+        stat = base64.b64encode(json.dumps({
+            'name': name, 'size': len(data), 'mode': 0o644,
+            'mtime': '2020-01-01T00:00:00Z', 'linkTarget': '',
+        }).encode('utf8')).decode('ascii')
+        self.start_chunked(
+            content_type='application/x-tar',
+            headers={'X-Docker-Container-Path-Stat': stat},
+        )
+        body = buf.getvalue()
+        for i in range(0, len(body), 64 * 1024):
+            self.write_chunk(body[i:i + 64 * 1024])
+        self.end_chunked()
+
+    def put_archive(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        body = self.read_body()
+        with self.state.lock:
+            self.state.uploads.append((id, self.query.get('path'), body))
+        self.send_empty(200)
+
+    # exec
+
+    def create_exec(self, id):
+        container = self.get_container(id)
+        if not container:
+            return self.not_found('container: %s' % id)
+        config = self.read_json()
+        exec_id = self.state.next_id()
+        with self.state.lock:
+            self.state.execs[exec_id] = {
+                'ID': exec_id,
+                'ContainerID': id,
+                'Config': config,
+                'Running': False,
+                'ExitCode': None,
+            }
+        self.send_json({'Id': exec_id}, status=201)
+
+    def start_exec(self, id):
+        with self.state.lock:
+            info = self.state.execs.get(id)
+        if not info:
+            return self.not_found('exec instance: %s' % id)
+        info['Running'] = True
+        self.write_archive(
+            self.get_container(info['ContainerID']),
+            env=info['Config'].get('Env'),
+        )
+        self.upgrade()
+        # give the client a chance to finish reading the response headers
+        time.sleep(0.05)
+        try:
+            self.write_frames(self.state.attach_size)
+        finally:
+            info['Running'] = False
+            info['ExitCode'] = self.state.exit_code
+
+    def inspect_exec(self, id):
+        with self.state.lock:
+            info = self.state.execs.get(id)
+        if not info:
+            return self.not_found('exec instance: %s' % id)
+        self.send_json(info)
+
+    def commit(self):
+        container = self.get_container(self.query['container'])
+        if not container:
+            return self.not_found('container: %s' % self.query['container'])
+        conf = self.read_json() or {}
+        ref = None
+        if self.query.get('repo'):
+            ref = '%s:%s' % (self.query['repo'], self.query.get('tag') or
+                             'latest')
+        # like the daemon, the configuration of the container is merged
+        # into the committed one
+        env = list(conf.get('Env') or [])
+        names = set(entry.split('=', 1)[0] for entry in env)
+        env += [
+            entry for entry in container.config.get('Env') or []
+            if entry.split('=', 1)[0] not in names
+        ]
+        labels = dict(container.config.get('Labels') or {})
+        labels.update(conf.get('Labels') or {})
+        image = self.state.add_image(ref, labels=labels, config={'Env': env})
+        self.send_json({'Id': image['Id']}, status=201)
+
+    def build(self):
+        context = self.read_body()
+        labels = json.loads(self.query.get('labels') or '{}')
+        tag = self.query.get('t')
+        image = self.state.add_image(
+            normalize_ref(tag) if tag else None, labels=labels)
+        short_id = image['Id'].split(':', 1)[1][:12]
+        events = [
+            {'stream': 'Step %d/%d : RUN true\n' % (
+                i + 1, self.state.build_lines)}
+            for i in range(self.state.build_lines)
+        ]
+        events.append({'aux': {'ID': image['Id']}})
+        events.append({'stream': 'Successfully built %s\n' % short_id})
+        if tag:
+            events.append({'stream': 'Successfully tagged %s\n' % tag})
+        self.server.last_build_context = context
+        self.stream_events(events)
+
+class FakeDockerServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+    # many concurrent builds overflow the default backlog of 5
+    request_queue_size = 128
+    last_build_context = None
+
+    def __init__(self, path, state=None):
+        self.state = state or FakeDockerState()
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+
+    def get_request(self):
+        request, _ = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+@contextmanager
+def serve(path, **kw):
+    """ Run a fake docker daemon on a unix socket in a background thread."""
+    server = FakeDockerServer(path, FakeDockerState(**kw))
+    th = threading.Thread(target=server.serve_forever, daemon=True)
+    th.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+KNOBS = (
+    'attach_size', 'stderr_size', 'chunk_size', 'build_lines',
+    'archive_size', 'pull_lines', 'exit_code', 'latency',
+)
+
+def main(argv=None):
+    """ Serve the fake daemon until interrupted.
+
+    The path of the socket is written to stdout once the server is ready.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket')
+    for knob in KNOBS:
+        parser.add_argument(
+            '--' + knob.replace('_', '-'),
+            type=float if knob == 'latency' else int,
+        )
+    args = parser.parse_args(argv)
+    kw = {
+        knob: getattr(args, knob)
+        for knob in KNOBS
+        if getattr(args, knob) is not None
+    }
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *a: stopped.set())
+    with serve(args.socket, **kw):
+        print(args.socket, flush=True)
+        try:
+            stopped.wait()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+
+@pytest.fixture
+def engine(fake_docker):
+    from marina.aio import AsyncDockerClient
+    from marina.aio import AsyncEngine
+    engine = AsyncEngine(AsyncDockerClient(fake_docker.server_address))
+    yield engine
+    engine.close()
+
+def _create_container(fake_docker):
+    import docker
+    client = docker.APIClient(base_url='unix://' + fake_docker.server_address)
+    fake_docker.state.add_image('ubuntu:14.04')
+    container = client.create_container('ubuntu:14.04')['Id']
+    return client, container
+
+def test_build_decodes_chunked_events(engine, fake_docker):
+    from marina.aio import make_build_context
+    fake_docker.state.build_lines = 3
+    events = list(engine.build(
+        [make_build_context('FROM ubuntu:14.04\n')],
+        params={'t': 'app:1.0'},
+    ))
+    image = fake_docker.state.find_image('app:1.0')
+    assert [e['stream'] for e in events[:3]] == [
+        'Step %d/3 : RUN true\n' % (i + 1) for i in range(3)]
+    assert {'aux': {'ID': image['Id']}} in events
+    assert events[-1] == {'stream': 'Successfully tagged app:1.0\n'}
+    assert fake_docker.last_build_context.startswith(b'Dockerfile')
+
+def test_attach_demuxes_stdout_and_stderr(engine, fake_docker):
+    fake_docker.state.chunk_size = 10
+    fake_docker.state.attach_size = 25
+    fake_docker.state.stderr_size = 15
+    client, container = _create_container(fake_docker)
+    output = []
+    num_bytes = engine.run(engine.client.attach(
+        container, output.append,
+        on_attached=lambda: client.start(container),
+    ))
+    assert num_bytes == 40
+    # the frame headers are stripped and both streams are forwarded
+    assert ''.join(output) == (
+        'xxxxxxxxx\nxxxxxxxxx\nxxxxx' + 'eeeeeeeee\neeeee')
+    assert engine.wait(container) == 0
+
+def test_wait_times_out(engine, fake_docker):
+    fake_docker.state.latency = 5
+    client, container = _create_container(fake_docker)
+    client.start(container)
+    with pytest.raises(asyncio.TimeoutError):
+        engine.wait(container, timeout=0.2)
+
+def test_cancelled_wait_leaves_the_loop_usable(engine, fake_docker):
+    fake_docker.state.latency = 5
+    client, container = _create_container(fake_docker)
+    client.start(container)
+    future = engine.submit(engine.client.wait(container))
+    assert future.cancel()
+    assert future.cancelled()
+    client.stop(container)
+    assert engine.wait(container, timeout=5) == 0
+
+def test_api_errors_are_raised(engine):
+    from marina.aio import DockerAPIError
+    with pytest.raises(DockerAPIError) as exc_info:
+        engine.wait('missing')
+    assert exc_info.value.status == 404
+
+def test_iter_applies_backpressure(engine):
+    produced = []
+
+    async def numbers():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    async def count():
+        await asyncio.sleep(0.1)
+        return len(produced)
+
+    engine.queue_size = 2
+    it = engine.iter(numbers())
+    assert next(it) == 0
+    # the generator is suspended once the queue is full
+    assert engine.run(count()) == 4
+    assert list(it) == list(range(1, 10))
+
+def test_iter_times_out(engine):
+    async def stalled():
+        yield 1
+        await asyncio.sleep(5)
+        yield 2
+
+    it = engine.iter(stalled(), timeout=0.2)
+    assert next(it) == 1
+    with pytest.raises(asyncio.TimeoutError):
+        next(it)
+
+def test_closing_iter_closes_the_generator(engine):
+    closed = []
+
+    async def endless():
+        try:
+            while True:
+                yield 1
+                await asyncio.sleep(0)
+        finally:
+            closed.append(True)
+
+    it = engine.iter(endless())
+    assert next(it) == 1
+    it.close()
+    engine.run(asyncio.sleep(0.1))
+    assert closed == [True]
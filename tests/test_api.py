@@ -0,0 +1,76 @@
+import os.path
+
+here = os.path.abspath(os.path.dirname(__file__))
+
+def test_batch_build_returns_results(fake_docker, tmpdir):
+    from marina.api import BatchBuilder
+    from marina.build import parse_build_steps_from_file
+
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    steps = parse_build_steps_from_file(os.path.join(dummy_path, 'meta.yml'))
+    steps.name = 'other'
+    steps.context_path = dummy_path
+    missing = str(tmpdir.join('missing'))
+    fake_docker.state.attach_size = 4096
+
+    with BatchBuilder(
+        build_dir=str(tmpdir),
+        archive_dir=str(tmpdir.join('slugs')),
+        log_lines=2,
+    ) as builder:
+        ok, other, bad = builder.build(
+            [dummy_path, steps, missing], tag='1.0')
+
+    assert ok.success and other.success
+    assert (ok.app, ok.version, ok.tag) == ('dummy', '1.0', 'dummy:1.0')
+    assert other.tag == 'other:1.0'
+    assert ok.image in fake_docker.state.images
+    assert ok.slug_path == str(tmpdir.join('slugs', 'dummy-1.0.tar.gz'))
+    assert os.path.getsize(ok.slug_path) == 4096
+    assert len(ok.slug_digest) == 64
+    assert 'compile' in ok.phases
+    assert ('compile', 0) in ok.exit_codes
+    assert ok.log[-1] == 'created image=dummy:1.0\n'
+    assert len(ok.log) == 2
+    # the caller's steps are not modified
+    assert steps.version != '1.0'
+
+    assert not bad.success
+    assert bad.error.startswith('Invalid meta.yml')
+
+def test_batch_build_applies_build_options(fake_docker, tmpdir):
+    from marina.api import BatchBuilder
+
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    with BatchBuilder(
+        build_dir=str(tmpdir),
+        archive_dir=str(tmpdir.join('slugs')),
+        compression='zstd',
+        snapshot=True,
+        cache=False,
+    ) as builder:
+        result, = builder.build([dummy_path], tag='2.0')
+
+    assert result.success
+    assert result.slug_path == str(tmpdir.join('slugs', 'dummy-2.0.tar.zst'))
+    assert 'snapshot' in result.phases
+    assert not fake_docker.state.volumes
+
+def test_batch_build_renames_slug_after_codec_fallback(fake_docker, tmpdir):
+    from marina.api import BatchBuilder
+
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    # zstd is not installed in the compile image
+    fake_docker.state.archive_codec = 'gzip'
+    with BatchBuilder(
+        build_dir=str(tmpdir),
+        archive_dir=str(tmpdir.join('slugs')),
+        compression='zstd',
+        host_dist=True,
+    ) as builder:
+        result, = builder.build([dummy_path], tag='2.0')
+
+    assert result.success
+    assert result.slug_path == str(tmpdir.join('slugs', 'dummy-2.0.tar.gz'))
+    assert sorted(os.listdir(str(tmpdir.join('slugs')))) == [
+        'dummy-2.0.tar.gz', 'dummy-2.0.tar.gz.sha256']
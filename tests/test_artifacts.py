@@ -0,0 +1,79 @@
+import os
+import os.path
+
+here = os.path.abspath(os.path.dirname(__file__))
+dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+
+def test_store_put_get_prune(tmpdir):
+    from marina.artifacts import ArtifactStore
+    store = ArtifactStore(str(tmpdir.join('store')))
+    assert store.get('aa11') is None
+
+    for key, size in (('aa11', 300), ('bb22', 200), ('cc33', 100)):
+        src = tmpdir.join(key)
+        src.write(b'x' * size, mode='wb')
+        artifact = store.put(key, str(src), 'gzip')
+        assert artifact.size == size
+        os.utime(store._prefix(key) + '.json', (0, len(key) + size))
+
+    artifact = store.get('bb22')
+    assert artifact.codec == 'gzip'
+    assert open(artifact.path, 'rb').read() == b'x' * 200
+    assert not [
+        f for f in tmpdir.join('store', 'aa').listdir()
+        if f.basename.startswith('.tmp-')]
+
+    # bb22 was just used so aa11 and cc33 are evicted
+    evicted = store.prune(250)
+    assert sorted(a.key for a in evicted) == ['aa11', 'cc33']
+    assert store.get('aa11') is None
+    assert [a.key for a in store.entries()] == ['bb22']
+
+def test_build_reuses_stored_slug(fake_docker, tmpdir):
+    from marina.cli import main
+    store = tmpdir.join('store')
+    argv = [
+        'build', '--force', '--artifact-store', str(store), dummy_path,
+    ]
+
+    def compiles():
+        return len([
+            c for c in fake_docker.state.created
+            if c.get('Cmd') == ['/bin/bash', 'build.sh']
+        ])
+
+    assert main(argv) == 0
+    assert compiles() == 1
+    assert len(store.listdir()) == 1
+
+    assert main(argv) == 0
+    assert compiles() == 1
+    # the slug is extracted from the host-bound dist folder
+    extract = fake_docker.state.created[-1]
+    binds = extract['HostConfig']['Binds']
+    assert [b.split(':')[1:] for b in binds] == [['/marina/dist', 'ro']]
+
+def test_corrupt_artifact_is_recompiled(fake_docker, tmpdir):
+    from marina.cli import main
+    store = tmpdir.join('store')
+    archive = tmpdir.join('dummy.tar.gz')
+    argv = [
+        'build', '--force', '--artifact-store', str(store),
+        '--archive', str(archive), dummy_path,
+    ]
+
+    def compiles():
+        return len([
+            c for c in fake_docker.state.created
+            if c.get('Cmd') == ['/bin/bash', 'build.sh']
+        ])
+
+    assert main(argv) == 0
+    slug, = store.visit('*.slug')
+    # the archive does not share its inode with the stored slug
+    assert os.stat(str(archive)).st_ino != os.stat(str(slug)).st_ino
+
+    slug.write('corrupt')
+    assert main(argv) == 0
+    assert compiles() == 2
+    assert slug.read() != 'corrupt'
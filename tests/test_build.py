@@ -1,4 +1,5 @@
 import os.path
+import pytest
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -6,3 +7,482 @@ def test_dummy():
     from marina.cli import main
     dummy_path = os.path.join(here, '..', 'examples', 'dummy')
     assert main(['-vvv', 'build', dummy_path]) == 0
+
+def _make_app(tmpdir, meta=None):
+    app = tmpdir.mkdir('app')
+    app.join('meta.yml').write(meta or (
+        'name: dummy\n'
+        'compile:\n'
+        '  base_image: ubuntu:14.04\n'
+        '  files: [/srv/dummy]\n'
+        'run:\n'
+        '  base_image: ubuntu:14.04\n'
+    ))
+    app.join('main.py').write('print("hello")\n')
+    return app
+
+def _steps_digest(app):
+    import hashlib
+    from marina.build import parse_build_steps_from_file
+    steps = parse_build_steps_from_file(str(app.join('meta.yml')))
+    steps.context_path = str(app)
+    h = hashlib.sha256()
+    steps.update_digest(h)
+    return h.hexdigest()
+
+def test_steps_digest_is_stable(tmpdir):
+    app = _make_app(tmpdir)
+    assert _steps_digest(app) == _steps_digest(app)
+
+def test_steps_digest_ignores_tag(tmpdir):
+    app = _make_app(tmpdir)
+    digest = _steps_digest(app)
+    app.join('meta.yml').write('tag: foo\n', mode='a')
+    assert _steps_digest(app) == digest
+
+def test_steps_digest_tracks_context(tmpdir):
+    app = _make_app(tmpdir)
+    digest = _steps_digest(app)
+    app.join('main.py').write('print("goodbye")\n')
+    assert _steps_digest(app) != digest
+
+def test_normalize_image_ref():
+    from marina.build import normalize_image_ref
+    assert normalize_image_ref('ubuntu') == 'ubuntu:latest'
+    assert normalize_image_ref('ubuntu:14.04') == 'ubuntu:14.04'
+    assert normalize_image_ref('docker.io/library/ubuntu') == 'ubuntu:latest'
+    assert (
+        normalize_image_ref('localhost:5000/app') ==
+        'localhost:5000/app:latest'
+    )
+    assert normalize_image_ref('app@sha256:abcd') == 'app@sha256:abcd'
+
+def test_compression_from_settings():
+    from marina.build import Compression
+    assert Compression.from_settings(None).codec == 'gzip'
+    compression = Compression.from_settings(
+        {'codec': 'zstd', 'level': 19, 'threads': 4})
+    assert compression.extension == '.tar.zst'
+    assert compression.compressor() == 'zstd -q -T4 -19'
+    assert compression.compressor('gzip') == 'gzip -9'
+    assert compression.override(codec='lz4').compressor() == 'lz4 -q -12'
+    assert compression.override(level=25).compressor() == (
+        'zstd -q -T4 --ultra -22')
+
+def test_build_script_default_compression():
+    import io
+    from marina.build import BuildScript
+    script = BuildScript()
+    script.add_archive_patterns(['/srv/dummy'])
+    fp = io.StringIO()
+    script.save(fp)
+    assert 'tar czf "$BUILD_ARCHIVE_PATH" --posix "/srv/dummy"\n' in (
+        fp.getvalue())
+
+def test_build_script_reproducible():
+    import io
+    from marina.build import BuildScript
+    script = BuildScript()
+    script.reproducible = True
+    script.add_archive_patterns(['/srv/dummy'])
+    fp = io.StringIO()
+    script.save(fp)
+    output = fp.getvalue()
+    assert '--sort=name --owner=0 --group=0 --numeric-owner' in output
+    assert '--mtime=@$SOURCE_DATE_EPOCH --clamp-mtime' in output
+    assert ('tar cf - --posix $BUILD_TAR_OPTIONS "/srv/dummy" | gzip -n > '
+            '"$BUILD_ARCHIVE_PATH"') in output
+
+def test_source_date_epoch_is_only_forwarded_when_reproducible(
+    fake_docker, tmpdir, monkeypatch,
+):
+    from marina.cli import main
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1234')
+
+    def compile_env(*options):
+        del fake_docker.state.created[:]
+        assert main(['build', '-b', str(tmpdir), '--force'] + list(options) +
+                    [dummy_path]) == 0
+        config, = [
+            c for c in fake_docker.state.created
+            if c.get('Cmd') == ['/bin/bash', 'build.sh']]
+        return config['Env']
+
+    assert not [e for e in compile_env() if 'SOURCE_DATE_EPOCH' in e]
+    assert 'SOURCE_DATE_EPOCH=1234' in compile_env('--reproducible')
+
+def test_build_output_parses_aux_image_id():
+    from marina.build import BuildOutput
+    events = [{'stream': 'Step %d\n' % i} for i in range(10)]
+    events.append({'aux': {'ID': 'sha256:abc'}})
+    events.append({'stream': 'Successfully built def\n'})
+    seen = []
+    output = BuildOutput(iter(events), on_event=seen.append, max_chunks=3)
+    assert list(output) == events
+    assert seen == events
+    assert output.image_id == 'sha256:abc'
+    assert output.output == 'Step 8\nStep 9\nSuccessfully built def\n'
+
+def test_build_output_legacy_image_id():
+    import pytest
+    from marina.build import BuildOutput
+    output = BuildOutput([{'stream': 'Successfully built 0123abcd\n'}])
+    list(output)
+    assert output.image_id == '0123abcd'
+
+    output = BuildOutput([{'stream': 'oops\n'}, {'error': 'failed'}])
+    with pytest.raises(Exception) as exc_info:
+        list(output)
+    assert exc_info.value.args[2] == 'oops\n'
+
+def test_build_with_fake_daemon(fake_docker):
+    from marina.cli import main
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    assert main(['build', dummy_path]) == 0
+    tags = [
+        tag
+        for image in fake_docker.state.images.values()
+        for tag in image['RepoTags']
+    ]
+    assert any(tag.startswith('dummy:') for tag in tags)
+    assert fake_docker.state.count('POST', r'/build$') == 1
+
+    # the second build reuses the image built from identical inputs
+    assert main(['build', dummy_path]) == 0
+    assert fake_docker.state.count('POST', r'/build$') == 1
+
+def test_archive_with_fake_daemon(fake_docker, tmpdir):
+    from marina.cli import main
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    archive = tmpdir.join('dummy.tar.gz')
+    fake_docker.state.attach_size = 4096
+    assert main([
+        'build', '--archive-only', '--archive', str(archive), dummy_path,
+    ]) == 0
+    assert archive.size() == 4096
+    assert archive.dirpath('dummy.tar.gz.sha256').check()
+
+MULTI_STEP_META = '''\
+name: multi
+
+compile:
+  - name: backend
+    base_image: python:3
+    depends_on: frontend
+    files: [/srv/app]
+  - name: frontend
+    base_image: node:20
+    files: [/srv/static]
+  - name: docs
+    base_image: python:3
+    files: [/srv/docs]
+
+run:
+  base_image: ubuntu:14.04
+'''
+
+def test_sort_compile_steps():
+    import pytest
+    from marina.build import parse_build_steps
+    steps = parse_build_steps(MULTI_STEP_META)
+    assert steps.multi_step
+    assert [s.name for s in steps.compilers] == [
+        'frontend', 'backend', 'docs']
+    with pytest.raises(ValueError):
+        parse_build_steps(MULTI_STEP_META.replace(
+            'base_image: node:20', 'base_image: node:20\n'
+            '    depends_on: [backend]'))
+    with pytest.raises(ValueError):
+        parse_build_steps(MULTI_STEP_META.replace('depends_on: frontend',
+                                                  'depends_on: missing'))
+
+def test_multi_step_build_with_fake_daemon(fake_docker, tmpdir):
+    from marina.cli import main
+    app = tmpdir.join('multi').ensure(dir=True)
+    app.join('meta.yml').write(MULTI_STEP_META)
+    assert main(['build', '--force', str(app)]) == 0
+
+    compiles = dict(
+        (dict(e.split('=', 1) for e in c['Env'])['BUILD_STEP'], c)
+        for c in fake_docker.state.created
+        if c.get('Cmd') == ['/bin/bash', 'build.sh']
+    )
+    assert sorted(compiles) == ['backend', 'docs', 'frontend']
+    binds = compiles['backend']['HostConfig']['Binds']
+    assert [b for b in binds if ':/marina/deps/frontend:' in b]
+    assert [b for b in binds if 'multi__buildcache-backend:' in b]
+
+    # each slug is extracted in order into a layer of the runner
+    extracts = fake_docker.state.created[-3:]
+    assert [c['Entrypoint'] for c in extracts] == [['tar']] * 3
+    assert [c['Cmd'][1].split('/')[3] for c in extracts] == [
+        'frontend', 'backend', 'docs']
+
+GROUPED_META = '''\
+name: grouped
+
+compile:
+  base_image: ubuntu:14.04
+  files:
+    deps: [/srv/venv]
+    app: [/srv/app]
+
+run:
+  base_image: ubuntu:14.04
+'''
+
+def test_grouped_files_are_separate_layers(fake_docker, tmpdir, caplog):
+    import io
+    import tarfile
+    from marina.cli import main
+    app = tmpdir.join('grouped').ensure(dir=True)
+    app.join('meta.yml').write(GROUPED_META)
+    # the ADD instruction cannot extract zstd, each group is committed
+    fake_docker.state.archive_codec = 'zstd'
+    assert main(['build', '--force', '--compression', 'zstd', str(app)]) == 0
+    extracts = fake_docker.state.created[-2:]
+    assert [c['Cmd'][-1] for c in extracts] == ['srv/venv', 'srv/app']
+    # the app layer is extracted from the image committed for the deps
+    assert extracts[1]['Image'] != extracts[0]['Image']
+    assert 'change on every build' in caplog.text
+
+    def slug(mtime, content):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+            for name, data in (
+                ('srv', None),
+                ('srv/venv/a.py', b'a'),
+                ('srv/app/main.py', content),
+            ):
+                info = tarfile.TarInfo(name)
+                # the files are clamped by a reproducible build but a
+                # folder is modified each time its contents are written
+                info.mtime = 1000
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mtime = mtime
+                    tf.addfile(info)
+                else:
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+        return buf.getvalue()
+
+    def build_layers(mtime, content):
+        fake_docker.state.archive_codec = 'gzip'
+        fake_docker.state.archive_data = slug(mtime, content)
+        # grouped files imply --single-pass, --host-dist and --reproducible
+        assert main(['build', '--force', str(app)]) == 0
+        context = tarfile.open(
+            fileobj=io.BytesIO(fake_docker.last_build_context))
+        dockerfile = context.extractfile('Dockerfile').read().decode('utf8')
+        assert 'ADD layers/layer-0.tar /\nADD layers/layer-1.tar /\n' in (
+            dockerfile)
+        return [
+            context.extractfile('layers/layer-{0}.tar'.format(i)).read()
+            for i in range(2)
+        ]
+
+    first = build_layers(1000, b'print(1)')
+    layer = tarfile.open(fileobj=io.BytesIO(first[1]))
+    assert layer.getnames() == ['srv', 'srv/app', 'srv/app/main.py']
+    # the parent folders of the deps are not left for docker to create
+    layer = tarfile.open(fileobj=io.BytesIO(first[0]))
+    assert layer.getnames() == ['srv', 'srv/venv', 'srv/venv/a.py']
+
+    # the folder containing both groups changes along with the app
+    second = build_layers(2000, b'print(2)')
+    assert second[0] == first[0]
+    assert second[1] != first[1]
+
+SNAPSHOT_META = '''\
+name: snap
+
+compile:
+  base_image: ubuntu:14.04
+  snapshot: true
+  commands:
+    - run: pip install -r requirements.txt
+      inputs: [requirements.txt]
+    - make
+  files:
+    - /srv/app
+
+run:
+  base_image: ubuntu:14.04
+'''
+
+def test_snapshot_skips_unchanged_commands(fake_docker, tmpdir):
+    from marina.cli import main
+    app = tmpdir.join('snap').ensure(dir=True)
+    app.join('meta.yml').write(SNAPSHOT_META)
+    app.join('requirements.txt').write('requests\n')
+    app.join('src', 'main.py').write('print(1)\n', ensure=True)
+
+    def commands():
+        created = fake_docker.state.created
+        del created[:]
+        assert main(['build', '--force', str(app)]) == 0
+        return [
+            c['Cmd'][1] for c in created if c['Cmd'][0] == '/bin/bash']
+
+    assert commands() == ['command-0.sh', 'command-1.sh', 'archive.sh']
+    assert commands() == ['archive.sh']
+    app.join('src', 'main.py').write('print(2)\n')
+    assert commands() == ['command-1.sh', 'archive.sh']
+    app.join('requirements.txt').write('requests\nyaml\n')
+    assert commands() == ['command-0.sh', 'command-1.sh', 'archive.sh']
+
+def test_snapshots_omit_env_and_are_pruned(fake_docker, tmpdir):
+    from marina.cli import main
+    app = tmpdir.join('snap').ensure(dir=True)
+    app.join('meta.yml').write(
+        SNAPSHOT_META.replace('snapshot: true', 'snapshot: true\n  '
+                              'max_snapshots: 3'))
+    app.join('requirements.txt').write('requests\n')
+
+    def snapshots():
+        return sorted(
+            (image['Created'], tag)
+            for image in fake_docker.state.images.values()
+            for tag in image['RepoTags']
+            if tag.startswith('snap__snapshot:')
+        )
+
+    argv = ['build', '-b', str(tmpdir), '--force', '-e', 'TOKEN=secret']
+    assert main(argv + [str(app)]) == 0
+    first = snapshots()
+    assert len(first) == 2
+    image = fake_docker.state.find_image(first[0][1])
+    env = image['Config']['Env']
+    assert 'TOKEN=' in env and 'PATH=/usr/bin:/bin' in env
+    assert not [entry for entry in env if 'secret' in entry]
+
+    for i in range(2):
+        app.join('main.py').write('print({0})\n'.format(i))
+        assert main(argv + [str(app)]) == 0
+    # the oldest snapshot of the second command was removed
+    kept = snapshots()
+    assert len(kept) == 3
+    assert kept[0] == first[0] and first[1] not in kept
+
+def test_warm_pool_reuses_compile_container(fake_docker, tmpdir):
+    from marina.cli import main
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    argv = [
+        'build', '-b', str(tmpdir), '--force', '--warm-pool', '--jobs', '1']
+    assert main(argv + [dummy_path, dummy_path]) == 0
+
+    created = fake_docker.state.created
+    assert not [c for c in created if c.get('Cmd') == ['/bin/bash', 'build.sh']]
+    warm = [c for c in created if c.get('Entrypoint') == ['tail']]
+    assert len(warm) == 1
+    # only the folder of the app is bound into the warm container
+    assert [b.rsplit(':', 2)[0] for b in warm[0]['HostConfig']['Binds']
+            if b.endswith(':/marina/builds:rw')] == [
+        str(tmpdir.join('.marina-pool', 'dummy'))]
+    execs = list(fake_docker.state.execs.values())
+    assert [e['Config']['Cmd'] for e in execs] == [
+        ['/bin/bash', 'build.sh']] * 2
+    # the warm container is removed once the builds are complete
+    assert fake_docker.state.containers == {}
+
+    # the exec is not run by the engine which enforces the timeout
+    assert main(argv + ['--timeout', '30', dummy_path]) != 0
+
+VARIANTS_META = '''\
+name: fan
+
+compile:
+  base_image: ubuntu:14.04
+  files: [/srv/app]
+
+run:
+  - name: slim
+    base_image: debian:slim
+  - name: debug
+    base_image: ubuntu:14.04
+    config:
+      Env:
+        DEBUG: '1'
+'''
+
+def test_run_variants_share_one_compile(fake_docker, tmpdir):
+    from marina.cli import main
+    app = tmpdir.join('fan').ensure(dir=True)
+    app.join('meta.yml').write(VARIANTS_META)
+    assert main(['build', '--tag', '1.0', str(app)]) == 0
+
+    created = fake_docker.state.created
+    assert len([c for c in created if c.get('Cmd') == [
+        '/bin/bash', 'build.sh']]) == 1
+    extracts = [c for c in created if c.get('Entrypoint') == ['tar']]
+    assert sorted(c['Image'] for c in extracts) == [
+        'debian:slim', 'ubuntu:14.04']
+    tags = sorted(
+        tag
+        for image in fake_docker.state.images.values()
+        for tag in image['RepoTags']
+        if tag.startswith('fan')
+    )
+    assert tags == ['fan-debug:1.0', 'fan-slim:1.0']
+    assert fake_docker.state.count('POST', r'/build$') == 2
+
+    # both variants are reused when the inputs are unchanged
+    del created[:]
+    assert main(['build', '--tag', '1.1', str(app)]) == 0
+    assert created == []
+    assert fake_docker.state.count('POST', r'/build$') == 2
+
+def test_run_variant_names_must_be_valid_repositories():
+    from marina.build import parse_build_steps
+    for name in ('Slim', 'debug_', 'a..b', 'x/y', ''):
+        meta = VARIANTS_META.replace('name: slim', 'name: "{0}"'.format(name))
+        with pytest.raises(ValueError):
+            parse_build_steps(meta)
+    steps = parse_build_steps(VARIANTS_META.replace('slim', 'slim-2.x_y'))
+    assert steps.run_variants == ['slim-2.x_y', 'debug']
+
+def test_sync_builds_of_an_app_are_serialized(fake_docker, tmpdir):
+    import threading
+    from marina.build import stage_lock
+    from marina.cli import main
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    argv = ['build', '-b', str(tmpdir), '--stage', 'sync', '--force',
+            dummy_path]
+    results = []
+    th = threading.Thread(target=lambda: results.append(main(argv)))
+    with stage_lock(str(tmpdir.join('.marina-stage', 'dummy'))):
+        th.start()
+        th.join(0.5)
+        assert th.is_alive()
+        assert not [c for c in fake_docker.state.created
+                    if c.get('Cmd') == ['/bin/bash', 'build.sh']]
+    th.join()
+    assert results == [0]
+
+def test_slug_is_decompressed_if_the_runner_lacks_the_codec(
+    fake_docker, tmpdir,
+):
+    from marina.cli import main
+    dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+    fake_docker.state.archive_codec = 'zstd'
+    # tar cannot run zstd in the runner image
+    fake_docker.state.exit_codes = lambda config: (
+        2 if '-I' in (config.get('Cmd') or []) else None)
+    assert main([
+        'build', '-b', str(tmpdir), '--host-dist', '--compression', 'zstd',
+        dummy_path,
+    ]) == 0
+
+    extract = [
+        config for config in fake_docker.state.created
+        if config.get('Entrypoint') in (['tar'], ['/bin/sh'])
+    ]
+    assert [config['Image'] for config in extract] == [
+        'ubuntu:14.04', 'ubuntu:14.04', 'ubuntu:14.04']
+    assert extract[0]['Cmd'][:2] == ['-I', 'zstd']
+    assert extract[1]['Cmd'][1] == 'zstd -dc "$1" > "$2"'
+    tarball = extract[1]['Cmd'][-1]
+    assert tarball.endswith('.tar') and not tarball.endswith('.zst.tar')
+    assert extract[2]['Cmd'][:2] == ['xf', tarball]
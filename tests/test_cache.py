@@ -0,0 +1,126 @@
+import gzip
+import io
+import os.path
+import tarfile
+import threading
+
+here = os.path.abspath(os.path.dirname(__file__))
+dummy_path = os.path.join(here, '..', 'examples', 'dummy')
+
+def test_select_evictions():
+    from marina.buildcache import CacheEntry
+    from marina.buildcache import select_evictions
+    entries = [
+        CacheEntry('new', 400, atime=30, mtime=10),
+        CacheEntry('old', 300, atime=5, mtime=10),
+        CacheEntry('older', 200, atime=1, mtime=2),
+    ]
+    assert select_evictions(entries, 900) == []
+    assert [e.name for e in select_evictions(entries, 700)] == ['older']
+    assert [e.name for e in select_evictions(entries, 500)] == [
+        'older', 'old']
+
+def test_prune_with_fake_daemon(fake_docker):
+    from marina.cli import main
+    fake_docker.state.volumes['dummy__buildcache'] = {
+        'Name': 'dummy__buildcache', 'Labels': {}}
+    fake_docker.state.log_output = (
+        '1024 100 100 pip\n'
+        '2048 50 60 npm cache\n'
+        '512 200 10 .m2\n'
+    )
+    assert main(['cache', 'prune', '--max-size', '2M', dummy_path]) == 0
+    rm = fake_docker.state.created[-1]
+    assert rm['Entrypoint'] == ['rm', '-rf', '--']
+    assert rm['Cmd'] == ['/cache/npm cache']
+    assert rm['HostConfig']['Binds'] == ['dummy__buildcache:/cache:rw']
+
+def test_export_import_with_fake_daemon(fake_docker, tmpdir):
+    from marina.cli import main
+    fake_docker.state.volumes['dummy__buildcache'] = {
+        'Name': 'dummy__buildcache', 'Labels': {}}
+    path = str(tmpdir.join('cache.tar.gz'))
+    assert main(['cache', 'export', '-f', path, dummy_path]) == 0
+    with tarfile.open(path) as tf:
+        assert tf.getnames() == ['cache']
+
+    assert main([
+        'cache', 'import', '--cache', 'fresh', '-f', path, dummy_path,
+    ]) == 0
+    assert 'fresh' in fake_docker.state.volumes
+    _, upload_path, body = fake_docker.state.uploads[-1]
+    assert upload_path == '/'
+    with gzip.open(path) as fp:
+        assert body == fp.read()
+
+def test_build_prunes_cache_over_quota(fake_docker, tmpdir):
+    from marina.cli import main
+    app = tmpdir.mkdir('app')
+    app.join('meta.yml').write(
+        'name: dummy\n'
+        'cache:\n'
+        '  max_size: 1k\n'
+        'compile:\n'
+        '  base_image: ubuntu:14.04\n'
+        '  files: [/srv/dummy]\n'
+        'run:\n'
+        '  base_image: ubuntu:14.04\n'
+    )
+    fake_docker.state.log_output = '4 100 100 pip\n'
+    assert main(['build', '-b', str(tmpdir), str(app)]) == 0
+    assert any(
+        c.get('Entrypoint') == ['rm', '-rf', '--'] and c['Cmd'] == ['/cache/pip']
+        for c in fake_docker.state.created
+    )
+
+def test_rebuild_cache_rotates_volume(fake_docker, tmpdir):
+    from marina.cli import main
+    volumes = fake_docker.state.volumes
+    argv = ['build', '-b', str(tmpdir), '--force', dummy_path]
+    assert main(argv) == 0
+    assert volumes['dummy__buildcache']['Labels'] == {
+        'marina.cache': 'dummy__buildcache',
+        'marina.cache.generation': '0',
+    }
+
+    assert main(argv[:1] + ['--rebuild-cache'] + argv[1:]) == 0
+    assert main(argv[:1] + ['--rebuild-cache'] + argv[1:]) == 0
+    for th in threading.enumerate():
+        if th.name == 'marina-cache-remove':
+            th.join()
+    assert list(volumes) == ['dummy__buildcache.2']
+    source = fake_docker.state.created[-2]
+    assert 'dummy__buildcache.2:/tmp/cache:rw' in source['HostConfig']['Binds']
+
+def test_rebuild_cache_clears_volume_with_driver_options(
+        fake_docker, tmpdir, monkeypatch):
+    from marina.build import BuildSteps
+    from marina.cli import main
+    scripts = []
+    write_build_script = BuildSteps.write_build_script
+
+    def record(self, dir, **kw):
+        write_build_script(self, dir, **kw)
+        with open(os.path.join(dir, 'build.sh')) as fp:
+            scripts.append(fp.read())
+    monkeypatch.setattr(BuildSteps, 'write_build_script', record)
+
+    volumes = fake_docker.state.volumes
+    volumes['nfs_cache'] = {
+        'Name': 'nfs_cache',
+        'Driver': 'local',
+        'Options': {'type': 'nfs', 'device': ':/exports/cache'},
+        'Labels': {'team': 'build'},
+    }
+    argv = [
+        'build', '-b', str(tmpdir), '--force', '--rebuild-cache',
+        '--cache', 'nfs_cache', dummy_path,
+    ]
+    assert main(argv) == 0
+    for th in threading.enumerate():
+        if th.name == 'marina-cache-remove':
+            th.join()
+    assert list(volumes) == ['nfs_cache']
+    assert 'find "$BUILD_CACHE" -mindepth 1 -delete\n' in scripts[-1]
+    source = fake_docker.state.created[-2]
+    assert 'nfs_cache:/tmp/cache:rw' in source['HostConfig']['Binds']
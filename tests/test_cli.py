@@ -0,0 +1,45 @@
+import subprocess
+import sys
+
+# importing docker alone used to cost more than this
+IMPORT_TIME_BUDGET_US = 150000
+
+def _import_time(module, runs=3):
+    best = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            stderr=subprocess.PIPE, universal_newlines=True, check=True,
+        )
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            parts = line.split('|')
+            if len(parts) != 3 or parts[2].strip() != module:
+                continue
+            cumulative = int(parts[1])
+            if best is None or cumulative < best:
+                best = cumulative
+    return best
+
+def test_cli_does_not_import_docker():
+    result = subprocess.run(
+        [sys.executable, '-c', (
+            'import sys, marina.cli, marina.submit;'
+            'print(sorted(m for m in ("docker", "pkg_resources", "yaml") '
+            'if m in sys.modules))'
+        )],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    assert result.stdout.strip() == '[]'
+
+def test_cli_import_time_budget():
+    assert _import_time('marina.cli') < IMPORT_TIME_BUDGET_US
+
+def test_version():
+    from importlib.metadata import version
+    result = subprocess.run(
+        [sys.executable, '-c', 'from marina.cli import main; main()',
+         '--version'],
+        stdout=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    assert result.stdout.strip() == version('marina')
@@ -0,0 +1,56 @@
+import pytest
+
+class DummyClient(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_client_pool_reuses_idle_clients():
+    from marina.clients import ClientPool
+    pool = ClientPool(DummyClient, size=1)
+    a = pool.acquire()
+    b = pool.acquire()
+    assert a is not b
+    pool.release(a)
+    pool.release(b)
+    assert not a.closed
+    assert b.closed
+    assert pool.acquire() is a
+    assert (pool.created, pool.reused) == (2, 1)
+
+def test_client_pool_discards_client_on_error():
+    from marina.clients import ClientPool
+    pool = ClientPool(DummyClient)
+    with pytest.raises(ValueError):
+        with pool.client() as client:
+            raise ValueError
+    assert client.closed
+    assert pool.idle == []
+    with pool.client() as other:
+        pass
+    assert pool.idle == [other]
+
+def test_image_puller_leases_its_own_client():
+    from marina.build import ImagePuller
+    from marina.clients import ClientPool
+
+    class PullClient(DummyClient):
+        pulled = None
+
+        def pull(self, image):
+            self.pulled = image
+
+    pool = ClientPool(PullClient)
+    leased = pool.acquire()
+    ImagePuller().pull(pool, 'ubuntu:14.04')
+    assert leased.pulled is None
+    assert [c.pulled for c in pool.idle] == ['ubuntu:14.04']
+    assert not pool.idle[0].closed
+
+def test_release_client_closes_unpooled_client():
+    from marina.clients import acquire_client
+    from marina.clients import release_client
+    client = acquire_client(DummyClient)
+    release_client(DummyClient, client)
+    assert client.closed
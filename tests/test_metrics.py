@@ -0,0 +1,37 @@
+import json
+
+def _make_metrics():
+    from marina.metrics import BuildMetrics
+    metrics = BuildMetrics('dummy', '1.0')
+    with metrics.measure():
+        for _ in range(2):
+            with metrics.phase('pull'):
+                pass
+        with metrics.phase('compile'):
+            metrics.record(status=0, num_bytes=10)
+            metrics.record(num_bytes=5)
+    metrics.record(num_bytes=100)
+    return metrics
+
+def test_build_metrics_json(tmpdir):
+    from marina.metrics import write_metrics_file
+    path = str(tmpdir.join('metrics.json'))
+    write_metrics_file(path, [_make_metrics()])
+    with open(path) as fp:
+        build, = json.load(fp)['builds']
+    assert build['app'] == 'dummy'
+    assert build['success']
+    assert [p['name'] for p in build['phases']] == ['pull', 'pull', 'compile']
+    assert build['phases'][2]['bytes'] == 15
+    assert build['phases'][2]['status'] == 0
+
+def test_build_metrics_prometheus():
+    from marina.metrics import render_prometheus
+    lines = render_prometheus([_make_metrics()]).splitlines()
+    assert '# TYPE marina_build_phase_bytes gauge' in lines
+    assert 'marina_build_phase_bytes{app="dummy",phase="compile"} 15.0' in lines
+    assert 'marina_build_success{app="dummy"} 1.0' in lines
+    assert sum(
+        1 for line in lines
+        if line.startswith('marina_build_phase_duration_seconds')
+    ) == 2
@@ -0,0 +1,82 @@
+import threading
+import time
+
+def test_identical_requests_share_a_build(tmpdir):
+    from marina.serve import BuildQueue
+    from marina.serve import UnixBuildServer
+    from marina.submit import UnixHTTPConnection
+    from marina.submit import submit_build
+
+    app = tmpdir.join('app').ensure(dir=True)
+    app.join('meta.yml').write(
+        'name: app\n'
+        'compile: {base_image: "ubuntu:14.04", files: [/srv/app]}\n'
+        'run: {base_image: "ubuntu:14.04"}\n'
+    )
+    release = threading.Event()
+    builds = []
+
+    def build(job):
+        builds.append(job.id)
+        job.write('building\n')
+        release.wait(5)
+        return {'status': 0, 'image': 'sha256:1234'}
+
+    jobs = BuildQueue(build, jobs=2)
+    path = str(tmpdir.join('marina.sock'))
+    server = UnixBuildServer(path, jobs)
+    th = threading.Thread(target=server.serve_forever)
+    th.start()
+    try:
+        results = []
+
+        def client(env=None):
+            conn = UnixHTTPConnection(path)
+            results.append(list(submit_build(conn, str(app), env=env)))
+            conn.close()
+
+        clients = [threading.Thread(target=client) for _ in range(2)]
+        clients.append(threading.Thread(target=client, args=({'X': '1'},)))
+        deadline = time.time() + 5
+        for t in clients:
+            t.daemon = True
+            t.start()
+        while (
+            sum(j['clients'] for j in jobs.jobs()) < 3 or len(builds) < 2
+        ):
+            assert time.time() < deadline, 'the requests were not queued'
+            threading.Event().wait(0.01)
+        release.set()
+        for t in clients:
+            t.join(max(deadline - time.time(), 1))
+            assert not t.is_alive(), 'the client did not receive a result'
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+        jobs.close()
+        th.join()
+
+    # the requests with an identical environment share the build
+    assert len(builds) == 2
+    shared = sorted(events[0]['shared'] for events in results)
+    assert shared == [False, False, True]
+    for events in results:
+        assert [e['event'] for e in events[-3:]] == ['started', 'log', 'result']
+        assert events[-1]['status'] == 0
+    assert sorted(j['clients'] for j in jobs.jobs()) == [1, 2]
+
+def test_late_followers_receive_a_truncated_log():
+    from marina.serve import BuildJob
+
+    job = BuildJob('1', 'key', 'app', max_events=3)
+    job.start()
+    for i in range(5):
+        job.write('line {0}\n'.format(i))
+    job.finish({'status': 0})
+
+    events = list(job.follow())
+    assert events[0] == {'event': 'truncated', 'job': '1', 'skipped': 4}
+    assert [e.get('data') for e in events[1:3]] == ['line 3\n', 'line 4\n']
+    assert events[-1]['event'] == 'result'
+    assert len(job.events) == 3
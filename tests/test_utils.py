@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+def test_ignore_rules(tmpdir):
+    from marina.utils import IgnoreRules
+    tmpdir.mkdir('node_modules')
+    tmpdir.mkdir('dist')
+    tmpdir.join('build').write('')
+    ignore = IgnoreRules(str(tmpdir), [
+        '# comment',
+        '.git',
+        'node_modules/',
+        '*.pyc',
+        'dist/*',
+        '!dist/keep.txt',
+        'build/',
+    ])
+    assert ignore('.git')
+    assert ignore('node_modules')
+    assert ignore(os.path.join('src', 'foo.pyc'))
+    assert ignore(os.path.join('dist', 'app.js'))
+    assert not ignore(os.path.join('dist', 'keep.txt'))
+    assert not ignore('build')
+    assert not ignore('src')
+
+def test_ignore_rules_anchored(tmpdir):
+    from marina.utils import IgnoreRules
+    ignore = IgnoreRules(str(tmpdir), ['/build', 'docs/*.md', 'a/**/z'])
+    assert ignore('build')
+    assert not ignore(os.path.join('src', 'build'))
+    assert ignore(os.path.join('docs', 'a.md'))
+    assert not ignore(os.path.join('docs', 'sub', 'a.md'))
+    assert not ignore(os.path.join('src', 'docs', 'a.md'))
+    assert ignore(os.path.join('a', 'z'))
+    assert ignore(os.path.join('a', 'b', 'c', 'z'))
+
+def test_stage_tree_sync(tmpdir):
+    from marina.utils import stage_tree
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    src.mkdir('sub').join('b.txt').write('bb')
+    src.mkdir('skip').join('c.txt').write('ccc')
+    dst = tmpdir.join('dst')
+
+    def ignore(relpath):
+        return relpath == 'skip'
+
+    stats = stage_tree(str(src), str(dst), mode='sync', ignore=ignore)
+    assert stats.files == 2
+    assert stats.bytes == 3
+    assert dst.join('sub', 'b.txt').read() == 'bb'
+    assert not dst.join('skip').exists()
+
+    dst.join('junk.txt').write('junk')
+    src.join('a.txt').write('aaaa')
+    stats = stage_tree(str(src), str(dst), mode='sync', ignore=ignore)
+    assert stats.files == 1
+    assert stats.bytes == 4
+    assert stats.unchanged == 1
+    assert stats.removed == 1
+    assert dst.join('a.txt').read() == 'aaaa'
+    assert not dst.join('junk.txt').exists()
+
+def test_stage_tree_hardlink(tmpdir):
+    from marina.utils import stage_tree
+    src = tmpdir.mkdir('src')
+    src.join('a.txt').write('a')
+    dst = tmpdir.join('dst')
+    stats = stage_tree(str(src), str(dst), mode='hardlink')
+    assert stats.files == 1
+    assert os.path.samefile(str(src.join('a.txt')), str(dst.join('a.txt')))
+
+def test_publish_file(tmpdir):
+    import hashlib
+    from marina.utils import publish_file
+    from marina.utils import write_checksum_file
+    src = tmpdir.join('src.tar.gz')
+    src.write('slug')
+    dst = tmpdir.join('dst.tar.gz')
+    digest = publish_file(str(src), str(dst))
+    assert digest == hashlib.sha256(b'slug').hexdigest()
+    assert dst.read() == 'slug'
+    assert src.exists()
+
+    path = write_checksum_file(str(dst), digest)
+    assert tmpdir.join('dst.tar.gz.sha256').read() == (
+        digest + '  dst.tar.gz\n')
+    assert path == str(dst) + '.sha256'
+
+    moved = tmpdir.join('moved.tar.gz')
+    assert publish_file(str(src), str(moved), move=True) == digest
+    assert not src.exists()
+
+def test_parse_size():
+    from marina.utils import parse_size
+    assert parse_size(None) is None
+    assert parse_size(10) == 10
+    assert parse_size('512') == 512
+    assert parse_size('2k') == 2048
+    assert parse_size('1.5G') == 3 * 1024 ** 3 // 2
+    assert parse_size('100MiB') == 100 * 1024 ** 2
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+def make_tarball(path, members):
+    import io
+    import tarfile
+    with tarfile.open(path, 'w:gz', format=tarfile.PAX_FORMAT) as tf:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = 1000
+            tf.addfile(info, io.BytesIO(data))
+
+def test_split_tarball(tmpdir):
+    import tarfile
+    from marina.utils import split_tarball
+    src = str(tmpdir.join('slug.tar.gz'))
+    make_tarball(src, [
+        ('srv/venv/lib/a.py', b'a'),
+        ('srv/app/main.py', b'main'),
+        ('srv/venv2/b.py', b'b'),
+    ])
+    groups = [
+        (str(tmpdir.join('deps.tar')), ['srv/venv']),
+        (str(tmpdir.join('app.tar')), ['srv/app']),
+    ]
+    assert split_tarball(src, groups) == [1, 2]
+    with tarfile.open(groups[0][0]) as tf:
+        assert tf.getnames() == ['srv', 'srv/venv', 'srv/venv/lib',
+                                 'srv/venv/lib/a.py']
+        assert tf.getmember('srv').isdir()
+        assert tf.getmember('srv').mtime == 0
+    with tarfile.open(groups[1][0]) as tf:
+        assert tf.getnames() == ['srv', 'srv/app', 'srv/app/main.py',
+                                 'srv/venv2', 'srv/venv2/b.py']
+        assert tf.extractfile('srv/app/main.py').read() == b'main'
+
+    # identical input results in identical layers
+    first = tmpdir.join('deps.tar').read_binary()
+    split_tarball(src, groups)
+    assert tmpdir.join('deps.tar').read_binary() == first
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+
+import pytest
+
+@pytest.mark.parametrize('poll', [False, True])
+def test_watcher_reports_changes(tmpdir, poll):
+    from marina.utils import IgnoreRules
+    from marina.watch import make_watch_ignore
+    from marina.watch import make_watcher
+    from marina.watch import wait_for_changes
+
+    app = tmpdir.join('app').ensure(dir=True)
+    app.join('.marinaignore').write('*.log\n')
+    app.join('src', 'main.py').write('print(1)\n', ensure=True)
+    root = str(app)
+    ignore = make_watch_ignore(
+        root, root, IgnoreRules.from_file(root, '.marinaignore'))
+    watcher = make_watcher(root, ignore=ignore, poll=poll, interval=0.05)
+
+    def change():
+        time.sleep(0.1)
+        app.join('debug.log').write('ignored\n')
+        app.join('.marina-build-1234').ensure(dir=True)
+        app.join('src', 'main.py').write('print(2)\n')
+        os.mkdir(str(app.join('src', 'pkg')))
+        time.sleep(0.1)
+        app.join('src', 'pkg', 'mod.py').write('print(3)\n')
+
+    th = threading.Thread(target=change)
+    th.start()
+    try:
+        changes, _ = wait_for_changes(watcher, 0.3)
+    finally:
+        th.join()
+        watcher.close()
+    # polling also reports the folders whose modification time changed
+    files = [c for c in changes if os.path.isfile(str(app.join(c)))]
+    assert files == [
+        os.path.join('src', 'main.py'),
+        os.path.join('src', 'pkg', 'mod.py'),
+    ]
+
+def test_watch_survives_invalid_meta_and_reloads_ignore_rules(
+    fake_docker, tmpdir, monkeypatch,
+):
+    import io
+    import marina.watch
+    from marina.cli import MarinaApp
+    from marina.cli import main
+
+    app = tmpdir.join('app').ensure(dir=True)
+    app.join('meta.yml').write(
+        'name: app\n'
+        'compile: {base_image: "ubuntu:14.04", files: [/srv/app]}\n'
+        'run: {base_image: "ubuntu:14.04"}\n'
+    )
+    watchers = []
+    make_watcher = marina.watch.make_watcher
+    monkeypatch.setattr(
+        marina.watch, 'make_watcher',
+        lambda *a, **kw: watchers.append(1) or make_watcher(*a, **kw))
+    cycles = [
+        lambda: app.join('meta.yml').write('name: [\n') or ['meta.yml'],
+        lambda: app.join('.marinaignore').write('*.log\n') or [
+            '.marinaignore'],
+    ]
+
+    stdout, stderr = io.StringIO(), io.StringIO()
+    monkeypatch.setattr(MarinaApp, 'stdout', stdout)
+    monkeypatch.setattr(MarinaApp, 'stderr', stderr)
+
+    def wait_for_changes(watcher, delay):
+        if not cycles:
+            raise KeyboardInterrupt
+        return cycles.pop(0)(), time.time()
+    monkeypatch.setattr(marina.watch, 'wait_for_changes', wait_for_changes)
+
+    assert main([
+        'watch', '-b', str(tmpdir.join('build')), '--poll', str(app)]) == 0
+    assert 'cycle=0 status=ok' in stdout.getvalue()
+    assert 'cycle=1 status=failed' in stdout.getvalue()
+    assert 'cycle=2 status=failed' in stdout.getvalue()
+    assert 'Invalid meta.yml' in stderr.getvalue()
+    # the watcher is recreated with the new rules
+    assert len(watchers) == 2
+
+def test_pooled_sync_context_is_reached_through_the_pool(fake_docker, tmpdir):
+    from marina.cli import main
+    app = tmpdir.join('app').ensure(dir=True)
+    app.join('meta.yml').write(
+        'name: app\n'
+        'compile: {base_image: "ubuntu:14.04", files: [/srv/app]}\n'
+        'run: {base_image: "ubuntu:14.04"}\n'
+    )
+    build_dir = tmpdir.join('build')
+    assert main([
+        'build', '-b', str(build_dir), '--warm-pool', '--stage', 'sync',
+        str(app),
+    ]) == 0
+
+    execs = list(fake_docker.state.execs.values())
+    assert len(execs) == 1
+    env = dict(e.split('=', 1) for e in execs[0]['Config']['Env'])
+    assert env['BUILD_CONTEXT'] == '/marina/builds/stage'
+    # the bound pool folder of the app contains the staged context
+    stage = build_dir.join('.marina-pool', 'app', 'stage')
+    assert stage.join('meta.yml').check()